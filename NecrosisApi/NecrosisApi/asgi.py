@@ -5,12 +5,18 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+Static files (the admin's CSS and JS) are served by ASGIStaticFilesHandler,
+as uvicorn serves none. Put a proxy or CDN in front of STATIC_ROOT to take
+that traffic off the application.
 """
 
 import os
 
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'NecrosisApi.settings')
+os.environ.setdefault('NECROSIS_ASGI', '1')
 
-application = get_asgi_application()
+application = ASGIStaticFilesHandler(get_asgi_application())
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'necrosis.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -79,12 +81,55 @@ WSGI_APPLICATION = 'NecrosisApi.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default, for single-node installs. Set NECROSIS_DB_ENGINE=postgresql
+# (and the NECROSIS_DB_* connection settings) when several processes write.
+NECROSIS_DB_ENGINE = os.environ.get('NECROSIS_DB_ENGINE', 'sqlite')
+# Seconds a connection is reused across requests; 0 closes it after each request
+NECROSIS_DB_CONN_MAX_AGE = int(os.environ.get('NECROSIS_DB_CONN_MAX_AGE', 60))
+# PostgreSQL only: psycopg connection pool, used instead of persistent connections
+NECROSIS_DB_POOL = os.environ.get('NECROSIS_DB_POOL', '').lower() in ('1', 'true', 'yes')
+NECROSIS_DB_POOL_MIN_SIZE = int(os.environ.get('NECROSIS_DB_POOL_MIN_SIZE', 2))
+NECROSIS_DB_POOL_MAX_SIZE = int(os.environ.get('NECROSIS_DB_POOL_MAX_SIZE', 10))
+# SQLite only: seconds a writer waits for the lock before "database is locked"
+NECROSIS_SQLITE_TIMEOUT = float(os.environ.get('NECROSIS_SQLITE_TIMEOUT', 20))
+# SQLite only: write-ahead log, so readers no longer block on the writer.
+# Opt-in: the mode is stored in the database file, which it rewrites, so use
+# it with a NECROSIS_DB_NAME outside the repository, not the committed one
+NECROSIS_SQLITE_WAL = os.environ.get('NECROSIS_SQLITE_WAL', '').lower() in ('1', 'true', 'yes')
+
+if NECROSIS_DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('NECROSIS_DB_NAME', 'necrosis'),
+            'USER': os.environ.get('NECROSIS_DB_USER', 'necrosis'),
+            'PASSWORD': os.environ.get('NECROSIS_DB_PASSWORD', ''),
+            'HOST': os.environ.get('NECROSIS_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('NECROSIS_DB_PORT', '5432'),
+            # Django refuses persistent connections on top of the pool
+            'CONN_MAX_AGE': 0 if NECROSIS_DB_POOL else NECROSIS_DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {'min_size': NECROSIS_DB_POOL_MIN_SIZE, 'max_size': NECROSIS_DB_POOL_MAX_SIZE},
+            } if NECROSIS_DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('NECROSIS_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': NECROSIS_DB_CONN_MAX_AGE,
+            'OPTIONS': {
+                # synchronous=NORMAL is durable across application crashes in WAL mode
+                'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL' if NECROSIS_SQLITE_WAL else '',
+                'timeout': NECROSIS_SQLITE_TIMEOUT,
+                # Take the write lock at BEGIN: a deferred transaction upgrading
+                # to a writer fails immediately instead of waiting out the timeout
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -141,3 +186,142 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 CORS_ALLOW_ALL_ORIGINS = True
 
 AUTH_USER_MODEL = 'necrosis.User'
+
+# Segmentation model weights
+NECROSIS_MODEL_PATH = os.environ.get(
+    'NECROSIS_MODEL_PATH',
+    str(BASE_DIR / 'media/models/exp_new-Sep-24_yolov8n-seg_24-09-27_13_26/best.pt'),
+)
+
+# Inference backend: 'torch' (the .pt weights), or 'onnx' / 'openvino' to run an
+# export made with `manage.py export_model` on CPU. NECROSIS_INFERENCE_INT8
+# selects the INT8 quantized export.
+NECROSIS_INFERENCE_BACKEND = os.environ.get('NECROSIS_INFERENCE_BACKEND', 'torch')
+NECROSIS_INFERENCE_INT8 = os.environ.get('NECROSIS_INFERENCE_INT8', '').lower() in ('1', 'true', 'yes')
+
+# Concurrent in-process inference (see necrosis.executor): model replicas
+# shared by request threads (1 serializes inference), and the intra-op threads
+# torch and OpenCV may use per process (unset keeps the library default)
+NECROSIS_MODEL_REPLICAS = int(os.environ.get('NECROSIS_MODEL_REPLICAS', 1))
+NECROSIS_TORCH_THREADS = int(os.environ['NECROSIS_TORCH_THREADS']) if os.environ.get('NECROSIS_TORCH_THREADS') else None
+NECROSIS_CV2_THREADS = int(os.environ['NECROSIS_CV2_THREADS']) if os.environ.get('NECROSIS_CV2_THREADS') else None
+
+# Number of images sent through the segmentation model per forward pass
+NECROSIS_INFERENCE_BATCH_SIZE = int(os.environ.get('NECROSIS_INFERENCE_BATCH_SIZE', 8))
+
+# Set by NecrosisApi.asgi: served over ASGI, the default session download
+# route uses the async view, which streams the ZIP without buffering it
+NECROSIS_ASGI = os.environ.get('NECROSIS_ASGI', '').lower() in ('1', 'true', 'yes')
+
+# Threads the async views (necrosis.async_views) hand decoding and inference to
+NECROSIS_ASYNC_INFERENCE_THREADS = int(os.environ.get('NECROSIS_ASYNC_INFERENCE_THREADS', NECROSIS_MODEL_REPLICAS))
+
+# Tiled inference for large images (see necrosis.tiling): images above
+# NECROSIS_TILE_MIN_PIXELS are also inferred as overlapping tiles of
+# NECROSIS_TILE_SIZE pixels, at most NECROSIS_MAX_CONCURRENT_TILES per pass
+NECROSIS_TILED_INFERENCE = os.environ.get('NECROSIS_TILED_INFERENCE', '').lower() in ('1', 'true', 'yes')
+NECROSIS_TILE_SIZE = int(os.environ.get('NECROSIS_TILE_SIZE', 1280))
+NECROSIS_TILE_OVERLAP = int(os.environ.get('NECROSIS_TILE_OVERLAP', 256))
+NECROSIS_MAX_CONCURRENT_TILES = int(os.environ.get('NECROSIS_MAX_CONCURRENT_TILES', 8))
+NECROSIS_TILE_MIN_PIXELS = int(os.environ.get('NECROSIS_TILE_MIN_PIXELS', 12_000_000))
+
+# How process_results measures root and necrosis areas: 'raster' (pixel exact,
+# bounding-box sized masks) or 'shoelace' (polygon areas, no masks)
+NECROSIS_AREA_METHOD = os.environ.get('NECROSIS_AREA_METHOD', 'raster')
+
+# Threads writing original uploads to storage while inference runs
+NECROSIS_PERSIST_THREADS = int(os.environ.get('NECROSIS_PERSIST_THREADS', 4))
+
+# Content-hash cache of analysis results for re-uploaded images
+NECROSIS_RESULT_CACHE_ENABLED = os.environ.get('NECROSIS_RESULT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+NECROSIS_RESULT_CACHE_DIR = os.environ.get('NECROSIS_RESULT_CACHE_DIR', str(MEDIA_ROOT / 'cache/results'))
+NECROSIS_RESULT_CACHE_MAX_BYTES = int(os.environ.get('NECROSIS_RESULT_CACHE_MAX_BYTES', 1024 ** 3))
+
+# Draw and write every result overlay PNG during analysis. Off by default:
+# overlays are rendered from the stored polygons when first requested
+NECROSIS_EAGER_OVERLAYS = os.environ.get('NECROSIS_EAGER_OVERLAYS', '').lower() in ('1', 'true', 'yes')
+
+# Widths in pixels overlays can be requested at, besides full size
+NECROSIS_OVERLAY_WIDTHS = [int(w) for w in os.environ.get('NECROSIS_OVERLAY_WIDTHS', '320,640,1280').split(',')]
+
+# Lifetime in seconds of the signed overlay URLs (see necrosis.overlays);
+# results list fresh ones on every request. Preview URLs do not expire.
+NECROSIS_IMAGE_URL_MAX_AGE = int(os.environ.get('NECROSIS_IMAGE_URL_MAX_AGE', 24 * 60 * 60))
+
+# Gallery previews (see necrosis.previews): widths in pixels, 'webp' or 'jpeg'
+# with its quality, and whether they are all made in the background right
+# after analysis (on NECROSIS_PREVIEW_THREADS threads) instead of on request
+NECROSIS_PREVIEW_WIDTHS = [int(w) for w in os.environ.get('NECROSIS_PREVIEW_WIDTHS', '160,480,1024').split(',')]
+NECROSIS_PREVIEW_FORMAT = os.environ.get('NECROSIS_PREVIEW_FORMAT', 'webp')
+NECROSIS_PREVIEW_QUALITY = int(os.environ.get('NECROSIS_PREVIEW_QUALITY', 80))
+NECROSIS_PREVIEWS_IN_BACKGROUND = os.environ.get('NECROSIS_PREVIEWS_IN_BACKGROUND', '').lower() in ('1', 'true', 'yes')
+NECROSIS_PREVIEW_THREADS = int(os.environ.get('NECROSIS_PREVIEW_THREADS', 2))
+
+# In-process cache of token -> user lookups (see necrosis.authentication):
+# seconds an entry is trusted (0 disables the cache) and entries kept
+NECROSIS_TOKEN_CACHE_TTL = int(os.environ.get('NECROSIS_TOKEN_CACHE_TTL', 60))
+NECROSIS_TOKEN_CACHE_SIZE = int(os.environ.get('NECROSIS_TOKEN_CACHE_SIZE', 10000))
+
+# Audit trail (see necrosis.activity): events are queued and written in
+# batches of NECROSIS_ACTIVITY_BATCH_SIZE or every NECROSIS_ACTIVITY_FLUSH_SECONDS;
+# at most NECROSIS_ACTIVITY_MAX_QUEUE are held, dropping the 'oldest' or 'newest'
+NECROSIS_ACTIVITY_LOG_ENABLED = os.environ.get('NECROSIS_ACTIVITY_LOG_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+NECROSIS_ACTIVITY_BATCH_SIZE = int(os.environ.get('NECROSIS_ACTIVITY_BATCH_SIZE', 100))
+NECROSIS_ACTIVITY_FLUSH_SECONDS = float(os.environ.get('NECROSIS_ACTIVITY_FLUSH_SECONDS', 2.0))
+NECROSIS_ACTIVITY_MAX_QUEUE = int(os.environ.get('NECROSIS_ACTIVITY_MAX_QUEUE', 10000))
+NECROSIS_ACTIVITY_DROP_POLICY = os.environ.get('NECROSIS_ACTIVITY_DROP_POLICY', 'oldest')
+# Reverse proxies in front of the app that append to X-Forwarded-For; the
+# header is ignored (the client address is REMOTE_ADDR) while this is 0
+NECROSIS_TRUSTED_PROXY_COUNT = int(os.environ.get('NECROSIS_TRUSTED_PROXY_COUNT', 0))
+
+# Per-stage and per-route latency histograms served at /metrics/
+NECROSIS_METRICS_ENABLED = os.environ.get('NECROSIS_METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+# Cursor pagination of session and result lists (opt-in with ?page_size= or ?cursor=)
+NECROSIS_PAGE_SIZE = int(os.environ.get('NECROSIS_PAGE_SIZE', 50))
+NECROSIS_MAX_PAGE_SIZE = int(os.environ.get('NECROSIS_MAX_PAGE_SIZE', 500))
+
+# Session cleanup: threads deleting files in parallel, and whether file
+# deletion runs in the background by default (requests can pass ?background=)
+NECROSIS_CLEANUP_THREADS = int(os.environ.get('NECROSIS_CLEANUP_THREADS', 8))
+NECROSIS_CLEANUP_BACKGROUND = os.environ.get('NECROSIS_CLEANUP_BACKGROUND', '').lower() in ('1', 'true', 'yes')
+# A background cleanup not finished this many seconds after it started (its
+# process died or restarted) is run again when its status is polled
+NECROSIS_CLEANUP_LEASE_SECONDS = float(os.environ.get('NECROSIS_CLEANUP_LEASE_SECONDS', 600))
+
+# Background analysis workers (see `manage.py run_analysis_workers`)
+NECROSIS_JOB_WORKERS = int(os.environ.get('NECROSIS_JOB_WORKERS', 2))
+NECROSIS_JOB_POLL_INTERVAL = float(os.environ.get('NECROSIS_JOB_POLL_INTERVAL', 1.0))
+# A claimed task is a lease: when its worker has not finished it within
+# NECROSIS_JOB_LEASE_SECONDS (it crashed or was killed), the task is queued
+# again, or failed once it has been claimed NECROSIS_JOB_MAX_ATTEMPTS times
+NECROSIS_JOB_LEASE_SECONDS = float(os.environ.get('NECROSIS_JOB_LEASE_SECONDS', 600))
+NECROSIS_JOB_MAX_ATTEMPTS = int(os.environ.get('NECROSIS_JOB_MAX_ATTEMPTS', 3))
+
+# Dedicated inference server (see `manage.py run_inference_server`). When an
+# address ('host:port' or a unix socket path) is set, views send images to the
+# server instead of loading the model in-process. The authkey is required
+# unless the address is loopback or a unix socket, which fall back to SECRET_KEY.
+NECROSIS_INFERENCE_SERVER = os.environ.get('NECROSIS_INFERENCE_SERVER', '')
+NECROSIS_INFERENCE_AUTHKEY = os.environ.get('NECROSIS_INFERENCE_AUTHKEY', '').encode() or None
+NECROSIS_INFERENCE_REPLICAS = int(os.environ.get('NECROSIS_INFERENCE_REPLICAS', 2))
+# Seconds a request to the server may wait for its results before failing
+NECROSIS_INFERENCE_TIMEOUT = float(os.environ.get('NECROSIS_INFERENCE_TIMEOUT', 120))
+
+# Load the model and run one dummy inference in the background at startup
+# instead of on the first request
+NECROSIS_WARMUP_MODEL = os.environ.get('NECROSIS_WARMUP_MODEL', '').lower() in ('1', 'true', 'yes')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'necrosis': {
+            'handlers': ['console'],
+            'level': os.environ.get('NECROSIS_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
@@ -0,0 +1,255 @@
+"""
+Buffered writes of the UserActivityLog audit trail.
+
+log_activity queues an event in memory and returns right away, so a request
+never waits on an audit INSERT. A background flusher thread writes the queued
+events with one bulk_create in two cases: NECROSIS_ACTIVITY_BATCH_SIZE events
+are waiting, or NECROSIS_ACTIVITY_FLUSH_SECONDS have passed since the last
+flush.
+
+Memory is bounded: at most NECROSIS_ACTIVITY_MAX_QUEUE events are held.
+When the queue is full, NECROSIS_ACTIVITY_DROP_POLICY decides which event is
+dropped: the 'oldest' queued one, or the 'newest', incoming one. Dropped
+events are counted and reported at /metrics/. Events still queued at
+interpreter exit are flushed by an atexit hook.
+
+Stale or broken connections are closed before each write, as Django does
+around requests. A batch that still fails is retried once, then written row
+by row, so one bad event cannot hold back the others. Rows refused for their
+content (IntegrityError, DataError, e.g. the user was deleted meanwhile) are
+logged and dropped, and counted as rejected. Any other error is taken as
+transient: the rows not written yet are put back at the head of the queue
+for the next flush, the drop policy deciding what no longer fits.
+"""
+import atexit
+import ipaddress
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DataError, DatabaseError, IntegrityError, close_old_connections, connections, transaction
+from django.utils import timezone
+
+from .models import UserActivityLog
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+# Errors caused by the rows themselves, which no retry will fix
+REJECTED_ERRORS = (IntegrityError, DataError)
+
+
+class ActivityLogWriter:
+    def __init__(self, batch_size=100, flush_interval=2.0, max_queue=10000, drop_policy=DROP_OLDEST):
+        if drop_policy not in DROP_POLICIES:
+            raise ImproperlyConfigured(f"Unknown activity drop policy {drop_policy!r}, use one of "
+                                       f"{', '.join(DROP_POLICIES)}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._failing = False
+
+    def record(self, entry):
+        """
+        Queues an unsaved UserActivityLog. Returns False when it was dropped.
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    return False
+                self._queue.popleft()
+            self._queue.append(entry)
+            if self._thread is None or not self._thread.is_alive():
+                # Started on first use, so forked worker processes get their own
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='necrosis-activity', daemon=True)
+                self._thread.start()
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    # After a failed write, wait the whole interval before the next attempt
+                    self._cond.wait_for(
+                        lambda: self._stopping or (not self._failing and len(self._queue) >= self.batch_size),
+                        timeout=self.flush_interval)
+                    stopping = self._stopping
+                self.flush()
+                if stopping:
+                    return
+        finally:
+            connections.close_all()
+
+    def flush(self):
+        """
+        Writes every queued event now. Returns the number written.
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._queue)
+                self._queue.clear()
+            if not batch:
+                return 0
+            for attempt in range(2):
+                _close_old_connections()
+                try:
+                    UserActivityLog.objects.bulk_create(batch, batch_size=self.batch_size)
+                    written, requeued = len(batch), False
+                    break
+                except DatabaseError:
+                    logger.exception('Could not write %d activity log entries (attempt %d)', len(batch), attempt + 1)
+            else:
+                written, requeued = self._write_rows(batch)
+            with self._cond:
+                self.written += written
+                if not requeued:
+                    self._failing = False
+            return written
+
+    def _write_rows(self, batch):
+        """
+        Writes a batch that failed as a whole one row at a time. Rejected rows
+        are dropped; at the first other error the rest is requeued. Returns
+        the number written and whether anything was requeued.
+        """
+        written = 0
+        for position, entry in enumerate(batch):
+            try:
+                with transaction.atomic():
+                    UserActivityLog.objects.bulk_create([entry])
+            except REJECTED_ERRORS:
+                logger.exception('Dropping activity log entry %r of user %s, the database refused it',
+                                 entry.activity_type, entry.user_id)
+                with self._cond:
+                    self.rejected += 1
+                continue
+            except DatabaseError:
+                logger.exception('Could not write activity log entries, requeueing %d', len(batch) - position)
+                self._requeue(batch[position:])
+                return written, True
+            written += 1
+        return written, False
+
+    def _requeue(self, batch):
+        """
+        Puts a batch that could not be written back ahead of the newer events.
+        """
+        with self._cond:
+            self._failing = True
+            self._queue.extendleft(reversed(batch))
+            overflow = max(0, len(self._queue) - self.max_queue)
+            self.dropped += overflow
+            for _ in range(overflow):
+                if self.drop_policy == DROP_NEWEST:
+                    self._queue.pop()
+                else:
+                    self._queue.popleft()
+
+    def discard(self):
+        """
+        Drops every queued event without writing it. Returns the number
+        dropped.
+        """
+        with self._flush_lock, self._cond:
+            count = len(self._queue)
+            self._queue.clear()
+            self._failing = False
+            return count
+
+    def shutdown(self, timeout=5.0):
+        """
+        Stops the flusher after a last flush, and flushes here what it left.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return {'queued': len(self._queue), 'written': self.written, 'dropped': self.dropped,
+                    'rejected': self.rejected}
+
+
+def _close_old_connections():
+    """
+    close_old_connections, unless a flush from a request or test runs inside
+    a transaction, whose connection must stay open.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        close_old_connections()
+
+
+activity_writer = ActivityLogWriter(
+    batch_size=settings.NECROSIS_ACTIVITY_BATCH_SIZE,
+    flush_interval=settings.NECROSIS_ACTIVITY_FLUSH_SECONDS,
+    max_queue=settings.NECROSIS_ACTIVITY_MAX_QUEUE,
+    drop_policy=settings.NECROSIS_ACTIVITY_DROP_POLICY,
+)
+atexit.register(activity_writer.shutdown)
+
+
+def client_ip(request):
+    """
+    The client address of a request. X-Forwarded-For is only read behind
+    NECROSIS_TRUSTED_PROXY_COUNT proxies, each appending the address it got
+    the request from: the entry added by the outermost one is the client,
+    anything left of it was sent by the client and is not trusted. Without
+    trusted proxies, or when the header has fewer hops, REMOTE_ADDR. None
+    when it is not a valid address, which would fail the whole batch on
+    PostgreSQL's inet column.
+    """
+    address = request.META.get('REMOTE_ADDR')
+    proxies = settings.NECROSIS_TRUSTED_PROXY_COUNT
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR') if proxies > 0 else None
+    if forwarded:
+        hops = [hop.strip() for hop in forwarded.split(',')]
+        if len(hops) >= proxies:
+            address = hops[-proxies]
+    try:
+        return str(ipaddress.ip_address(address))
+    except ValueError:
+        return None
+
+
+def log_activity(request, activity_type, user=None, **context):
+    """
+    Queues an audit event for ``user`` (the request's user by default) with
+    the client's address and user agent; ``context`` becomes its
+    context_data. Anonymous requests have no user to log against and are
+    skipped.
+    """
+    if not settings.NECROSIS_ACTIVITY_LOG_ENABLED:
+        return
+    user = user or request.user
+    if not user.is_authenticated:
+        return
+    activity_writer.record(UserActivityLog(
+        user_id=user.pk,
+        activity_type=activity_type,
+        # Set here: the row is only written at the next flush
+        timestamp=timezone.now(),
+        ip_address=client_ip(request),
+        device_info=request.META.get('HTTP_USER_AGENT', '')[:255] or None,
+        context_data=context or None,
+    ))
@@ -0,0 +1,119 @@
+"""
+Per-session summary statistics stored on AnalysisSession.
+
+Instead of aggregating a session's CassavaImage rows on every read, each
+session carries num_images, the sum and sum of squares of the necrosis
+percentages, their min and max, and the total lesion count. add_images
+folds new results in with a single UPDATE built from F() expressions, so
+concurrent writers to the same session don't lose updates. Deleted images
+(through the API, the admin or a cascade) are taken out by a post_delete
+receiver, which subtracts them the same way and recomputes min/max from the
+remaining rows, the only values that can't be maintained by subtraction.
+recompute rebuilds the columns from the image rows, for sessions whose
+images were changed around the ORM, e.g. with raw SQL or QuerySet.update()
+(see `manage.py recompute_session_aggregates`). Mean and standard
+deviation are derived on read by session_summary.
+"""
+import math
+
+from django.db.models import Count, F, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import AnalysisSession, CassavaImage
+
+# AnalysisSession columns session_summary reads
+SUMMARY_COLUMNS = ('num_images', 'necrosis_sum', 'necrosis_sum_sq', 'necrosis_min', 'necrosis_max',
+                   'total_lesions')
+
+
+def add_images(session_id, results):
+    """
+    Adds analysed images to a session's aggregates. ``results`` is an
+    iterable of (necrosis_percentage, lesion_count) pairs.
+    """
+    results = [(float(p), int(n)) for p, n in results]
+    if not results:
+        return
+    percentages = [p for p, _ in results]
+    low, high = Value(min(percentages)), Value(max(percentages))
+    AnalysisSession.objects.filter(id=session_id).update(
+        num_images=F('num_images') + len(results),
+        necrosis_sum=F('necrosis_sum') + sum(percentages),
+        necrosis_sum_sq=F('necrosis_sum_sq') + sum(p * p for p in percentages),
+        necrosis_min=Least(Coalesce(F('necrosis_min'), low), low),
+        necrosis_max=Greatest(Coalesce(F('necrosis_max'), high), high),
+        total_lesions=F('total_lesions') + sum(n for _, n in results),
+    )
+
+
+def _remaining(aggregate):
+    return Subquery(
+        CassavaImage.objects.filter(session=OuterRef('pk')).values('session')
+        .annotate(value=aggregate('necrosis_percentage')).values('value')
+    )
+
+
+@receiver(post_delete, sender=CassavaImage)
+def _image_deleted(sender, instance, origin=None, **kwargs):
+    """
+    Takes a deleted image out of its session's aggregates, unless the
+    delete started from the session, whose row goes with it.
+    """
+    if isinstance(origin, AnalysisSession) or getattr(origin, 'model', None) is AnalysisSession:
+        return
+    percentage = instance.necrosis_percentage
+    AnalysisSession.objects.filter(id=instance.session_id).update(
+        num_images=Greatest(F('num_images') - 1, Value(0)),
+        necrosis_sum=F('necrosis_sum') - percentage,
+        necrosis_sum_sq=F('necrosis_sum_sq') - percentage * percentage,
+        necrosis_min=_remaining(Min),
+        necrosis_max=_remaining(Max),
+        total_lesions=Greatest(F('total_lesions') - instance.total_lesions, Value(0)),
+    )
+
+
+def recompute(sessions=None):
+    """
+    Rebuilds the aggregates of ``sessions`` (all sessions by default) from
+    their CassavaImage rows.
+    """
+    sessions = AnalysisSession.objects.all() if sessions is None else sessions
+    images = CassavaImage.objects.filter(session=OuterRef('pk')).values('session')
+
+    def column(aggregate, default=None):
+        value = Subquery(images.annotate(value=aggregate).values('value'))
+        return value if default is None else Coalesce(value, default)
+
+    return sessions.update(
+        num_images=column(Count('id'), 0),
+        necrosis_sum=column(Sum('necrosis_percentage'), 0.0),
+        necrosis_sum_sq=column(Sum(F('necrosis_percentage') * F('necrosis_percentage')), 0.0),
+        necrosis_min=column(Min('necrosis_percentage')),
+        necrosis_max=column(Max('necrosis_percentage')),
+        total_lesions=column(Sum('total_lesions'), 0),
+    )
+
+
+def session_summary(session):
+    """
+    Summary statistics of a session, from an AnalysisSession or a dict of
+    SUMMARY_COLUMNS (as returned by .values()).
+    """
+    if not isinstance(session, dict):
+        session = {column: getattr(session, column) for column in SUMMARY_COLUMNS}
+    count = session['num_images']
+    mean = std = None
+    if count:
+        mean = session['necrosis_sum'] / count
+        # Population standard deviation; clamped against float rounding
+        std = math.sqrt(max(session['necrosis_sum_sq'] / count - mean * mean, 0.0))
+    return {
+        'num_images': count,
+        'mean_necrosis': mean,
+        'std_necrosis': std,
+        'min_necrosis': session['necrosis_min'],
+        'max_necrosis': session['necrosis_max'],
+        'total_lesions': session['total_lesions'],
+    }
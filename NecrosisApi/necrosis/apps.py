@@ -1,6 +1,73 @@
+import logging
+import os
+import sys
+import time
+
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
+_IMPORTED_AT = time.perf_counter()
+
+
+def _process_age():
+    """
+    Seconds since this process started, read from /proc on Linux. Elsewhere,
+    seconds since this module was imported, which misses interpreter start-up
+    and the settings import.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, which may hold spaces; the start
+            # time, in clock ticks after boot, is the 22nd field of the line
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return time.perf_counter() - _IMPORTED_AT
+
+
+def _serving_requests():
+    # Management commands other than runserver never need the model, and the
+    # runserver autoreloader parent process does not serve requests.
+    if os.path.basename(sys.argv[0]) != 'manage.py':
+        return True
+    return 'runserver' in sys.argv and os.environ.get('RUN_MAIN') == 'true'
+
 
 class NecrosisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'necrosis'
+
+    def ready(self):
+        from django.conf import settings
+        from django.core.signals import request_finished, request_started
+
+        from . import aggregates  # noqa: F401, connects the image deletion receiver
+        from . import authentication  # noqa: F401, connects the token cache invalidation receivers
+        from .inference import stats, warm_up
+
+        serving = _serving_requests()
+        stats['startup_seconds'] = _process_age()
+        logger.log(logging.INFO if serving else logging.DEBUG,
+                   'necrosis app ready %.2fs after process start', stats['startup_seconds'])
+
+        first_request = {}
+
+        def on_request_started(**kwargs):
+            first_request.setdefault('start', time.perf_counter())
+            request_started.disconnect(on_request_started)
+
+        def on_request_finished(**kwargs):
+            if 'start' not in first_request:
+                return
+            request_finished.disconnect(on_request_finished)
+            stats['first_request_seconds'] = time.perf_counter() - first_request['start']
+            logger.info('First request served in %.2fs', stats['first_request_seconds'])
+
+        request_started.connect(on_request_started, weak=False)
+        request_finished.connect(on_request_finished, weak=False)
+
+        if settings.NECROSIS_WARMUP_MODEL and serving:
+            warm_up()
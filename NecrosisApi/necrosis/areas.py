@@ -0,0 +1,112 @@
+"""
+Root and necrosis area computation from mask polygons.
+
+process_results used to rasterize every polygon into two full-resolution
+masks. Here areas come straight from the polygons:
+
+- 'raster': each polygon (or group of overlapping lesions) is filled into a
+  mask only as large as its bounding box, so lesions spread over the image
+  never need a mask much larger than their biggest cluster. Pixel counts are
+  identical to filling full-size masks with cv2.fillPoly.
+- 'shoelace': polygon areas from the shoelace formula, with no mask at all.
+  Lesions whose bounding boxes overlap are still unioned on a bounding-box
+  raster so overlaps are not counted twice. Results differ slightly from
+  pixel counts, which include the polygon outline.
+"""
+import cv2
+import numpy as np
+
+AREA_METHODS = ('raster', 'shoelace')
+
+
+def polygon_area(points):
+    """
+    Area enclosed by a polygon given as an (N, 2) array of x, y points.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        return 0.0
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def raster_area(polygons, shape):
+    """
+    Number of pixels covered by the union of ``polygons`` on an image of
+    ``shape`` (height, width). Each group of overlapping polygons is filled
+    into its own mask, limited to the group's bounding box.
+    """
+    # Grouped on the pixel coordinates: separate groups never share a pixel
+    polygons = [np.asarray(p).astype('int') for p in polygons if len(p)]
+    return sum(_box_raster_area(group, shape) for group in _overlap_groups(polygons))
+
+
+def _box_raster_area(polygons, shape):
+    """
+    raster_area of integer polygons, on one mask covering all of them.
+    """
+    height, width = shape[:2]
+    stacked = np.concatenate(polygons)
+    x0, y0 = np.maximum(stacked.min(axis=0), 0)
+    x1, y1 = np.minimum(stacked.max(axis=0), [width - 1, height - 1])
+    if x1 < x0 or y1 < y0:
+        return 0
+    mask = np.zeros((y1 - y0 + 1, x1 - x0 + 1), np.uint8)
+    for polygon in polygons:
+        # One call per polygon: a single fillPoly call with several polygons
+        # leaves their overlaps unfilled
+        cv2.fillPoly(mask, [polygon - [x0, y0]], color=[255])
+    return cv2.countNonZero(mask)
+
+
+def _overlap_groups(polygons):
+    """
+    Groups polygons whose bounding boxes overlap, directly or through other
+    polygons in the group.
+    """
+    boxes = [(p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()) for p in polygons]
+    parent = list(range(len(polygons)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    order = sorted(range(len(boxes)), key=lambda i: boxes[i][0])
+    for pos, i in enumerate(order):
+        for j in order[pos + 1:]:
+            if boxes[j][0] > boxes[i][2]:
+                break
+            if boxes[j][1] <= boxes[i][3] and boxes[i][1] <= boxes[j][3]:
+                parent[find(j)] = find(i)
+    groups = {}
+    for i in range(len(polygons)):
+        groups.setdefault(find(i), []).append(polygons[i])
+    return list(groups.values())
+
+
+def union_area(polygons, shape, method='raster'):
+    """
+    Area of the union of ``polygons`` (lesions may overlap each other).
+    """
+    polygons = [np.asarray(p) for p in polygons if len(p)]
+    if method == 'raster':
+        return raster_area(polygons, shape)
+    area = 0.0
+    for group in _overlap_groups(polygons):
+        area += polygon_area(group[0]) if len(group) == 1 else raster_area(group, shape)
+    return area
+
+
+def necrosis_areas(root_polygon, lesion_polygons, shape, method='raster'):
+    """
+    Returns (root_area, necrosis_area) for an image of ``shape``.
+    """
+    if method not in AREA_METHODS:
+        raise ValueError(f'Unknown area method {method!r}, expected one of {AREA_METHODS}')
+    if method == 'raster':
+        root_area = raster_area([root_polygon], shape)
+    else:
+        root_area = polygon_area(root_polygon)
+    return root_area, union_area(lesion_polygons, shape, method=method)
@@ -0,0 +1,203 @@
+"""
+Async versions of the analyze, results and download endpoints.
+
+Served over ASGI (uvicorn, see the Dockerfile), a request only holds an
+event loop slot while it waits: Django's ASGI handler buffers the upload
+body before the view runs, so slow mobile uploads no longer tie up a thread
+each. Inside the views nothing blocks the loop either:
+
+- token and session lookups use the async ORM;
+- decoding and inference run on a dedicated thread pool
+  (NECROSIS_ASYNC_INFERENCE_THREADS), and the original uploads are stored on
+  the ingest pool and awaited;
+- the transactional result write and the paginated results query run
+  through sync_to_async;
+- the session ZIP is streamed from an async iterator whose steps run on the
+  request's sync thread: the image rows are read there in chunks, the files
+  read and missing overlays rendered, without holding every row in memory.
+
+They share their logic with the DRF views in necrosis.views and return the
+same payloads. DRF views are sync only, so these are plain Django views
+with the token check done here.
+"""
+import asyncio
+import copy
+import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.authentication import get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import views
+from .activity import log_activity
+from .authentication import token_cache
+from .ingest import IngestedImage, ingest_uploads
+from .models import AnalysisSession
+from .overlays import OVERLAY_COLUMNS, zip_entries
+from .result_cache import cached_process_images
+from .zipstream import stream_zip
+
+_inference_pool = ThreadPoolExecutor(max_workers=settings.NECROSIS_ASYNC_INFERENCE_THREADS,
+                                     thread_name_prefix='necrosis-async-inference')
+
+_EXHAUSTED = object()
+# Image rows fetched per query while streaming a session ZIP
+ZIP_CHUNK_SIZE = 200
+
+
+def _json(data, status=200):
+    # DRF's encoder, so dates and decimals render as in the sync views
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+async def authenticate(request):
+    """
+    The user of the request's 'Authorization: Token <key>' header, looked up
+    through the token cache of necrosis.authentication. Raises the same
+    errors as DRF's TokenAuthentication.
+    """
+    auth = get_authorization_header(request).split()
+    if not auth or auth[0].lower() != b'token':
+        raise NotAuthenticated()
+    if len(auth) != 2:
+        raise AuthenticationFailed('Invalid token header.')
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise AuthenticationFailed('Invalid token.')
+    cached = token_cache.get(key)
+    if cached is None:
+        try:
+            token = await Token.objects.select_related('user').aget(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        cached = (token.user, token)
+        token_cache.set(key, *cached)
+    return copy.copy(cached[0])
+
+
+def token_required(view):
+    """
+    Authenticates the request and turns API errors into JSON responses, as
+    APIView does for the DRF views.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            request.user = await authenticate(request)
+            return await view(request, *args, **kwargs)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (dict, list)) else {'detail': exc.detail}
+            response = _json(detail, status=exc.status_code)
+            if exc.status_code == 401:
+                response['WWW-Authenticate'] = 'Token'
+            return response
+        except Http404 as exc:
+            return _json({'detail': str(exc)}, status=404)
+    return wrapper
+
+
+def _analyze(files):
+    """
+    Decodes and analyses the uploads; runs on the inference pool.
+    """
+    images = ingest_uploads(files)
+    processed = cached_process_images(
+        images, views.model,
+        batch_size=settings.NECROSIS_INFERENCE_BATCH_SIZE,
+        names=[img.stored_name for img in images],
+        digests=[img.digest for img in images],
+        render=settings.NECROSIS_EAGER_OVERLAYS,
+        load=IngestedImage.decode,
+    )
+    return images, processed
+
+
+@csrf_exempt
+@require_POST
+@token_required
+async def analyze_images(request):
+    files = await sync_to_async(request.FILES.getlist)('images')
+    session_id = request.POST.get('session_id')
+    session = None
+    if session_id:
+        session = await AnalysisSession.objects.filter(session_id=session_id, user=request.user).afirst()
+    if session is None:
+        session = await AnalysisSession.objects.acreate(user=request.user, session_id=str(uuid.uuid4()),
+                                                        num_images=0)
+    loop = asyncio.get_running_loop()
+    images, processed = await loop.run_in_executor(_inference_pool, _analyze, files)
+    upload_paths = await asyncio.gather(*(img.aupload_path() for img in images))
+    names = [file.name for file in files]
+    rows, db_seconds = await sync_to_async(views.store_analysis)(session, names, upload_paths, processed)
+    log_activity(request, 'analyze', session_id=session.session_id, images=len(files))
+    return _json({
+        "results": views.analysis_results(request, rows, processed),
+        "session_id": session.session_id,
+        "created_at": session.created_at,
+        "timing": {
+            "db_seconds": db_seconds,
+            "db_ms_per_image": db_seconds * 1000 / len(files) if files else 0.0,
+        },
+    })
+
+
+@require_GET
+@token_required
+async def session_results(request, session_id):
+    session = await AnalysisSession.objects.filter(session_id=session_id, user=request.user).afirst()
+    if session is None:
+        raise Http404('Session not found.')
+    data = await sync_to_async(views.session_results_data)(Request(request), None, session,
+                                                           created_at=session.created_at)
+    return _json(data)
+
+
+@require_GET
+@token_required
+async def latest_session_results(request):
+    session = await AnalysisSession.objects.filter(user=request.user).order_by('-created_at').afirst()
+    if session is None:
+        return _json({'results': []})
+    return _json(await sync_to_async(views.session_results_data)(Request(request), None, session))
+
+
+async def _aiter_in_thread(iterator):
+    """
+    Async iterator over a blocking iterator, each step run on a worker thread.
+    Steps are thread sensitive: under ASGI that is a thread of the request's
+    own, and the iterator may keep a database cursor open on it.
+    """
+    step = sync_to_async(lambda: next(iterator, _EXHAUSTED))
+    while (item := await step()) is not _EXHAUSTED:
+        yield item
+
+
+@require_GET
+@token_required
+async def download_session_images(request, session_id):
+    session = await AnalysisSession.objects.filter(session_id=session_id, user=request.user).afirst()
+    if session is None:
+        raise Http404('Session not found.')
+    if not await session.cassava_images.aexists():
+        raise Http404('No images found for this session.')
+    images = session.cassava_images.exclude(Q(processed_image='') | Q(processed_image=None), original_image='')
+    images = images.only(*OVERLAY_COLUMNS).order_by('id').iterator(chunk_size=ZIP_CHUNK_SIZE)
+    # Rows are read and missing overlays rendered by zip_entries, on the worker thread
+    response = StreamingHttpResponse(_aiter_in_thread(stream_zip(zip_entries(images))),
+                                     content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="session_{session_id}_images.zip"'
+    log_activity(request, 'download', session_id=session_id)
+    return response
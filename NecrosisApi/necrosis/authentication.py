@@ -0,0 +1,107 @@
+"""
+Token authentication with an in-process cache of token lookups.
+
+DRF's TokenAuthentication joins authtoken_token with the user table on every
+request, which for polling clients is more database work than the request
+itself. CachedTokenAuthentication keeps token -> (user, token) lookups in a
+bounded LRU cache whose entries expire after NECROSIS_TOKEN_CACHE_TTL
+seconds. Entries are dropped when a token is deleted or its user is saved
+or deleted (see the signal receivers below). The cache is per process, so
+in other workers such changes take effect once the entry expires; the TTL
+bounds how long a revoked token keeps working there.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+class TokenCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        The cached (user, token) pair of ``key``, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, user, token):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, (user, token))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_user(self, user_pk):
+        with self._lock:
+            for key in [k for k, (_, (user, _)) in self._entries.items() if user.pk == user_pk]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+token_cache = TokenCache(settings.NECROSIS_TOKEN_CACHE_SIZE, settings.NECROSIS_TOKEN_CACHE_TTL)
+
+
+def cached_credentials(key, lookup):
+    """
+    (user, token) for ``key`` from the cache, else from ``lookup(key)``,
+    which raises on invalid tokens. Each request gets its own copy of the
+    user, so changes made while handling one never leak into another.
+    """
+    cached = token_cache.get(key)
+    if cached is None:
+        cached = lookup(key)
+        token_cache.set(key, *cached)
+    user, token = cached
+    return copy.copy(user), token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        return cached_credentials(key, super().authenticate_credentials)
+
+
+@receiver(post_delete, sender=Token)
+def _token_deleted(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def _user_changed(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
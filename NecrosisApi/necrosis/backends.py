@@ -0,0 +1,164 @@
+"""
+CPU inference backends for the segmentation model.
+
+'torch' runs the PyTorch weights (NECROSIS_MODEL_PATH) as before. 'onnx' and
+'openvino' run an export of the same weights with ONNX Runtime or OpenVINO;
+`manage.py export_model` writes the export next to the .pt file. Exports are
+loaded through ultralytics' YOLO class too, so letterboxing, NMS and mask
+decoding are shared with the torch backend and the results carry the same
+boxes.cls and masks.xy that process_results reads.
+
+INT8: the ONNX export is quantized with onnxruntime's dynamic quantization
+(weights stored as 8 bit, activations quantized on the fly, no calibration
+data needed). OpenVINO INT8 goes through ultralytics' own post-training
+quantization, which calibrates on a dataset.
+
+Image paths are decoded with ingest.load_image before they reach the model
+(see DecodingModel): ultralytics would read them with the EXIF orientation
+applied, and the polygons would not match the overlays drawn later.
+
+compare_backends measures how far the necrosis percentages of a backend
+drift from the torch reference on a set of fixture images.
+"""
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .areas import necrosis_areas
+from .ingest import load_image, read_image
+
+TORCH = 'torch'
+ONNX = 'onnx'
+OPENVINO = 'openvino'
+BACKENDS = (TORCH, ONNX, OPENVINO)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def weights_path(backend=None, int8=None, model_path=None):
+    """
+    Path of the weights a backend loads: the .pt file for torch, the export
+    derived from it otherwise (named as ultralytics names its exports).
+    """
+    backend = backend or settings.NECROSIS_INFERENCE_BACKEND
+    int8 = settings.NECROSIS_INFERENCE_INT8 if int8 is None else int8
+    model_path = str(model_path or settings.NECROSIS_MODEL_PATH)
+    if backend not in BACKENDS:
+        raise ImproperlyConfigured(f"Unknown inference backend {backend!r}, use one of {', '.join(BACKENDS)}")
+    stem = os.path.splitext(model_path)[0]
+    if backend == TORCH:
+        return model_path
+    if backend == ONNX:
+        return f'{stem}-int8.onnx' if int8 else f'{stem}.onnx'
+    return f'{stem}_int8_openvino_model' if int8 else f'{stem}_openvino_model'
+
+
+def backend_label(backend=None, int8=None):
+    backend = backend or settings.NECROSIS_INFERENCE_BACKEND
+    int8 = settings.NECROSIS_INFERENCE_INT8 if int8 is None else int8
+    return f'{backend}-int8' if int8 and backend != TORCH else backend
+
+
+def export_model(backend, int8=False, imgsz=640, data=None, model_path=None):
+    """
+    Exports the .pt weights for ``backend`` and returns the export's path.
+    ``data`` is the calibration dataset for OpenVINO INT8.
+    """
+    from ultralytics import YOLO
+
+    if backend == TORCH:
+        raise ValueError('The torch backend runs the .pt weights directly, there is nothing to export')
+    target = weights_path(backend, int8, model_path)
+    model = YOLO(str(model_path or settings.NECROSIS_MODEL_PATH))
+    if backend == OPENVINO:
+        return model.export(format='openvino', imgsz=imgsz, dynamic=True, int8=int8, data=data)
+    exported = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    if not int8:
+        return exported
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    # Unsigned weights: the CPU provider has no ConvInteger kernel for signed ones
+    quantize_dynamic(exported, target, weight_type=QuantType.QUInt8)
+    return target
+
+
+class DecodingModel:
+    """
+    Model wrapper decoding path sources with ingest.load_image; arrays are
+    passed through.
+    """
+
+    def __init__(self, mdl):
+        self.mdl = mdl
+
+    def __call__(self, sources, **kwargs):
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        return self.mdl([load_image(source) for source in sources], **kwargs)
+
+
+def load_backend(backend=None, int8=None):
+    """
+    Loads the model for ``backend`` (NECROSIS_INFERENCE_BACKEND by default),
+    wrapped in a DecodingModel.
+    """
+    from ultralytics import YOLO
+
+    backend = backend or settings.NECROSIS_INFERENCE_BACKEND
+    int8 = settings.NECROSIS_INFERENCE_INT8 if int8 is None else int8
+    path = weights_path(backend, int8)
+    if not os.path.exists(path):
+        raise ImproperlyConfigured(f'No {backend_label(backend, int8)} export at {path}; create it with '
+                                   f"`manage.py export_model --backend {backend}{' --int8' if int8 else ''}`")
+    return DecodingModel(YOLO(path, task='segment'))
+
+
+def necrosis_percentage(results):
+    """
+    Necrosis percentage of one model result, computed as process_results
+    does but without drawing or writing the overlay. None without a root.
+    """
+    if results.masks is None:
+        return None
+    classes = [int(c) for c in results.boxes.cls.tolist()]
+    root_idx = [i for i, c in enumerate(classes) if c == 0]
+    if not root_idx:
+        return None
+    root_area, nec_area = necrosis_areas(
+        results.masks.xy[root_idx[0]], [results.masks.xy[i] for i, c in enumerate(classes) if c == 1],
+        results.orig_shape, method=settings.NECROSIS_AREA_METHOD,
+    )
+    return nec_area / root_area * 100
+
+
+def fixture_images(paths):
+    """
+    Image files among ``paths``, directories expanded (not recursively).
+    """
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images += sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            images.append(path)
+    return images
+
+
+def compare_backends(images, reference, candidates):
+    """
+    Runs ``images`` through the ``reference`` model and each of the
+    ``candidates`` ({label: model}) and returns one row per image and
+    candidate with both percentages and their absolute difference in
+    percentage points (None when either found no root).
+    """
+    rows = []
+    for path in images:
+        img = read_image(path)
+        expected = necrosis_percentage(reference([img])[0])
+        for label, mdl in candidates.items():
+            actual = necrosis_percentage(mdl([img])[0])
+            difference = abs(actual - expected) if None not in (actual, expected) else None
+            rows.append({'image': os.path.basename(path), 'backend': label, 'reference': expected,
+                         'percentage_necrosis': actual, 'difference': difference})
+    return rows
@@ -0,0 +1,433 @@
+"""
+Benchmarks for the analysis pipeline, run through management commands.
+
+benchmark_areas compares the area methods (`manage.py benchmark_areas`).
+benchmark_pipeline times every stage of the analysis separately on synthetic
+cassava-like images, plus the full /api/analyze/ endpoint through the Django
+test client (`manage.py benchmark_pipeline`), and compare_to_baseline flags
+stages that got slower than a stored run. benchmark_concurrent_writes
+measures analyze throughput with several clients writing at once
+(`manage.py load_test_writes`), and benchmark_concurrency the inference
+throughput of the model executor under parallel callers
+(`manage.py load_test_inference`). benchmark_authentication shows the
+queries and time the token cache saves per request
+(`manage.py benchmark_auth`).
+"""
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from . import utilities
+from .areas import AREA_METHODS, necrosis_areas
+from .ingest import decode_image, load_image
+from .utilities import Detections
+
+RESOLUTIONS = ((1080, 1920), (3000, 4000), (4000, 6000))
+STAGES = ('decode', 'inference', 'areas', 'overlay', 'png_encode', 'db_write')
+
+
+def parse_resolution(value):
+    """
+    (height, width) of a WIDTHxHEIGHT command line value, as in RESOLUTIONS.
+    """
+    width, _, height = value.partition('x')
+    return int(height), int(width)
+
+
+def ellipse_polygon(center, axes, points=120, jitter=0.0, rng=None):
+    """
+    Polygon approximating an ellipse, optionally with a wobbly outline so it
+    looks more like a segmentation mask than a perfect shape.
+    """
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    radius = np.ones(points)
+    if jitter and rng is not None:
+        radius += rng.uniform(-jitter, jitter, points)
+    x = center[0] + axes[0] * radius * np.cos(angles)
+    y = center[1] + axes[1] * radius * np.sin(angles)
+    return np.stack([x, y], axis=1).astype(np.float32)
+
+
+def synthetic_polygons(shape, lesions=12, seed=0):
+    """
+    Root cross-section polygon plus lesion polygons (some overlapping) for an
+    image of ``shape`` (height, width), in pixel coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    center = (width / 2, height / 2)
+    root = ellipse_polygon(center, (width * 0.4, height * 0.4), points=400, jitter=0.03, rng=rng)
+    lesion_polygons = []
+    for _ in range(lesions):
+        angle = rng.uniform(0, 2 * np.pi)
+        distance = rng.uniform(0, 0.3)
+        lesion_center = (center[0] + distance * width * np.cos(angle), center[1] + distance * height * np.sin(angle))
+        size = rng.uniform(0.02, 0.08)
+        lesion_polygons.append(ellipse_polygon(lesion_center, (width * size, height * size * rng.uniform(0.5, 1.5)),
+                                               points=60, jitter=0.1, rng=rng))
+    return root, lesion_polygons
+
+
+def fillpoly_areas(root_polygon, lesion_polygons, shape):
+    """
+    Reference implementation: full-resolution masks, as process_results
+    originally computed the areas.
+    """
+    root_mask = np.zeros(shape, np.uint8)
+    nec_mask = np.zeros(shape, np.uint8)
+    cv2.fillPoly(root_mask, [root_polygon.astype('int')], color=[255])
+    for polygon in lesion_polygons:
+        cv2.fillPoly(nec_mask, [polygon.astype('int')], color=[255])
+    return cv2.countNonZero(root_mask), cv2.countNonZero(nec_mask)
+
+
+def _time(func, repeat):
+    """
+    Returns (mean seconds, last result) over ``repeat`` calls.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def benchmark_areas(resolutions=RESOLUTIONS, lesions=12, repeat=5):
+    """
+    Times the full-resolution fillPoly reference against each area method.
+    Returns one row per resolution and method with the mean seconds per image
+    and the necrosis percentage it produced.
+    """
+    rows = []
+    for shape in resolutions:
+        root, lesion_polygons = synthetic_polygons(shape, lesions=lesions)
+        methods = [('fillpoly', lambda: fillpoly_areas(root, lesion_polygons, shape))]
+        methods += [(m, lambda m=m: necrosis_areas(root, lesion_polygons, shape, method=m)) for m in AREA_METHODS]
+        for name, func in methods:
+            seconds, (root_area, nec_area) = _time(func, repeat)
+            rows.append({
+                'resolution': f'{shape[1]}x{shape[0]}',
+                'method': name,
+                'seconds': seconds,
+                'percentage_necrosis': nec_area / root_area * 100,
+            })
+    return rows
+
+
+def synthetic_root_image(shape, lesions=12, seed=0):
+    """
+    JPEG bytes of a cassava root cross-section look-alike: a cream disc with
+    a darker cortex ring and brown lesion blobs on a dark background.
+    Returns (jpeg_bytes, root_polygon, lesion_polygons).
+    """
+    rng = np.random.default_rng(seed)
+    root, lesion_polygons = synthetic_polygons(shape, lesions=lesions, seed=seed)
+    img = np.full((*shape, 3), (30, 35, 40), np.uint8)
+    cv2.fillPoly(img, [root.astype('int')], color=(170, 205, 225))
+    cv2.polylines(img, [root.astype('int')], isClosed=True, color=(60, 90, 120), thickness=max(shape) // 100)
+    for polygon in lesion_polygons:
+        cv2.fillPoly(img, [polygon.astype('int')], color=(40, 70, 110))
+    noise = rng.normal(0, 6, img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    return encoded.tobytes(), root, lesion_polygons
+
+
+class SyntheticModel:
+    """
+    Model stand-in returning the synthetic root and lesion polygons scaled to
+    each input, for timing everything around inference without the weights.
+    """
+
+    def __call__(self, sources):
+        detections = []
+        for source in sources:
+            img = load_image(source)
+            root, lesion_polygons = synthetic_polygons(img.shape[:2])
+            detections.append(Detections([0] + [1] * len(lesion_polygons), [root] + lesion_polygons, img))
+        return detections
+
+
+def load_benchmark_model(kind):
+    if kind == 'synthetic':
+        return SyntheticModel()
+    from .inference import get_model
+    return get_model()
+
+
+@contextlib.contextmanager
+def isolated_environment(file_database=False):
+    """
+    Test database and throwaway media directory, so benchmarks never touch
+    real data. Overlays are redirected there too. With ``file_database`` a
+    SQLite test database lives in a file in that directory instead of in
+    memory, so journal mode and locking behave as in production.
+    """
+    from .activity import activity_writer
+
+    media_root = tempfile.mkdtemp(prefix='necrosis-bench-')
+    results_dir = os.path.join(media_root, 'results')
+    os.makedirs(results_dir)
+    old_results_dir = utilities.img_results_dir
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    if file_database and connection.vendor == 'sqlite':
+        test_settings['NAME'] = os.path.join(media_root, 'benchmark.sqlite3')
+    setup_test_environment()
+    old_db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(MEDIA_ROOT=media_root, NECROSIS_RESULT_CACHE_ENABLED=False):
+            utilities.img_results_dir = results_dir
+            yield media_root
+    finally:
+        utilities.img_results_dir = old_results_dir
+        # The benchmark's activity events belong in the test database; any
+        # left unwritten are dropped so no later flush reaches the real one
+        activity_writer.flush()
+        activity_writer.discard()
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+def benchmark_stages(mdl, resolutions=RESOLUTIONS, repeat=3):
+    """
+    Mean seconds per image of each pipeline stage, per resolution.
+    Must run inside isolated_environment (the db_write stage writes rows).
+    """
+    from .models import AnalysisSession, CassavaImage, User
+    from .polygons import encode_polygons
+
+    user = User.objects.create_user(username='benchmark', email='benchmark@example.com', password='benchmark')
+    session = AnalysisSession.objects.create(user=user, session_id='benchmark', num_images=0)
+    rows = []
+    for shape in resolutions:
+        jpeg, _, _ = synthetic_root_image(shape)
+        timings = {}
+        timings['decode'], img = _time(lambda: decode_image(jpeg), repeat)
+        mdl([img])  # Warm-up, keeps model loading out of the timings
+        timings['inference'], results = _time(lambda: mdl([img])[0], repeat)
+        classes = [int(c) for c in results.boxes.cls.tolist()]
+        root_idx = [i for i, c in enumerate(classes) if c == 0]
+        nec_idx = [i for i, c in enumerate(classes) if c == 1]
+        if not root_idx:
+            raise RuntimeError('The model found no root in the synthetic image; use --model synthetic')
+        timings['areas'], _ = _time(lambda: necrosis_areas(
+            results.masks.xy[root_idx[0]], [results.masks.xy[n] for n in nec_idx], results.orig_shape,
+            method=settings.NECROSIS_AREA_METHOD), repeat)
+
+        def draw():
+            overlay = img.copy()
+            for n in nec_idx:
+                cv2.polylines(overlay, [results.masks.xy[n].astype('int')], color=(255, 0, 0), thickness=6,
+                              isClosed=True)
+            cv2.putText(overlay, '12.34%', (shape[1] // 2, 100), color=(255, 0, 0), thickness=5,
+                        fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=5)
+            return overlay
+
+        timings['overlay'], overlay = _time(draw, repeat)
+        timings['png_encode'], _ = _time(lambda: cv2.imencode('.png', overlay), repeat)
+        polygons = {str(n): results.masks.xyn[n].tolist() for n in nec_idx}
+        timings['db_write'], _ = _time(lambda: CassavaImage.objects.create(
+            session=session, original_image='uploads/images/benchmark.jpg', image_name='benchmark.jpg',
+            total_lesions=len(nec_idx), necrosis_percentage=12.34, lesion_polygons=encode_polygons(polygons),
+        ), repeat)
+        for stage in STAGES:
+            rows.append({'resolution': f'{shape[1]}x{shape[0]}', 'stage': stage, 'seconds': timings[stage]})
+    return rows
+
+
+def benchmark_endpoint(mdl, resolution=(3000, 4000), images=8, repeat=2):
+    """
+    Mean seconds per image of a full /api/analyze/ request through the test
+    client. Must run inside isolated_environment.
+    """
+    from rest_framework.authtoken.models import Token
+
+    from . import views
+    from .models import User
+
+    user = User.objects.create_user(username='endpoint', email='endpoint@example.com', password='endpoint')
+    client = Client(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+    payloads = [synthetic_root_image(resolution, seed=i)[0] for i in range(images)]
+    mdl([decode_image(payloads[0])])
+    old_model, views.model = views.model, mdl
+    try:
+        def post():
+            files = [SimpleUploadedFile(f'root{i}.jpg', data, content_type='image/jpeg')
+                     for i, data in enumerate(payloads)]
+            response = client.post('/api/analyze/', {'images': files})
+            if response.status_code != 200:
+                raise RuntimeError(f'/api/analyze/ returned {response.status_code}')
+        seconds, _ = _time(post, repeat)
+    finally:
+        views.model = old_model
+    return {'resolution': f'{resolution[1]}x{resolution[0]}', 'stage': 'endpoint', 'seconds': seconds / images}
+
+
+def journal_mode():
+    if connection.vendor != 'sqlite':
+        return connection.vendor
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+
+def benchmark_concurrent_writes(mdl, workers=(1, 2, 4, 8), requests_per_worker=4, images=4,
+                                resolution=(480, 640)):
+    """
+    Analyze throughput with ``workers`` clients posting at the same time,
+    each sending ``requests_per_worker`` requests of ``images`` images into
+    its own session. Small images by default so the database writes, not
+    inference, dominate. Must run inside isolated_environment. Returns one
+    row per worker count with the images written per second and the
+    requests that failed (e.g. "database is locked").
+    """
+    from rest_framework.authtoken.models import Token
+
+    from . import views
+    from .models import User
+
+    user = User.objects.create_user(username='loadtest', email='loadtest@example.com', password='loadtest')
+    auth = f'Token {Token.objects.create(user=user).key}'
+    payloads = [synthetic_root_image(resolution, seed=i)[0] for i in range(images)]
+    mdl([decode_image(payloads[0])])
+
+    def client_run(_):
+        client = Client(HTTP_AUTHORIZATION=auth)
+        failures = 0
+        try:
+            for _ in range(requests_per_worker):
+                files = [SimpleUploadedFile(f'root{i}.jpg', data, content_type='image/jpeg')
+                         for i, data in enumerate(payloads)]
+                try:
+                    response = client.post('/api/analyze/', {'images': files})
+                    failures += response.status_code != 200
+                except Exception:
+                    failures += 1
+        finally:
+            connections.close_all()
+        return failures
+
+    rows = []
+    old_model, views.model = views.model, mdl
+    try:
+        for count in workers:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=count) as pool:
+                failures = sum(pool.map(client_run, range(count)))
+            seconds = time.perf_counter() - start
+            total = count * requests_per_worker
+            rows.append({
+                'workers': count,
+                'requests': total,
+                'failed': failures,
+                'seconds': seconds,
+                'images_per_second': (total - failures) * images / seconds,
+            })
+    finally:
+        views.model = old_model
+    return rows
+
+
+def benchmark_concurrency(mdl, levels=(1, 2, 4, 8), calls_per_worker=8, resolution=(3000, 4000)):
+    """
+    Calls ``mdl`` (typically an InferenceExecutor) from ``level`` threads at
+    once, each running ``calls_per_worker`` single-image inferences. Returns
+    one row per level with the images per second and the median and 95th
+    percentile latency of a call.
+    """
+    img = decode_image(synthetic_root_image(resolution)[0])
+    mdl([img])  # Warm-up, keeps model loading out of the timings
+
+    def worker(_):
+        latencies = []
+        for _ in range(calls_per_worker):
+            start = time.perf_counter()
+            mdl([img])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    rows = []
+    for level in levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            latencies = [seconds for result in pool.map(worker, range(level)) for seconds in result]
+        seconds = time.perf_counter() - start
+        rows.append({
+            'concurrency': level,
+            'images_per_second': len(latencies) / seconds,
+            'p50_seconds': float(np.percentile(latencies, 50)),
+            'p95_seconds': float(np.percentile(latencies, 95)),
+        })
+    return rows
+
+
+def benchmark_authentication(requests=200, url='/api/user_sessions/?fields=session_id'):
+    """
+    Queries and mean milliseconds per authenticated request to ``url`` with
+    the token cache disabled and enabled. Must run inside
+    isolated_environment.
+    """
+    from rest_framework.authtoken.models import Token
+
+    from .authentication import token_cache
+    from .models import User
+
+    user = User.objects.create_user(username='auth', email='auth@example.com', password='auth')
+    client = Client(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+    old_ttl = token_cache.ttl
+    rows = []
+    try:
+        for label, ttl in (('uncached', 0), ('cached', old_ttl or 60)):
+            token_cache.clear()
+            token_cache.ttl = ttl
+            client.get(url)  # Warm-up, fills the cache when enabled
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                for _ in range(requests):
+                    if client.get(url).status_code != 200:
+                        raise RuntimeError(f'{url} returned an error')
+                seconds = time.perf_counter() - start
+            rows.append({'auth': label, 'queries_per_request': len(queries) / requests,
+                         'ms_per_request': seconds * 1000 / requests})
+    finally:
+        token_cache.ttl = old_ttl
+        token_cache.clear()
+    return rows
+
+
+def compare_to_baseline(rows, baseline_rows, threshold=0.2):
+    """
+    Returns the rows that are more than ``threshold`` (a fraction) slower than
+    the matching baseline row, each with the baseline time and the slowdown.
+    """
+    baseline = {(row['resolution'], row['stage']): row['seconds'] for row in baseline_rows}
+    regressions = []
+    for row in rows:
+        reference = baseline.get((row['resolution'], row['stage']))
+        if reference and row['seconds'] > reference * (1 + threshold):
+            regressions.append({**row, 'baseline_seconds': reference, 'slowdown': row['seconds'] / reference - 1})
+    return regressions
+
+
+def write_results(path, rows, **meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': rows}, f, indent=2)
+
+
+def read_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
@@ -0,0 +1,173 @@
+"""
+Bulk cleanup of a session's stored image files, including the overlays
+rendered on request and the previews (see necrosis.overlays and
+necrosis.previews).
+
+The rows are handled first, in one statement: clear_session_images blanks
+the file fields of every image with a single update() and delete_session
+removes the session (cascading to its images). The files those rows
+pointed to are then deleted concurrently on a thread pool, each with one
+storage round trip after its size is read, so the reclaimed bytes can be
+reported.
+
+With ``background`` the caller gets a cleanup id right away. The cleanup
+is recorded as a CleanupTask row, with the file names, and once the
+transaction commits the deletion runs on a process-wide executor, which
+writes the outcome to the row. cleanup_status reads the row, so any web
+worker can answer for it. A cleanup still running
+NECROSIS_CLEANUP_LEASE_SECONDS after it started was lost with its process
+and is started again when polled; deleting a file twice is harmless.
+"""
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import AnalysisReport, CleanupTask
+from .overlays import session_overlays
+from .previews import session_previews
+
+logger = logging.getLogger(__name__)
+
+# How long finished background cleanups are kept for status requests
+CLEANUP_RETENTION = timedelta(days=7)
+
+_background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='necrosis-cleanup')
+
+
+def _delete_file(name):
+    """
+    Deletes one stored file and returns its size in bytes, or None when it
+    was already gone or could not be deleted.
+    """
+    try:
+        size = default_storage.size(name)
+        default_storage.delete(name)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        logger.warning('Could not delete %s', name, exc_info=True)
+        return None
+    return size
+
+
+def delete_files(names, threads=None):
+    """
+    Deletes the named files from default_storage in parallel. Returns
+    {'files': number deleted, 'bytes_reclaimed': total size}.
+    """
+    names = list(dict.fromkeys(name for name in names if name))
+    if not names:
+        return {'files': 0, 'bytes_reclaimed': 0}
+    threads = min(threads or settings.NECROSIS_CLEANUP_THREADS, len(names))
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='necrosis-delete') as pool:
+        sizes = list(pool.map(_delete_file, names))
+    sizes = [size for size in sizes if size is not None]
+    result = {'files': len(sizes), 'bytes_reclaimed': sum(sizes)}
+    logger.info('Deleted %d files, %d bytes reclaimed', result['files'], result['bytes_reclaimed'])
+    return result
+
+
+def _stored_files(images):
+    names = []
+    for original, processed in images.values_list('original_image', 'processed_image'):
+        names += [original, processed]
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def run_cleanup(task_id):
+    """
+    Deletes the files of a running CleanupTask and records the outcome.
+    """
+    task = CleanupTask.objects.filter(pk=task_id, status='running').first()
+    if task is None:
+        return
+    try:
+        outcome = delete_files(task.files)
+    except Exception as exc:
+        logger.exception('Cleanup %s failed', task.cleanup_id)
+        CleanupTask.objects.filter(pk=task_id).update(
+            status='failed', error=str(exc) or exc.__class__.__name__, finished_at=timezone.now(),
+        )
+        return
+    CleanupTask.objects.filter(pk=task_id).update(
+        status='completed', files_deleted=outcome['files'], bytes_reclaimed=outcome['bytes_reclaimed'],
+        finished_at=timezone.now(),
+    )
+
+
+def _background_cleanup(task_id):
+    try:
+        run_cleanup(task_id)
+    finally:
+        connections.close_all()
+
+
+def _submit(task_id):
+    transaction.on_commit(lambda: _background_executor.submit(_background_cleanup, task_id))
+
+
+def _run(names, user, background):
+    if not background:
+        return delete_files(names)
+    CleanupTask.objects.filter(finished_at__lt=timezone.now() - CLEANUP_RETENTION).delete()
+    task = CleanupTask.objects.create(cleanup_id=uuid.uuid4().hex, user=user, files=names)
+    _submit(task.pk)
+    return {'cleanup_id': task.cleanup_id, 'files_queued': len(names)}
+
+
+def clear_session_images(session, user, background=False):
+    """
+    Removes the stored originals and overlays of a session's images while
+    keeping their results. Returns the outcome of delete_files, or the
+    cleanup id and queued file count when run in the background.
+    """
+    images = session.cassava_images.all()
+    with transaction.atomic():
+        names = _stored_files(images) + session_overlays(session.pk) + session_previews(session.pk)
+        images.update(original_image='', processed_image='')
+    return _run(names, user, background)
+
+
+def delete_session(session, user, background=False):
+    """
+    Deletes a session with its images, reports and analysis tasks, and their
+    stored files, including the uploads of tasks not processed yet. Returns
+    the same as clear_session_images.
+    """
+    with transaction.atomic():
+        names = _stored_files(session.cassava_images.all()) + session_overlays(session.pk) + session_previews(
+            session.pk)
+        names += AnalysisReport.objects.filter(session=session).exclude(report_file='').values_list(
+            'report_file', flat=True)
+        names += session.tasks.values_list('upload_path', flat=True)
+        session.delete()
+    return _run(names, user, background)
+
+
+def cleanup_status(cleanup_id, user):
+    """
+    State of a background cleanup started by ``user``, or None when the id
+    is unknown. Restarts the cleanup when its lease ran out.
+    """
+    task = CleanupTask.objects.filter(cleanup_id=cleanup_id, user=user).first()
+    if task is None:
+        return None
+    if task.status == 'running':
+        now = timezone.now()
+        expired = task.started_at < now - timedelta(seconds=settings.NECROSIS_CLEANUP_LEASE_SECONDS)
+        # Only the request that moves started_at on restarts it
+        if expired and CleanupTask.objects.filter(
+                pk=task.pk, status='running', started_at=task.started_at).update(started_at=now):
+            logger.warning('Cleanup %s did not finish in time, running it again', cleanup_id)
+            _submit(task.pk)
+        return {'cleanup_id': cleanup_id, 'status': 'running'}
+    if task.status == 'failed':
+        return {'cleanup_id': cleanup_id, 'status': 'failed', 'error': task.error}
+    return {'cleanup_id': cleanup_id, 'status': 'completed', 'files': task.files_deleted,
+            'bytes_reclaimed': task.bytes_reclaimed}
@@ -0,0 +1,87 @@
+"""
+Thread-safe access to the in-process model.
+
+A model object is not safe to call from several request threads at once, so
+InferenceExecutor hands each call a model replica of its own: replicas are
+checked out of a pool and returned when the call finishes, and a call waits
+while all of them are busy. With one replica, inference is serialized; with
+more, up to that many requests run at once, each on its own copy. Replicas
+beyond the first are only loaded once concurrent calls need them.
+
+The trade-off between per-request latency and total throughput is set with
+the replica count and the intra-op threads each forward pass may use
+(torch and OpenCV thread pools are process-wide): few replicas with many
+threads favour latency, replicas x threads close to the core count with few
+threads each favours throughput.
+"""
+import logging
+import queue
+import threading
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+def configure_threads(torch_threads=None, cv2_threads=None):
+    """
+    Sets the process-wide intra-op thread counts; None leaves a library's
+    default alone. torch is only configured if it is installed.
+    """
+    if cv2_threads is not None:
+        cv2.setNumThreads(cv2_threads)
+    if torch_threads is not None:
+        try:
+            import torch
+        except ImportError:
+            return
+        torch.set_num_threads(torch_threads)
+
+
+class InferenceExecutor:
+    def __init__(self, factory, replicas=1):
+        if replicas < 1:
+            raise ValueError('At least one model replica is needed')
+        self.factory = factory
+        self.replicas = replicas
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        # The first replica is loaded right away so load errors surface early
+        self._idle.put(self._load(1))
+        self._loaded = 1
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _load(self, number):
+        mdl = self.factory()
+        logger.info('Loaded model replica %d of %d', number, self.replicas)
+        return mdl
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = self._loaded < self.replicas
+            if grow:
+                # Reserve the slot before loading, which can take seconds
+                self._loaded += 1
+                number = self._loaded
+        if not grow:
+            return self._idle.get()
+        try:
+            return self._load(number)
+        except Exception:
+            with self._lock:
+                self._loaded -= 1
+            raise
+
+    def __call__(self, *args, **kwargs):
+        mdl = self._checkout()
+        try:
+            return mdl(*args, **kwargs)
+        finally:
+            self._idle.put(mdl)
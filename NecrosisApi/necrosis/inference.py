@@ -0,0 +1,122 @@
+"""
+Lazy access to the segmentation model.
+
+Importing this module (and therefore necrosis.views) does not import
+ultralytics/torch or read the weights; that happens on the first inference,
+or earlier in the background when NECROSIS_WARMUP_MODEL is enabled.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .executor import InferenceExecutor, configure_threads
+
+logger = logging.getLogger(__name__)
+
+# Timings reported in the logs, in seconds
+stats = {
+    'startup_seconds': None,
+    'model_load_seconds': None,
+    'first_inference_seconds': None,
+    'first_request_seconds': None,
+    'warmup_seconds': None,
+}
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def load_model():
+    """
+    Builds the configured model: a client for the inference server when one
+    is set, otherwise the configured backend loaded in-process. Wrapped for
+    tiled inference when NECROSIS_TILED_INFERENCE is enabled.
+    """
+    if settings.NECROSIS_INFERENCE_SERVER:
+        from .inference_server import InferenceClient, inference_authkey
+        mdl = InferenceClient(settings.NECROSIS_INFERENCE_SERVER,
+                              authkey=inference_authkey(settings.NECROSIS_INFERENCE_SERVER))
+    else:
+        from .backends import load_backend
+        mdl = load_backend()
+    if settings.NECROSIS_TILED_INFERENCE:
+        from .tiling import TiledModel
+        mdl = TiledModel(mdl, tile_size=settings.NECROSIS_TILE_SIZE, overlap=settings.NECROSIS_TILE_OVERLAP,
+                         max_tiles=settings.NECROSIS_MAX_CONCURRENT_TILES, min_pixels=settings.NECROSIS_TILE_MIN_PIXELS)
+    return mdl
+
+
+def load_executor():
+    """
+    Builds the process-wide model: the inference server client as is (the
+    server schedules its own replicas), otherwise an InferenceExecutor over
+    NECROSIS_MODEL_REPLICAS in-process replicas, after applying the
+    configured intra-op thread counts.
+    """
+    if settings.NECROSIS_INFERENCE_SERVER:
+        return load_model()
+    configure_threads(settings.NECROSIS_TORCH_THREADS, settings.NECROSIS_CV2_THREADS)
+    return InferenceExecutor(load_model, replicas=settings.NECROSIS_MODEL_REPLICAS)
+
+
+def get_model():
+    """
+    Returns the process-wide model, loading it on first use. Safe to call
+    from concurrent request threads.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                start = time.perf_counter()
+                _model = load_executor()
+                stats['model_load_seconds'] = time.perf_counter() - start
+                logger.info('Model loaded in %.2fs', stats['model_load_seconds'])
+    return _model
+
+
+def is_loaded():
+    return _model is not None
+
+
+class LazyModel:
+    """
+    Callable stand-in for the model that loads it on the first call and
+    records how long that first inference took, load included.
+    """
+
+    def __call__(self, *args, **kwargs):
+        if stats['first_inference_seconds'] is not None:
+            return get_model()(*args, **kwargs)
+        start = time.perf_counter()
+        results = get_model()(*args, **kwargs)
+        if stats['first_inference_seconds'] is None:
+            stats['first_inference_seconds'] = time.perf_counter() - start
+            logger.info('First inference took %.2fs (model load included)', stats['first_inference_seconds'])
+        return results
+
+
+def warm_up(background=True):
+    """
+    Loads the model and runs one dummy inference so the first real request
+    does not pay for it. Runs in a daemon thread unless ``background`` is False.
+    """
+    def run():
+        start = time.perf_counter()
+        try:
+            LazyModel()(np.zeros((640, 640, 3), dtype=np.uint8))
+        except Exception:
+            logger.exception('Model warm-up failed')
+            return
+        stats['warmup_seconds'] = time.perf_counter() - start
+        logger.info('Model warm-up finished in %.2fs', stats['warmup_seconds'])
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name='necrosis-warmup', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,308 @@
+"""
+Dedicated inference server.
+
+`manage.py run_inference_server` starts N replica processes, each holding its
+own preloaded copy of the segmentation model, behind a local socket. Web
+workers talk to it through InferenceClient, which behaves like a model: it is
+called with a list of image paths (or arrays) and returns one Detections per
+image, so it can be handed to process_images_batch in place of a YOLO object.
+
+Scheduling: the dispatcher spreads images over per-replica queues, and a
+replica whose own queue is empty steals pending images from the others, so a
+replica stuck on a large image does not hold back the rest of a request.
+
+Failures: a monitor thread restarts replica processes that died (OOM, CUDA
+fault). Replicas announce the jobs they take, so the jobs a dead replica
+held fail their requests right away instead of never producing results. As
+a last resort a request fails after NECROSIS_INFERENCE_TIMEOUT seconds;
+replies arriving after that are dropped.
+
+Replies carry the image size with the polygons, so the web worker does not
+decode the image just to build its Detections.
+
+Security: requests are pickled, so whoever passes the authkey handshake can
+run code in the server. Only a loopback or unix socket address may fall
+back to SECRET_KEY as the key; any other address needs
+NECROSIS_INFERENCE_AUTHKEY set (see inference_authkey).
+"""
+import ipaddress
+import itertools
+import logging
+import queue
+import threading
+import time
+from multiprocessing import Process, Queue
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .ingest import load_image
+from .utilities import Detections
+
+logger = logging.getLogger(__name__)
+
+STEAL_TIMEOUT = 0.05
+MONITOR_INTERVAL = 1.0
+
+
+def parse_address(address):
+    """
+    'host:port' becomes a TCP address, anything else is a unix socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+def _is_local(address):
+    if isinstance(address, str):
+        # Unix socket, guarded by its file permissions
+        return True
+    host = address[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def inference_authkey(address):
+    """
+    The authkey for the server at ``address``: NECROSIS_INFERENCE_AUTHKEY,
+    else SECRET_KEY for a local address. Raises ImproperlyConfigured when
+    a network address has no key of its own.
+    """
+    if settings.NECROSIS_INFERENCE_AUTHKEY:
+        return settings.NECROSIS_INFERENCE_AUTHKEY
+    if not _is_local(parse_address(address)):
+        raise ImproperlyConfigured(f'The inference server address {address!r} is reachable from the network, '
+                                   'set NECROSIS_INFERENCE_AUTHKEY')
+    return settings.SECRET_KEY.encode()
+
+
+def _take_jobs(index, queues, batch_size):
+    """
+    Returns up to ``batch_size`` jobs for replica ``index``, preferring its own
+    queue and stealing from the other replicas' queues when that is empty.
+    Returns None once the shutdown sentinel is received.
+    """
+    own = queues[index]
+    while True:
+        jobs = []
+        try:
+            job = own.get(timeout=STEAL_TIMEOUT)
+            if job is None:
+                return None
+            jobs.append(job)
+            while len(jobs) < batch_size:
+                job = own.get_nowait()
+                if job is None:
+                    own.put(None)
+                    break
+                jobs.append(job)
+        except queue.Empty:
+            pass
+        if not jobs:
+            for victim in queues[index + 1:] + queues[:index]:
+                while len(jobs) < batch_size:
+                    try:
+                        job = victim.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        # Not ours to consume, hand it back
+                        victim.put(None)
+                        break
+                    jobs.append(job)
+        if jobs:
+            return jobs
+
+
+def _replica_main(index, queues, results, model_path, batch_size):
+    from ultralytics import YOLO
+
+    mdl = YOLO(model_path, task='segment')
+    while True:
+        jobs = _take_jobs(index, queues, batch_size)
+        if jobs is None:
+            return
+        results.put(('taken', index, [job_id for job_id, _ in jobs]))
+        try:
+            # Decoded here rather than by ultralytics, which would apply the EXIF orientation
+            predictions = mdl([load_image(source) for _, source in jobs])
+        except Exception as exc:
+            for job_id, _ in jobs:
+                results.put(('result', job_id, None, str(exc) or exc.__class__.__name__))
+            continue
+        for (job_id, _), res in zip(jobs, predictions):
+            polygons = list(res.masks.xy) if res.masks is not None else []
+            results.put(('result', job_id, {'classes': res.boxes.cls.tolist(), 'polygons': polygons,
+                                            'orig_shape': tuple(res.orig_shape)}, None))
+
+
+class InferenceServer:
+    def __init__(self, address, model_path, replicas=2, batch_size=8, authkey=None, timeout=120.0):
+        self.address = parse_address(address)
+        self.model_path = model_path
+        self.replicas = replicas
+        self.batch_size = batch_size
+        self.authkey = authkey
+        self.timeout = timeout
+        self.restarts = 0
+        self._queues = []
+        self._processes = []
+        self._results = None
+        self._pending = {}
+        # Job ids each replica took and has not answered yet
+        self._taken = [set() for _ in range(replicas)]
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._next_replica = itertools.cycle(range(replicas))
+
+    def _start_replica(self, index):
+        process = Process(target=_replica_main, daemon=True,
+                          args=(index, self._queues, self._results, self.model_path, self.batch_size))
+        process.start()
+        return process
+
+    def start_replicas(self):
+        self._queues = [Queue() for _ in range(self.replicas)]
+        self._results = Queue()
+        self._processes = [self._start_replica(i) for i in range(self.replicas)]
+        threading.Thread(target=self._collect, name='necrosis-inference-collect', daemon=True).start()
+        threading.Thread(target=self._monitor, name='necrosis-inference-monitor', daemon=True).start()
+
+    def stop(self):
+        self._stopping = True
+        for q in self._queues:
+            q.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def serve_forever(self):
+        self.start_replicas()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            try:
+                while True:
+                    conn = listener.accept()
+                    threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+            finally:
+                self.stop()
+
+    def predict(self, sources):
+        """
+        Runs the sources through the replicas and returns one reply per
+        source, in order. Raises RuntimeError if any of them failed or
+        they were not all answered within ``timeout`` seconds.
+        """
+        done = threading.Event()
+        request = {'remaining': len(sources), 'replies': [None] * len(sources), 'error': None, 'done': done}
+        job_ids = []
+        with self._lock:
+            for position, source in enumerate(sources):
+                job_id = next(self._job_ids)
+                job_ids.append(job_id)
+                self._pending[job_id] = (request, position)
+                self._queues[next(self._next_replica)].put((job_id, source))
+        if sources and not done.wait(self.timeout):
+            with self._lock:
+                for job_id in job_ids:
+                    self._pending.pop(job_id, None)
+                for taken in self._taken:
+                    taken.difference_update(job_ids)
+            raise RuntimeError(f'Inference timed out after {self.timeout:g}s')
+        if request['error']:
+            raise RuntimeError(request['error'])
+        return request['replies']
+
+    def _complete(self, job_id, reply, error):
+        with self._lock:
+            for taken in self._taken:
+                taken.discard(job_id)
+            entry = self._pending.pop(job_id, None)
+            if entry is None:
+                # Its request already timed out or failed
+                return
+            request, position = entry
+            request['replies'][position] = reply
+            request['error'] = request['error'] or error
+            request['remaining'] -= 1
+            if request['remaining'] == 0:
+                request['done'].set()
+
+    def _collect(self):
+        while True:
+            message = self._results.get()
+            if message[0] == 'taken':
+                _, index, job_ids = message
+                with self._lock:
+                    self._taken[index].update(job_id for job_id in job_ids if job_id in self._pending)
+            else:
+                self._complete(*message[1:])
+
+    def _monitor(self):
+        while not self._stopping:
+            time.sleep(MONITOR_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if self._stopping or process.is_alive():
+                    continue
+                with self._lock:
+                    lost = list(self._taken[index])
+                logger.error('Inference replica %d exited with code %s, restarting it (%d jobs lost)',
+                             index, process.exitcode, len(lost))
+                self._processes[index] = self._start_replica(index)
+                self.restarts += 1
+                for job_id in lost:
+                    self._complete(job_id, None, f'Inference replica {index} exited with code {process.exitcode}')
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                while True:
+                    command, sources = conn.recv()
+                    if command != 'predict':
+                        conn.send(('error', f'Unknown command {command!r}'))
+                        continue
+                    try:
+                        conn.send(('ok', self.predict(sources)))
+                    except RuntimeError as exc:
+                        conn.send(('error', str(exc)))
+            except EOFError:
+                pass
+
+
+class InferenceClient:
+    """
+    Model-like client for InferenceServer. Sources are image paths on the
+    shared filesystem or BGR numpy arrays.
+    """
+
+    def __init__(self, address, authkey=None):
+        self.address = parse_address(address)
+        self.authkey = authkey
+
+    def __call__(self, sources):
+        if isinstance(sources, (str, np.ndarray)):
+            sources = [sources]
+        sources = list(sources)
+        with Client(self.address, authkey=self.authkey) as conn:
+            conn.send(('predict', sources))
+            state, replies = conn.recv()
+        if state != 'ok':
+            raise RuntimeError(f'Inference server error: {replies}')
+        detections = []
+        for source, reply in zip(sources, replies):
+            if isinstance(source, str):
+                # Read from the path only if an overlay is drawn
+                detections.append(Detections(reply['classes'], reply['polygons'], path=source,
+                                              orig_shape=reply['orig_shape']))
+            else:
+                detections.append(Detections(reply['classes'], reply['polygons'], source))
+        return detections
@@ -0,0 +1,112 @@
+"""
+Upload ingestion for the analyze endpoint.
+
+Each upload is read once, straight from its chunks into a single buffer.
+That buffer is hashed for the result cache and, right before the image's
+inference batch runs, decoded once with cv2.imdecode into the BGR array
+handed to the model (and from there to process_results as ``orig_img``).
+Only one batch of full resolution arrays is therefore alive at a time. The
+upload itself is written to storage on a thread pool while inference runs.
+
+Like the Pillow decoding this replaced, DECODE_FLAGS leave the EXIF
+orientation unapplied: masks, overlays and previews of a rotated phone photo
+keep the orientation they always had. Images inferred from a path are read
+with read_image for the same reason: ultralytics and cv2.imread would apply
+the orientation, and the stored polygons would then be in another pixel
+frame than the overlays drawn from them.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from . import metrics
+
+DECODE_FLAGS = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+_persist_executor = ThreadPoolExecutor(max_workers=settings.NECROSIS_PERSIST_THREADS,
+                                       thread_name_prefix='necrosis-persist')
+
+
+class IngestedImage:
+    def __init__(self, name, stored_name, buffer, digest, saved):
+        self.name = name
+        self.stored_name = stored_name
+        self.digest = digest
+        self._buffer = buffer
+        self._saved = saved
+
+    def decode(self):
+        """
+        The upload as a BGR array; pass as ``load`` to cached_process_images.
+        """
+        return decode_image(self._buffer)
+
+    @property
+    def upload_path(self):
+        """
+        Storage path of the original bytes; waits for the write to finish.
+        """
+        return self._saved.result()
+
+    async def aupload_path(self):
+        """
+        Async counterpart of upload_path, awaiting the write without
+        blocking the event loop.
+        """
+        return await asyncio.wrap_future(self._saved)
+
+
+def decode_image(buffer):
+    """
+    Decodes encoded image bytes into a BGR array without copying them first.
+    Formats OpenCV cannot read go through Pillow.
+    """
+    with metrics.timer('decode') as timer:
+        array = cv2.imdecode(np.frombuffer(buffer, np.uint8), DECODE_FLAGS)
+        if array is None:
+            rgb = Image.open(io.BytesIO(buffer)).convert("RGB")
+            array = cv2.cvtColor(np.asarray(rgb), cv2.COLOR_RGB2BGR)
+        if timer is not None:
+            timer.shape = array.shape[:2]
+    return array
+
+
+def read_image(path):
+    """
+    Decodes the image file at ``path`` like decode_image does an upload.
+    """
+    with open(path, 'rb') as f:
+        return decode_image(f.read())
+
+
+def load_image(source):
+    """
+    ``source`` as a BGR array: arrays are returned as is, paths are read
+    with read_image.
+    """
+    return source if isinstance(source, np.ndarray) else read_image(source)
+
+
+def ingest_upload(upload, upload_dir='uploads/images/'):
+    buffer = bytearray()
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        buffer.extend(chunk)
+        digest.update(chunk)
+    stored_name = f'{uuid.uuid4()}_{upload.name}'
+    # Saved from the upload itself: it is no longer read here, and copying the buffer would cost another copy
+    saved = _persist_executor.submit(default_storage.save, os.path.join(upload_dir, stored_name), upload)
+    return IngestedImage(upload.name, stored_name, buffer, digest.hexdigest(), saved)
+
+
+def ingest_uploads(files, upload_dir='uploads/images/'):
+    return [ingest_upload(upload, upload_dir) for upload in files]
@@ -0,0 +1,230 @@
+"""
+Background analysis jobs.
+
+The AnalysisTask table is used as a local broker: the API stores the uploads
+and queues one task per image, and `manage.py run_analysis_workers` starts a
+pool of worker processes that claim queued tasks, run them through the model
+and fill in the CassavaImage rows. A job is identified by its session_id.
+
+Claiming a task leases it to the worker for NECROSIS_JOB_LEASE_SECONDS,
+counted from started_at. Tasks of a worker that crashed or was killed are
+released once their lease runs out: queued again, or failed after
+NECROSIS_JOB_MAX_ATTEMPTS claims so a task that kills its worker cannot
+loop forever. A worker whose lease ran out no longer records its result,
+and tasks deleted with their session while claimed are dropped.
+"""
+import logging
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .inference import get_model
+from .aggregates import add_images
+from .models import AnalysisSession, AnalysisTask, CassavaImage
+from .polygons import encode_polygons
+from .previews import schedule_previews
+from .result_cache import cached_process_images
+from .utilities import store_upload
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_images(user, files, session_id=None):
+    """
+    Stores the uploaded files and queues one AnalysisTask per image.
+    Reuses the user's session when a valid session_id is given, otherwise
+    creates a new one. Returns the queued AnalysisSession.
+    """
+    session = None
+    if session_id:
+        session = AnalysisSession.objects.filter(session_id=session_id, user=user).first()
+    upload_paths = [store_upload(file) for file in files]
+    with transaction.atomic():
+        if session is None:
+            session = AnalysisSession.objects.create(
+                user=user,
+                session_id=str(uuid.uuid4()),
+                num_images=0,
+                status='queued',
+            )
+        else:
+            session.status = 'queued'
+            session.save(update_fields=['status'])
+        AnalysisTask.objects.bulk_create([
+            AnalysisTask(session=session, upload_path=upload_path, image_name=file.name)
+            for file, upload_path in zip(files, upload_paths)
+        ])
+    return session
+
+
+def release_expired_tasks():
+    """
+    Requeues running tasks whose lease ran out, or fails them once they used
+    up NECROSIS_JOB_MAX_ATTEMPTS claims. Returns the number released.
+    """
+    now = timezone.now()
+    expired = AnalysisTask.objects.filter(
+        status='running', started_at__lt=now - timedelta(seconds=settings.NECROSIS_JOB_LEASE_SECONDS),
+    )
+    session_ids = set(expired.values_list('session_id', flat=True))
+    if not session_ids:
+        return 0
+    failed = expired.filter(attempts__gte=settings.NECROSIS_JOB_MAX_ATTEMPTS).update(
+        status='failed', claim_token=None, finished_at=now,
+        error=f'Worker did not finish the task in {settings.NECROSIS_JOB_MAX_ATTEMPTS} attempts',
+    )
+    requeued = expired.update(status='queued', claim_token=None, started_at=None)
+    if failed or requeued:
+        logger.warning('Released %d expired analysis tasks (%d requeued, %d failed)',
+                       failed + requeued, requeued, failed)
+    for session_id in session_ids:
+        _refresh_session(session_id)
+    return failed + requeued
+
+
+def claim_tasks(limit):
+    """
+    Atomically marks up to ``limit`` queued tasks as running for this worker
+    and returns them. Rows claimed by another worker in between are skipped.
+    Expired leases are released first.
+    """
+    release_expired_tasks()
+    token = uuid.uuid4().hex
+    queued_ids = AnalysisTask.objects.filter(status='queued').order_by('id').values_list('id', flat=True)[:limit]
+    AnalysisTask.objects.filter(id__in=list(queued_ids), status='queued').update(
+        status='running', claim_token=token, started_at=timezone.now(), attempts=F('attempts') + 1,
+    )
+    claimed = list(AnalysisTask.objects.filter(claim_token=token).select_related('session').order_by('id'))
+    AnalysisSession.objects.filter(
+        id__in={task.session_id for task in claimed}, status='queued',
+    ).update(status='running')
+    return claimed
+
+
+def run_tasks(tasks, mdl, batch_size):
+    """
+    Runs claimed tasks through the model and records their results.
+    If a batch fails, its images are retried one by one so a single bad
+    upload only fails its own task.
+    """
+    for start in range(0, len(tasks), batch_size):
+        chunk = tasks[start:start + batch_size]
+        # The session may have been deleted since the tasks were claimed
+        live = set(AnalysisTask.objects.filter(pk__in=[task.pk for task in chunk]).values_list('pk', flat=True))
+        if len(live) < len(chunk):
+            logger.info('Dropping %d claimed tasks deleted with their session', len(chunk) - len(live))
+            chunk = [task for task in chunk if task.pk in live]
+            if not chunk:
+                continue
+        paths = [os.path.join(default_storage.location, task.upload_path) for task in chunk]
+        try:
+            processed = cached_process_images(paths, mdl, batch_size=batch_size,
+                                              render=settings.NECROSIS_EAGER_OVERLAYS)
+        except Exception:
+            processed = None
+        for i, task in enumerate(chunk):
+            try:
+                res = processed[i] if processed is not None else cached_process_images(
+                    [paths[i]], mdl, render=settings.NECROSIS_EAGER_OVERLAYS)[0]
+            except Exception as exc:
+                _finish_task(task, error=str(exc) or exc.__class__.__name__)
+                continue
+            _finish_task(task, res=res)
+    for session_id in {task.session_id for task in tasks}:
+        _refresh_session(session_id)
+
+
+def _finish_task(task, res=None, error=None):
+    with transaction.atomic():
+        if not AnalysisTask.objects.select_for_update().filter(
+                pk=task.pk, status='running', claim_token=task.claim_token).exists():
+            logger.warning('Task %s expired or was deleted, dropping its result', task.pk)
+            return
+        if res is not None:
+            task.cassava_image = CassavaImage.objects.create(
+                session_id=task.session_id,
+                original_image=task.upload_path,
+                processed_image=f'results/{res[1]}' if settings.NECROSIS_EAGER_OVERLAYS else '',
+                image_name=task.image_name,
+                total_lesions=res[2],
+                necrosis_percentage=res[0],
+                lesion_polygons=encode_polygons(res[3]),
+            )
+            add_images(task.session_id, [(res[0], res[2])])
+            schedule_previews([task.cassava_image])
+            task.status = 'done'
+        else:
+            task.status = 'failed'
+            task.error = error
+        task.finished_at = timezone.now()
+        task.save(update_fields=['cassava_image', 'status', 'error', 'finished_at'])
+
+
+def _refresh_session(session_id):
+    session = AnalysisSession.objects.filter(id=session_id).first()
+    if session is None:
+        return
+    tasks = session.tasks.all()
+    if tasks.filter(status__in=['queued', 'running']).exists():
+        session.status = 'running'
+    elif tasks.filter(status='failed').exists() and not tasks.filter(status='done').exists():
+        session.status = 'failed'
+    else:
+        session.status = 'completed'
+    session.save(update_fields=['status'])
+
+
+def job_status(session):
+    """
+    Returns the progress of a job along with the state of each image.
+    """
+    images = []
+    counts = {choice: 0 for choice, _ in AnalysisTask.STATUS_CHOICES}
+    for task in session.tasks.select_related('cassava_image').order_by('id'):
+        counts[task.status] += 1
+        image = task.cassava_image
+        images.append({
+            'filename': task.image_name,
+            'status': task.status,
+            'percentage_necrosis': image.necrosis_percentage if image else None,
+            'lesion_count': image.total_lesions if image else None,
+            'error': task.error,
+        })
+    return {
+        'job_id': session.session_id,
+        'status': session.status,
+        'total': len(images),
+        'progress': counts,
+        'images': images,
+    }
+
+
+def run_worker(poll_interval=None, batch_size=None, once=False):
+    """
+    Worker loop: loads the model once, then keeps claiming and running
+    queued tasks. With ``once`` it returns as soon as the queue is empty.
+    """
+    poll_interval = poll_interval or settings.NECROSIS_JOB_POLL_INTERVAL
+    batch_size = batch_size or settings.NECROSIS_INFERENCE_BATCH_SIZE
+    mdl = get_model()
+    while True:
+        try:
+            tasks = claim_tasks(batch_size)
+            if tasks:
+                run_tasks(tasks, mdl, batch_size)
+        except Exception:
+            # Keep the worker alive: its tasks are released when their lease runs out
+            logger.exception('Analysis worker batch failed')
+            tasks = None
+        if tasks:
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from necrosis.benchmarks import benchmark_areas
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the necrosis area methods against full-resolution fillPoly masks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lesions', type=int, default=12, help='Lesions per synthetic image.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs averaged per measurement.')
+
+    def handle(self, *args, **options):
+        rows = benchmark_areas(lesions=options['lesions'], repeat=options['repeat'])
+        self.stdout.write(f"{'resolution':<12}{'method':<10}{'ms/image':>10}{'necrosis %':>12}")
+        for row in rows:
+            self.stdout.write(f"{row['resolution']:<12}{row['method']:<10}"
+                              f"{row['seconds'] * 1000:>10.2f}{row['percentage_necrosis']:>12.3f}")
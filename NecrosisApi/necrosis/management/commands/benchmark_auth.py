@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from necrosis.benchmarks import benchmark_authentication, isolated_environment
+
+
+class Command(BaseCommand):
+    help = ('Measures the database queries and latency per authenticated request with and without the '
+            'in-process token cache, against a throwaway test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per measurement.')
+        parser.add_argument('--url', default='/api/user_sessions/?fields=session_id',
+                            help='Authenticated endpoint to request.')
+
+    def handle(self, *args, **options):
+        with isolated_environment():
+            rows = benchmark_authentication(requests=options['requests'], url=options['url'])
+
+        self.stdout.write(f"{'auth':>10}{'queries':>10}{'ms':>10}")
+        for row in rows:
+            self.stdout.write(f"{row['auth']:>10}{row['queries_per_request']:>10.2f}{row['ms_per_request']:>10.2f}")
+        saved = rows[0]['ms_per_request'] - rows[1]['ms_per_request']
+        self.stdout.write(f"Saved per request: {rows[0]['queries_per_request'] - rows[1]['queries_per_request']:.2f} "
+                          f"queries, {saved:.2f} ms")
@@ -0,0 +1,52 @@
+import platform
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from necrosis.benchmarks import (
+    RESOLUTIONS, benchmark_endpoint, benchmark_stages, compare_to_baseline, isolated_environment,
+    load_benchmark_model, parse_resolution, read_results, write_results,
+)
+
+
+class Command(BaseCommand):
+    help = ('Times each stage of the analysis pipeline and the /api/analyze/ endpoint on synthetic images, '
+            'optionally comparing against a baseline run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['real', 'synthetic'], default='real',
+                            help="'synthetic' replaces inference with fixed polygons (no weights needed).")
+        parser.add_argument('--resolutions', nargs='+', type=parse_resolution,
+                            default=[(h, w) for h, w in RESOLUTIONS], help='Image sizes as WIDTHxHEIGHT.')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs averaged per measurement.')
+        parser.add_argument('--endpoint-images', type=int, default=8,
+                            help='Images per /api/analyze/ request (0 skips the endpoint).')
+        parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results.')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed slowdown against the baseline, as a fraction.')
+
+    def handle(self, *args, **options):
+        mdl = load_benchmark_model(options['model'])
+        with isolated_environment():
+            rows = benchmark_stages(mdl, resolutions=options['resolutions'], repeat=options['repeat'])
+            if options['endpoint_images']:
+                rows.append(benchmark_endpoint(mdl, resolution=options['resolutions'][-1],
+                                               images=options['endpoint_images'], repeat=options['repeat']))
+
+        self.stdout.write(f"{'resolution':<12}{'stage':<12}{'ms/image':>10}")
+        for row in rows:
+            self.stdout.write(f"{row['resolution']:<12}{row['stage']:<12}{row['seconds'] * 1000:>10.2f}")
+        write_results(options['output'], rows, model=options['model'], python=platform.python_version(),
+                      created_at=datetime.now(timezone.utc).isoformat())
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if options['baseline']:
+            regressions = compare_to_baseline(rows, read_results(options['baseline']), options['threshold'])
+            for row in regressions:
+                self.stderr.write(f"{row['resolution']} {row['stage']}: {row['seconds'] * 1000:.2f} ms vs "
+                                  f"{row['baseline_seconds'] * 1000:.2f} ms baseline (+{row['slowdown']:.0%})")
+            if regressions:
+                raise CommandError(f'{len(regressions)} stage(s) slower than the baseline by more than '
+                                   f"{options['threshold']:.0%}")
+            self.stdout.write('No regressions against the baseline.')
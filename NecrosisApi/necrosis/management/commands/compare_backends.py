@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from necrosis.backends import BACKENDS, TORCH, backend_label, compare_backends, fixture_images, load_backend
+
+
+class Command(BaseCommand):
+    help = ('Compares the necrosis percentages of exported backends against the torch model '
+            'on a set of fixture images.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', nargs='+', default=[str(settings.BASE_DIR / 'media/fixtures')],
+                            help='Fixture images or directories of images.')
+        parser.add_argument('--backends', nargs='+', choices=[b for b in BACKENDS if b != TORCH],
+                            default=['onnx'], help='Backends to check.')
+        parser.add_argument('--int8', action='store_true', help='Check the INT8 exports.')
+        parser.add_argument('--tolerance', type=float, default=1.0,
+                            help='Largest accepted difference, in percentage points.')
+
+    def handle(self, *args, **options):
+        images = fixture_images(options['images'])
+        if not images:
+            raise CommandError(f"No fixture images found in {' '.join(options['images'])}")
+        candidates = {backend_label(b, options['int8']): load_backend(b, options['int8'])
+                      for b in options['backends']}
+        rows = compare_backends(images, load_backend(TORCH), candidates)
+
+        self.stdout.write(f"{'image':<32}{'backend':<14}{'torch %':>10}{'backend %':>11}{'diff':>8}")
+        failures = []
+        for row in rows:
+            reference, actual, difference = (
+                '-' if v is None else f'{v:.2f}' for v in (row['reference'], row['percentage_necrosis'],
+                                                           row['difference'])
+            )
+            self.stdout.write(f"{row['image']:<32}{row['backend']:<14}{reference:>10}{actual:>11}{difference:>8}")
+            if row['difference'] is None:
+                # A root found by only one of the two models is a mismatch too
+                if (row['reference'] is None) != (row['percentage_necrosis'] is None):
+                    failures.append(row)
+            elif row['difference'] > options['tolerance']:
+                failures.append(row)
+        if failures:
+            raise CommandError(f"{len(failures)} result(s) differ from torch by more than "
+                               f"{options['tolerance']} percentage points")
+        self.stdout.write(f"All {len(rows)} results within {options['tolerance']} percentage points of torch.")
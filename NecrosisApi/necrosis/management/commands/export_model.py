@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from necrosis.backends import ONNX, OPENVINO, backend_label, export_model
+
+
+class Command(BaseCommand):
+    help = 'Exports the segmentation weights for the ONNX Runtime or OpenVINO backend, optionally as INT8.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=[ONNX, OPENVINO], default=ONNX)
+        parser.add_argument('--int8', action='store_true', help='Quantize the weights to INT8.')
+        parser.add_argument('--imgsz', type=int, default=640, help='Model input size.')
+        parser.add_argument('--data', help='Calibration dataset YAML for OpenVINO INT8.')
+
+    def handle(self, *args, **options):
+        path = export_model(options['backend'], int8=options['int8'], imgsz=options['imgsz'], data=options['data'])
+        self.stdout.write(f"{backend_label(options['backend'], options['int8'])} model written to {path}")
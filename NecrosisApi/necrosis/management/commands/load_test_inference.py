@@ -0,0 +1,42 @@
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from necrosis.benchmarks import benchmark_concurrency, load_benchmark_model, parse_resolution
+from necrosis.executor import InferenceExecutor, configure_threads
+from necrosis.inference import load_model
+
+
+class Command(BaseCommand):
+    help = ('Measures inference throughput (images/sec) and latency with several threads calling the '
+            'model executor at once, for a given replica count and intra-op thread setting.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['real', 'synthetic'], default='real',
+                            help="'synthetic' replaces inference with fixed polygons (no weights needed).")
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 2, 4, 8],
+                            help='Numbers of parallel callers to measure.')
+        parser.add_argument('--replicas', type=int, default=settings.NECROSIS_MODEL_REPLICAS,
+                            help='Model replicas in the executor.')
+        parser.add_argument('--torch-threads', type=int, default=settings.NECROSIS_TORCH_THREADS,
+                            help='Intra-op threads for torch.')
+        parser.add_argument('--cv2-threads', type=int, default=settings.NECROSIS_CV2_THREADS,
+                            help='Threads for OpenCV.')
+        parser.add_argument('--calls', type=int, default=8, help='Inferences per caller.')
+        parser.add_argument('--resolution', type=parse_resolution, default=(3000, 4000), help='Image size as WIDTHxHEIGHT.')
+
+    def handle(self, *args, **options):
+        configure_threads(options['torch_threads'], options['cv2_threads'])
+        factory = load_model if options['model'] == 'real' else partial(load_benchmark_model, 'synthetic')
+        executor = InferenceExecutor(factory, replicas=options['replicas'])
+        rows = benchmark_concurrency(executor, levels=options['concurrency'], calls_per_worker=options['calls'],
+                                     resolution=options['resolution'])
+
+        threads = {name: 'default' if options[name] is None else options[name] for name in ('torch_threads', 'cv2_threads')}
+        self.stdout.write(f"Replicas: {options['replicas']}, torch threads: {threads['torch_threads']}, "
+                          f"OpenCV threads: {threads['cv2_threads']}")
+        self.stdout.write(f"{'callers':>8}{'images/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for row in rows:
+            self.stdout.write(f"{row['concurrency']:>8}{row['images_per_second']:>10.2f}"
+                              f"{row['p50_seconds'] * 1000:>10.1f}{row['p95_seconds'] * 1000:>10.1f}")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from necrosis.benchmarks import benchmark_concurrent_writes, isolated_environment, journal_mode, load_benchmark_model
+
+
+class Command(BaseCommand):
+    help = ('Measures /api/analyze/ write throughput with several clients posting in parallel, '
+            'against a throwaway copy of the configured database backend.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['real', 'synthetic'], default='synthetic',
+                            help="'synthetic' replaces inference with fixed polygons (no weights needed).")
+        parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8],
+                            help='Parallel client counts to measure.')
+        parser.add_argument('--requests', type=int, default=4, help='Requests sent by each client.')
+        parser.add_argument('--images', type=int, default=4, help='Images per request.')
+
+    def handle(self, *args, **options):
+        mdl = load_benchmark_model(options['model'])
+        with isolated_environment(file_database=True):
+            mode = journal_mode()
+            rows = benchmark_concurrent_writes(mdl, workers=options['workers'],
+                                               requests_per_worker=options['requests'], images=options['images'])
+
+        self.stdout.write(f"Backend: {connection.vendor} ({mode})")
+        self.stdout.write(f"{'workers':>8}{'requests':>10}{'failed':>8}{'seconds':>10}{'images/s':>10}")
+        for row in rows:
+            self.stdout.write(f"{row['workers']:>8}{row['requests']:>10}{row['failed']:>8}"
+                              f"{row['seconds']:>10.2f}{row['images_per_second']:>10.1f}")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from necrosis.aggregates import recompute
+from necrosis.models import AnalysisSession
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the per-session summary columns from the image rows, e.g. after images were changed with '
+            'raw SQL or QuerySet.update().')
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_ids', nargs='*',
+                            help='session_id of the sessions to rebuild; all sessions when omitted.')
+
+    def handle(self, *args, **options):
+        sessions = None
+        if options['session_ids']:
+            sessions = AnalysisSession.objects.filter(session_id__in=options['session_ids'])
+        updated = recompute(sessions)
+        self.stdout.write(f'Recomputed the aggregates of {updated} sessions.')
@@ -0,0 +1,45 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from necrosis.jobs import run_worker
+
+
+def _worker_main(poll_interval, batch_size, once):
+    # Each process opens its own database connection
+    connections.close_all()
+    run_worker(poll_interval=poll_interval, batch_size=batch_size, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Runs a pool of worker processes that process queued analysis jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.NECROSIS_JOB_WORKERS,
+                            help='Number of worker processes.')
+        parser.add_argument('--batch-size', type=int, default=settings.NECROSIS_INFERENCE_BATCH_SIZE,
+                            help='Images claimed and inferred per batch.')
+        parser.add_argument('--poll-interval', type=float, default=settings.NECROSIS_JOB_POLL_INTERVAL,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue has been drained.')
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        args = (options['poll_interval'], options['batch_size'], options['once'])
+        if workers == 1:
+            run_worker(*args)
+            return
+        connections.close_all()
+        processes = [multiprocessing.Process(target=_worker_main, args=args, daemon=True) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {workers} analysis workers.')
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
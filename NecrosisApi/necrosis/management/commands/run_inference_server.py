@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from necrosis.backends import weights_path
+from necrosis.inference_server import InferenceServer, inference_authkey
+
+
+class Command(BaseCommand):
+    help = 'Runs the inference server holding preloaded model replicas.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=settings.NECROSIS_INFERENCE_SERVER or '127.0.0.1:8765',
+                            help="'host:port' or unix socket path to listen on.")
+        parser.add_argument('--replicas', type=int, default=settings.NECROSIS_INFERENCE_REPLICAS,
+                            help='Number of model replica processes.')
+        parser.add_argument('--batch-size', type=int, default=settings.NECROSIS_INFERENCE_BATCH_SIZE,
+                            help='Maximum images per replica forward pass.')
+        parser.add_argument('--timeout', type=float, default=settings.NECROSIS_INFERENCE_TIMEOUT,
+                            help='Seconds a request may wait for its results.')
+
+    def handle(self, *args, **options):
+        server = InferenceServer(
+            options['address'],
+            weights_path(),
+            replicas=max(1, options['replicas']),
+            batch_size=options['batch_size'],
+            authkey=inference_authkey(options['address']),
+            timeout=options['timeout'],
+        )
+        self.stdout.write(f"Serving {server.replicas} model replicas on {options['address']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
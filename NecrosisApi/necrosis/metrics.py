@@ -0,0 +1,184 @@
+"""
+Latency instrumentation exposed in the Prometheus text format.
+
+Pipeline stages are timed with ``timer(stage, shape)`` into the
+necrosis_stage_seconds histogram, labelled by stage and image resolution
+bucket. MetricsMiddleware records necrosis_request_seconds per route. Both
+live in process memory and are served by metrics_view at /metrics/.
+
+With NECROSIS_METRICS_ENABLED off, timer() returns a shared no-op context
+manager and nothing is recorded.
+"""
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Upper bounds in megapixels for the resolution label
+RESOLUTION_BUCKETS = ((2, 'le2MP'), (8, '2-8MP'), (16, '8-16MP'), (float('inf'), 'gt16MP'))
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted(self._series.items())
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in series]
+        for labels, counts, total, count in series:
+            base = ','.join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{base}}} {total}')
+            lines.append(f'{self.name}_count{{{base}}} {count}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+stage_seconds = Histogram('necrosis_stage_seconds', 'Time spent in each analysis pipeline stage.',
+                          ('stage', 'resolution'))
+request_seconds = Histogram('necrosis_request_seconds', 'Request latency per route.',
+                            ('view', 'method', 'status'))
+
+
+def enabled():
+    return settings.NECROSIS_METRICS_ENABLED
+
+
+def resolution_bucket(shape):
+    if shape is None:
+        return 'unknown'
+    megapixels = shape[0] * shape[1] / 1e6
+    for bound, label in RESOLUTION_BUCKETS:
+        if megapixels <= bound:
+            return label
+
+
+class _StageTimer:
+    __slots__ = ('stage', 'shape', 'start')
+
+    def __init__(self, stage, shape):
+        self.stage = stage
+        self.shape = shape
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_seconds.observe(time.perf_counter() - self.start, self.stage, resolution_bucket(self.shape))
+        return False
+
+
+def timer(stage, shape=None):
+    """
+    Context manager timing a pipeline stage for an image of ``shape``
+    (height, width). The shape can also be set on the timer inside the block.
+    """
+    if not enabled():
+        return _NOOP
+    return _StageTimer(stage, shape)
+
+
+def observe_stage(stage, seconds, shape=None):
+    if enabled():
+        stage_seconds.observe(seconds, stage, resolution_bucket(shape))
+
+
+class MetricsMiddleware:
+    """
+    Works in both sync and async stacks, so async views served over ASGI
+    are not pushed into a thread by this middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not enabled():
+            return self.get_response(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        if not enabled():
+            return await self.get_response(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    @staticmethod
+    def _observe(request, response, start):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        request_seconds.observe(time.perf_counter() - start, view, request.method, response.status_code)
+
+
+def render():
+    from .activity import activity_writer
+    from .result_cache import result_cache
+
+    lines = stage_seconds.render() + request_seconds.render()
+    cache_stats = result_cache.stats()
+    lines += ['# HELP necrosis_result_cache_total Result cache lookups by outcome.',
+              '# TYPE necrosis_result_cache_total counter',
+              f'necrosis_result_cache_total{{result="hit"}} {cache_stats["hits"]}',
+              f'necrosis_result_cache_total{{result="miss"}} {cache_stats["misses"]}']
+    activity = activity_writer.stats()
+    lines += ['# HELP necrosis_activity_events_total Audit events by outcome.',
+              '# TYPE necrosis_activity_events_total counter',
+              f'necrosis_activity_events_total{{result="written"}} {activity["written"]}',
+              f'necrosis_activity_events_total{{result="dropped"}} {activity["dropped"]}',
+              f'necrosis_activity_events_total{{result="rejected"}} {activity["rejected"]}',
+              '# HELP necrosis_activity_events_queued Audit events waiting to be written.',
+              '# TYPE necrosis_activity_events_queued gauge',
+              f'necrosis_activity_events_queued {activity["queued"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    if not enabled():
+        raise Http404('Metrics are disabled.')
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
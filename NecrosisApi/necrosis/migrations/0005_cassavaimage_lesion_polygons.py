@@ -0,0 +1,38 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+from necrosis.polygons import decode_polygons, encode_polygons
+
+
+def pack_lesion_polygons(apps, schema_editor):
+    CassavaImage = apps.get_model('necrosis', 'CassavaImage')
+    for img in CassavaImage.objects.exclude(metadata=None).iterator():
+        polygons = img.metadata.pop('necrosis_lesions', None)
+        if polygons is None:
+            continue
+        img.lesion_polygons = encode_polygons(polygons)
+        img.save(update_fields=['lesion_polygons', 'metadata'])
+
+
+def unpack_lesion_polygons(apps, schema_editor):
+    CassavaImage = apps.get_model('necrosis', 'CassavaImage')
+    for img in CassavaImage.objects.exclude(lesion_polygons=None).iterator():
+        img.metadata = {**(img.metadata or {}), 'necrosis_lesions': decode_polygons(img.lesion_polygons)}
+        img.save(update_fields=['metadata'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0004_analysistask_analysissession_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cassavaimage',
+            name='lesion_polygons',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(pack_lesion_polygons, unpack_lesion_polygons),
+    ]
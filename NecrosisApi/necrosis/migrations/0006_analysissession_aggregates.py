@@ -0,0 +1,55 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:35
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Min, Sum
+
+
+def fill_session_aggregates(apps, schema_editor):
+    AnalysisSession = apps.get_model('necrosis', 'AnalysisSession')
+    CassavaImage = apps.get_model('necrosis', 'CassavaImage')
+    rows = CassavaImage.objects.values('session').annotate(
+        count=Count('id'), total=Sum('necrosis_percentage'),
+        total_sq=Sum(F('necrosis_percentage') * F('necrosis_percentage')),
+        low=Min('necrosis_percentage'), high=Max('necrosis_percentage'), lesions=Sum('total_lesions'),
+    )
+    for row in rows.iterator():
+        AnalysisSession.objects.filter(id=row['session']).update(
+            num_images=row['count'], necrosis_sum=row['total'], necrosis_sum_sq=row['total_sq'],
+            necrosis_min=row['low'], necrosis_max=row['high'], total_lesions=row['lesions'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0005_cassavaimage_lesion_polygons'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysissession',
+            name='necrosis_max',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysissession',
+            name='necrosis_min',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysissession',
+            name='necrosis_sum',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysissession',
+            name='necrosis_sum_sq',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='analysissession',
+            name='total_lesions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_session_aggregates, migrations.RunPython.noop),
+    ]
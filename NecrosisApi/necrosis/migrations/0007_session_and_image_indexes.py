@@ -0,0 +1,25 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0006_analysissession_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='analysissession',
+            index=models.Index(fields=['user', '-created_at'], name='session_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysissession',
+            index=models.Index(fields=['session_id', 'user'], name='session_id_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cassavaimage',
+            index=models.Index(fields=['session', 'id'], name='image_session_id_idx'),
+        ),
+    ]
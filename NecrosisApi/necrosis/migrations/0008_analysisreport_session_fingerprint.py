@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0007_session_and_image_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisreport',
+            name='session_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
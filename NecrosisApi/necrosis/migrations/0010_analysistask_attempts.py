@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0009_useractivitylog_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysistask',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
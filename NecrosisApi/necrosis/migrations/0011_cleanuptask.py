@@ -0,0 +1,32 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0010_analysistask_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CleanupTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cleanup_id', models.CharField(max_length=32, unique=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('files', models.JSONField(default=list)),
+                ('files_deleted', models.PositiveIntegerField(blank=True, null=True)),
+                ('bytes_reclaimed', models.BigIntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cleanups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
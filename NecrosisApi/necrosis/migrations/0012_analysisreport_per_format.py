@@ -0,0 +1,23 @@
+# Generated by Django 5.1.15 on 2026-10-18 14:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('necrosis', '0011_cleanuptask'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='analysisreport',
+            name='session',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reports', to='necrosis.analysissession'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='analysisreport',
+            unique_together={('session', 'file_format')},
+        ),
+    ]
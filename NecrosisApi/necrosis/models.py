@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AbstractUser
 from django.db.models import JSONField
 from django.db import models
+from django.utils import timezone
 
 
 # Model to Store all user account information
@@ -41,13 +42,40 @@ class AnalysisSession(models.Model):
         num_images: Number of images analyzed in this session
         notes: Optional notes for the session
         session_name: User-editable session name
+        status: Processing state of the session's queued analysis jobs
+        necrosis_sum: Sum of the images' necrosis percentages
+        necrosis_sum_sq: Sum of the squared necrosis percentages
+        necrosis_min: Lowest necrosis percentage (null while empty)
+        necrosis_max: Highest necrosis percentage (null while empty)
+        total_lesions: Lesions counted over all images
+    Aggregates are maintained by necrosis.aggregates.
     """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
     user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='analysis_sessions')
     session_id = models.CharField(max_length=64, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     num_images = models.PositiveIntegerField()
     notes = models.TextField(blank=True, null=True)
     session_name = models.CharField(max_length=128, blank=True, null=True, help_text="User-editable session name")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='completed')
+    necrosis_sum = models.FloatField(default=0)
+    necrosis_sum_sq = models.FloatField(default=0)
+    necrosis_min = models.FloatField(blank=True, null=True)
+    necrosis_max = models.FloatField(blank=True, null=True)
+    total_lesions = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Session lists: a user's sessions, newest first
+            models.Index(fields=['user', '-created_at'], name='session_user_created_idx'),
+            # Session lookups by id, scoped to the requesting user
+            models.Index(fields=['session_id', 'user'], name='session_id_user_idx'),
+        ]
 
     def __str__(self):
         return f"Session {self.session_id} by {self.user.username}"
@@ -66,6 +94,7 @@ class CassavaImage(models.Model):
         necrosis_percentage: Percentage of necrosis
         confidence_score: Optional confidence score
         metadata: Additional metadata (JSON)
+        lesion_polygons: Lesion polygons in the compact binary format of necrosis.polygons
     """
     session = models.ForeignKey('AnalysisSession', on_delete=models.CASCADE, related_name='cassava_images')
     original_image = models.ImageField(upload_to='uploads/originals/')
@@ -76,29 +105,117 @@ class CassavaImage(models.Model):
     necrosis_percentage = models.FloatField()
     confidence_score = models.FloatField(blank=True, null=True)
     metadata = JSONField(blank=True, null=True)
+    lesion_polygons = models.BinaryField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # A session's images in id order, as the result cursor pages them
+            models.Index(fields=['session', 'id'], name='image_session_id_idx'),
+        ]
 
     def __str__(self):
         return self.image_name
 
+# Model acting as the broker table for queued image analysis jobs
+class AnalysisTask(models.Model):
+    """
+    One queued image analysis, picked up by the analysis workers.
+    Attributes:
+        session: ForeignKey to the AnalysisSession (job) the image belongs to
+        upload_path: Storage path of the stored upload
+        image_name: Name of the uploaded image
+        status: queued/running/done/failed
+        claim_token: Token of the worker batch that claimed the task
+        attempts: Number of times a worker claimed the task
+        error: Error message if processing failed
+        cassava_image: Resulting CassavaImage once processed
+        created_at: Timestamp of submission
+        started_at: Timestamp a worker claimed the task
+        finished_at: Timestamp processing finished
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    session = models.ForeignKey('AnalysisSession', on_delete=models.CASCADE, related_name='tasks')
+    upload_path = models.CharField(max_length=255)
+    image_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued', db_index=True)
+    claim_token = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    cassava_image = models.OneToOneField('CassavaImage', on_delete=models.SET_NULL, blank=True, null=True,
+                                         related_name='task')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Task {self.pk} ({self.status}) for Session {self.session.session_id}"
+
+# Model tracking background deletions of stored files
+class CleanupTask(models.Model):
+    """
+    A file deletion run in the background, polled by the client.
+    Attributes:
+        cleanup_id: Identifier returned to the client
+        user: ForeignKey to the User who started the cleanup
+        status: running/completed/failed
+        files: Storage names of the files to delete
+        files_deleted: Number of files deleted once finished
+        bytes_reclaimed: Total size of the deleted files once finished
+        error: Error message if the deletion failed
+        created_at: Timestamp the cleanup was accepted
+        started_at: Timestamp a process last started deleting the files
+        finished_at: Timestamp the deletion finished
+    Run by necrosis.cleanup.
+    """
+    STATUS_CHOICES = [
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    cleanup_id = models.CharField(max_length=32, unique=True)
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='cleanups')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='running')
+    files = JSONField(default=list)
+    files_deleted = models.PositiveIntegerField(blank=True, null=True)
+    bytes_reclaimed = models.BigIntegerField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Cleanup {self.cleanup_id} ({self.status})"
+
 # Model to generate downloadable result summaries for analysis sessions
 class AnalysisReport(models.Model):
     """
     Generates downloadable result summaries for analysis sessions.
     Attributes:
-        session: One-to-one link to AnalysisSession
+        session: ForeignKey to the AnalysisSession, one report per file format
         report_file: The generated report file (CSV/JSON/PDF)
         generated_at: Timestamp when the report was generated
         file_format: File format type (CSV, JSON, PDF, etc.)
-        checksum: Checksum for file verification
+        checksum: Checksum for file verification (SHA-256 of the file)
+        session_fingerprint: State of the session the report was built from
+    Reports are built by necrosis.reports.
     """
-    session = models.OneToOneField('AnalysisSession', on_delete=models.CASCADE, related_name='report')
+    session = models.ForeignKey('AnalysisSession', on_delete=models.CASCADE, related_name='reports')
     report_file = models.FileField(upload_to='reports/')
     generated_at = models.DateTimeField(auto_now_add=True)
     file_format = models.CharField(max_length=10)
     checksum = models.CharField(max_length=128)
+    session_fingerprint = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        unique_together = [('session', 'file_format')]
 
     def __str__(self):
-        return f"Report for Session {self.session.session_id}"
+        return f"{self.file_format} report for Session {self.session.session_id}"
 
 # Model to provide an audit trail of user actions
 class UserActivityLog(models.Model):
@@ -111,10 +228,11 @@ class UserActivityLog(models.Model):
         ip_address: IP address of the user
         device_info: Device information
         context_data: Additional context data (JSON)
+    Written in batches by necrosis.activity.
     """
     user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='activity_logs')
     activity_type = models.CharField(max_length=32)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
     ip_address = models.GenericIPAddressField(blank=True, null=True)
     device_info = models.CharField(max_length=255, blank=True, null=True)
     context_data = JSONField(blank=True, null=True)
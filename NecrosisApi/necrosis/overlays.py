@@ -0,0 +1,161 @@
+"""
+On-demand rendering of result overlays.
+
+Unless NECROSIS_EAGER_OVERLAYS is set, the analyze path no longer draws the
+lesion outlines onto every full resolution image and encodes the result as
+a PNG: most overlays are never looked at. Instead an overlay is drawn the
+first time it is requested, from the stored original and the image's lesion
+polygons, at the width asked for. The PNG is then kept in storage under
+overlays/<session pk>/ and served from there on later requests. File names
+include a hash of the original's name, so a reused image id never picks up
+a stale file. Only the NECROSIS_OVERLAY_WIDTHS can be requested, and widths
+at or above the original's are served the full size file, so each image
+has a bounded number of overlays on disk.
+
+Overlay URLs carry the image id signed with SECRET_KEY and timestamped.
+Like the public /media/results/ URLs they replace, they work in <img> tags
+without a token, but they cannot be guessed and they expire after
+NECROSIS_IMAGE_URL_MAX_AGE seconds.
+"""
+import hashlib
+import logging
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+from . import metrics
+from .ingest import DECODE_FLAGS
+from .polygons import EXPANDED, lesions_for
+from .utilities import draw_overlay
+
+logger = logging.getLogger(__name__)
+
+OVERLAY_DIR = 'overlays'
+# CassavaImage columns needed to render or serve an overlay
+OVERLAY_COLUMNS = ('session', 'image_name', 'original_image', 'processed_image', 'necrosis_percentage',
+                   'lesion_polygons', 'metadata')
+
+_signer = signing.TimestampSigner(salt='necrosis.overlays')
+
+
+def image_token(img):
+    return _signer.sign(str(img.pk))
+
+
+def overlay_url(request, img):
+    return request.build_absolute_uri(reverse('necrosis:image_overlay', args=[image_token(img)]))
+
+
+def unsign_image_id(token):
+    """
+    The image id of an image_token, or None when it was tampered with or
+    has expired.
+    """
+    try:
+        return int(_signer.unsign(token, max_age=settings.NECROSIS_IMAGE_URL_MAX_AGE))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def session_overlays(session_pk):
+    """
+    Storage names of the overlays rendered for a session.
+    """
+    directory = f'{OVERLAY_DIR}/{session_pk}'
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [f'{directory}/{name}' for name in files]
+
+
+def overlay_image(img, width=None):
+    """
+    The overlay of a CassavaImage as a BGR array, scaled down to ``width``
+    pixels when the original is wider. None when the original cannot be
+    decoded.
+    """
+    with default_storage.open(img.original_image.name, 'rb') as f:
+        image = cv2.imdecode(np.frombuffer(f.read(), np.uint8), DECODE_FLAGS)
+    if image is None:
+        return None
+    height, full_width = image.shape[:2]
+    scale = 1.0
+    if width and width < full_width:
+        scale = width / full_width
+        image = cv2.resize(image, (width, max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    with metrics.timer('overlay', image.shape[:2]):
+        # Polygons are normalized, scale them to the rendered size
+        size = np.array([image.shape[1], image.shape[0]], dtype=np.float64)
+        polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) * size
+                    for p in (lesions_for(img, EXPANDED) or {}).values()]
+        draw_overlay(image, polygons, img.necrosis_percentage, scale=scale)
+    return image
+
+
+def render_overlay(img, width=None):
+    """
+    PNG bytes of overlay_image, or None.
+    """
+    image = overlay_image(img, width)
+    if image is None:
+        return None
+    with metrics.timer('image_write', image.shape[:2]):
+        ok, encoded = cv2.imencode('.png', image)
+    return encoded.tobytes() if ok else None
+
+
+def _original_width(img):
+    """
+    Width of the stored original, read from its header; 0 when unknown.
+    """
+    try:
+        return img.original_image.width or 0
+    except (OSError, ValueError):
+        return 0
+
+
+def overlay_file(img, width=None):
+    """
+    Storage name of the overlay of ``img`` at ``width`` (full size when
+    None or not narrower than the original), rendered and stored first if
+    needed. None when the original is no longer available.
+    """
+    if not img.original_image:
+        return None
+    if width and width >= _original_width(img):
+        width = None
+    original = hashlib.sha256(img.original_image.name.encode()).hexdigest()[:12]
+    name = f"{OVERLAY_DIR}/{img.session_id}/{img.pk}-{original}-{width or 'full'}.png"
+    if default_storage.exists(name):
+        return name
+    try:
+        png = render_overlay(img, width)
+    except FileNotFoundError:
+        logger.warning('Original of image %s is missing, cannot render its overlay', img.pk)
+        return None
+    if png is None:
+        return None
+    # Another request may have rendered it meanwhile
+    if default_storage.exists(name):
+        return name
+    return default_storage.save(name, ContentFile(png))
+
+
+def zip_entries(images):
+    """
+    (entry name, path) pairs for stream_zip: the eagerly written overlay of
+    each image if there is one, else its rendered full size overlay.
+    """
+    for img in images:
+        if img.processed_image:
+            yield img.image_name or img.processed_image.name.split('/')[-1], img.processed_image.path
+            continue
+        name = overlay_file(img)
+        if name:
+            yield img.image_name or name.split('/')[-1], default_storage.path(name)
@@ -0,0 +1,41 @@
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+
+
+class SessionCursorPagination(CursorPagination):
+    ordering = '-created_at'
+    page_size = settings.NECROSIS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.NECROSIS_MAX_PAGE_SIZE
+
+
+class ImageCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = settings.NECROSIS_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.NECROSIS_MAX_PAGE_SIZE
+
+
+def wants_pagination(request):
+    """
+    Pagination is opt-in so existing clients keep getting complete lists:
+    it applies once a request carries a cursor or a page_size.
+    """
+    return 'cursor' in request.query_params or 'page_size' in request.query_params
+
+
+def selected_fields(request, available):
+    """
+    Fields requested through ?fields=a,b,c, in the order given, or all
+    ``available`` fields when the parameter is absent.
+    """
+    value = request.query_params.get('fields')
+    if not value:
+        return list(available)
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ValidationError({'fields': f'Unknown fields: {", ".join(unknown)}. '
+                                         f'Available: {", ".join(available)}.'})
+    return fields
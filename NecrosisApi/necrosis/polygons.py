@@ -0,0 +1,76 @@
+"""
+Compact binary encoding of lesion polygons.
+
+Lesion polygons are normalized (xyn) coordinates in [0, 1], keyed by the
+model's box index. Instead of JSON float lists they are stored as:
+
+    uint16  number of polygons
+    per polygon: uint16 box index, uint32 number of points
+    all points: uint16 x, uint16 y, quantized as round(v * 65535)
+
+All values are little endian. The quantization step is 1/65535 of the image
+side, well under a pixel even for 20+ MP images. API clients get this blob
+base64 encoded when they ask for the compact form.
+"""
+import base64
+import struct
+
+import numpy as np
+
+QUANT_SCALE = 65535
+COMPACT = 'compact'
+EXPANDED = 'expanded'
+POLYGON_FORMATS = (EXPANDED, COMPACT)
+
+_COUNT = struct.Struct('<H')
+_ENTRY = struct.Struct('<HI')
+
+
+def encode_polygons(polygons):
+    """
+    Packs a {box_index: [[x, y], ...]} dict of normalized polygons into bytes.
+    """
+    header = [_COUNT.pack(len(polygons))]
+    points = []
+    for key, polygon in polygons.items():
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        header.append(_ENTRY.pack(int(key), len(polygon)))
+        points.append(np.round(np.clip(polygon, 0, 1) * QUANT_SCALE).astype('<u2'))
+    body = np.concatenate(points).tobytes() if points else b''
+    return b''.join(header) + body
+
+
+def decode_polygons(blob):
+    """
+    Unpacks bytes from encode_polygons back into a {box_index: [[x, y], ...]} dict.
+    """
+    blob = bytes(blob)
+    (count,) = _COUNT.unpack_from(blob, 0)
+    offset = _COUNT.size
+    entries = []
+    for _ in range(count):
+        entries.append(_ENTRY.unpack_from(blob, offset))
+        offset += _ENTRY.size
+    coords = np.frombuffer(blob, dtype='<u2', offset=offset).reshape(-1, 2) / QUANT_SCALE
+    polygons = {}
+    start = 0
+    for key, length in entries:
+        polygons[str(key)] = coords[start:start + length].tolist()
+        start += length
+    return polygons
+
+
+def lesions_for(img, polygon_format=EXPANDED):
+    """
+    Lesion polygons of a CassavaImage in the requested form. Rows written
+    before the binary field existed keep their polygons in metadata.
+    """
+    blob = img.lesion_polygons
+    if blob is None:
+        polygons = img.metadata.get('necrosis_lesions') if img.metadata else None
+        if polygons is None or polygon_format == EXPANDED:
+            return polygons
+        blob = encode_polygons(polygons)
+    if polygon_format == COMPACT:
+        return base64.b64encode(bytes(blob)).decode('ascii')
+    return decode_polygons(blob)
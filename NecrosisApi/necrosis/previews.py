@@ -0,0 +1,210 @@
+"""
+Downscaled previews of result images for galleries.
+
+Every CassavaImage can have WebP (or JPEG, see NECROSIS_PREVIEW_FORMAT)
+previews of its original ('original') and of its overlay ('overlay') at
+each of the fixed NECROSIS_PREVIEW_WIDTHS. A preview is made the first time
+it is asked for, or right after analysis when NECROSIS_PREVIEWS_IN_BACKGROUND
+is set, and stored as
+
+    previews/<session pk>/<image pk>/<kind>-<width>-<content hash>.<ext>
+
+The size URL, /api/previews/<token>/<kind>/<width>/, redirects to the file's
+content-hashed URL, /api/previews/<image id>/<signature>/<file name>. Unlike
+overlay URLs, neither is timestamped: the size URL signs the image id and
+the hashed URL signs the image id with the file name, so the same preview
+always has the same URLs and browsers can cache them across requests. A
+hashed URL never changes content, so it is served with a one year immutable
+cache lifetime. Both stop working once the image is deleted.
+
+Large JPEG originals are downscaled by libjpeg while decoding (by 2, 4 or
+8) when the preview is small enough, which saves most of the decode time.
+"""
+import hashlib
+import io
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from PIL import Image
+
+from .models import CassavaImage
+from .overlays import OVERLAY_COLUMNS, overlay_image
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR = 'previews'
+ORIGINAL = 'original'
+OVERLAY = 'overlay'
+KINDS = (ORIGINAL, OVERLAY)
+# Extension, cv2 quality flag and content type of each preview format
+FORMATS = {
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+}
+PREVIEW_NAME = re.compile(r'^(original|overlay)-\d+-[0-9a-f]{16}\.(webp|jpg)$')
+_REDUCED_DECODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                    (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+_signer = signing.Signer(salt='necrosis.previews')
+
+_executor = ThreadPoolExecutor(max_workers=settings.NECROSIS_PREVIEW_THREADS, thread_name_prefix='necrosis-previews')
+
+
+def preview_token(img):
+    return _signer.sign(str(img.pk))
+
+
+def unsign_preview_id(token):
+    """
+    The image id of a preview_token, or None when it was tampered with.
+    """
+    try:
+        return int(_signer.unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def file_signature(image_id, name):
+    return _signer.signature(f'{image_id}/{name}')
+
+
+def valid_file_signature(image_id, name, signature):
+    return constant_time_compare(signature, file_signature(image_id, name))
+
+
+def preview_dir(img):
+    return f'{PREVIEW_DIR}/{img.session_id}/{img.pk}'
+
+
+def content_type(name):
+    return next(ctype for ext, _, ctype in FORMATS.values() if name.endswith(ext))
+
+
+def session_previews(session_pk):
+    """
+    Storage names of the previews made for a session's images.
+    """
+    directory = f'{PREVIEW_DIR}/{session_pk}'
+    try:
+        image_dirs, _ = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return []
+    names = []
+    for image_dir in image_dirs:
+        _, files = default_storage.listdir(f'{directory}/{image_dir}')
+        names += [f'{directory}/{image_dir}/{name}' for name in files]
+    return names
+
+
+def _decode(name, width):
+    """
+    Decodes a stored image, letting the decoder shrink it by 2, 4 or 8 when
+    it stays at least ``width`` pixels wide.
+    """
+    with default_storage.open(name, 'rb') as f:
+        data = f.read()
+    try:
+        # Only the header is parsed here
+        full_width = Image.open(io.BytesIO(data)).size[0]
+    except OSError:
+        return None
+    flag = next((reduced for factor, reduced in _REDUCED_DECODES if full_width // factor >= width),
+                cv2.IMREAD_COLOR)
+    # Same orientation as the image the polygons were found on
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flag | cv2.IMREAD_IGNORE_ORIENTATION)
+
+
+def _source_image(img, kind, width):
+    if kind == ORIGINAL:
+        return _decode(img.original_image.name, width)
+    if img.processed_image and default_storage.exists(img.processed_image.name):
+        return _decode(img.processed_image.name, width)
+    return overlay_image(img, width) if img.original_image else None
+
+
+def preview_file(img, kind, width):
+    """
+    Storage name of the ``kind`` preview of ``img`` at ``width`` pixels,
+    made and stored first if needed. None when its source image is gone.
+    """
+    if not (img.original_image or (kind == OVERLAY and img.processed_image)):
+        return None
+    directory = preview_dir(img)
+    prefix = f'{kind}-{width}-'
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        files = []
+    existing = next((name for name in files if name.startswith(prefix)), None)
+    if existing:
+        return f'{directory}/{existing}'
+    try:
+        image = _source_image(img, kind, width)
+    except FileNotFoundError:
+        logger.warning('Source of the %s preview of image %s is missing', kind, img.pk)
+        return None
+    if image is None:
+        return None
+    height, full_width = image.shape[:2]
+    if full_width > width:
+        image = cv2.resize(image, (width, max(1, round(height * width / full_width))), interpolation=cv2.INTER_AREA)
+    extension, quality, _ = FORMATS[settings.NECROSIS_PREVIEW_FORMAT]
+    ok, encoded = cv2.imencode(extension, image, [quality, settings.NECROSIS_PREVIEW_QUALITY])
+    if not ok:
+        return None
+    data = encoded.tobytes()
+    name = f'{directory}/{prefix}{hashlib.sha256(data).hexdigest()[:16]}{extension}'
+    if default_storage.exists(name):
+        return name
+    return default_storage.save(name, ContentFile(data))
+
+
+def preview_urls(request, img):
+    """
+    Size URLs of the previews an image can have, as {kind: {width: url}},
+    or None once its files are deleted.
+    """
+    kinds = KINDS if img.original_image else (OVERLAY,) if img.processed_image else ()
+    if not kinds:
+        return None
+    token = preview_token(img)
+    return {
+        kind: {str(width): request.build_absolute_uri(reverse('necrosis:image_preview', args=[token, kind, width]))
+               for width in settings.NECROSIS_PREVIEW_WIDTHS}
+        for kind in kinds
+    }
+
+
+def generate_previews(image_ids):
+    """
+    Makes every preview of the given images; runs on the preview executor.
+    """
+    try:
+        for img in CassavaImage.objects.only(*OVERLAY_COLUMNS).filter(pk__in=image_ids):
+            for kind in KINDS:
+                for width in settings.NECROSIS_PREVIEW_WIDTHS:
+                    preview_file(img, kind, width)
+    except Exception:
+        logger.exception('Could not make the previews of images %s', image_ids)
+    finally:
+        connections.close_all()
+
+
+def schedule_previews(images):
+    """
+    Queues generate_previews for ``images`` once the current transaction
+    commits, when NECROSIS_PREVIEWS_IN_BACKGROUND is set.
+    """
+    if settings.NECROSIS_PREVIEWS_IN_BACKGROUND:
+        image_ids = [img.pk for img in images]
+        transaction.on_commit(lambda: _executor.submit(generate_previews, image_ids))
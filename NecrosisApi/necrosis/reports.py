@@ -0,0 +1,211 @@
+"""
+Downloadable session reports, stored as the session's AnalysisReport of
+each format.
+
+build_report writes a session's CassavaImage rows to a CSV, JSON Lines or
+Parquet file. The rows are read CHUNK_SIZE at a time (a server-side cursor on
+PostgreSQL) and written to a temporary file as they arrive, and the SHA-256
+checksum is updated with every write. Memory therefore stays flat even for
+sessions with tens of thousands of images. The temporary file sits next to
+its final name, reports/session_<session id><ext>, and is moved there with
+os.replace while the report's row is locked. Concurrent builds of the same
+report are serialized on that lock. Each opens the file it moved in before
+releasing the lock, and keeps reading it even after a later build replaced
+it.
+
+Each report records the fingerprint of the session state it was built from:
+the count, highest id and sums of the session's images, taken in one
+aggregate query. A session keeps one report per format, so session_report
+serves each stored report while the fingerprint matches and builds a new one
+once the session changed, whatever other formats were asked for meanwhile.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+from itertools import islice
+from types import SimpleNamespace
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .models import AnalysisReport, CassavaImage
+from .polygons import EXPANDED, lesions_for
+
+logger = logging.getLogger(__name__)
+
+# Bump when the report layout changes, so stored reports are rebuilt
+REPORT_VERSION = 1
+CHUNK_SIZE = 2000
+
+CSV = 'csv'
+JSONL = 'jsonl'
+PARQUET = 'parquet'
+# Extension and content type of each format
+FORMATS = {
+    CSV: ('.csv', 'text/csv'),
+    JSONL: ('.jsonl', 'application/x-ndjson'),
+    PARQUET: ('.parquet', 'application/vnd.apache.parquet'),
+}
+COLUMNS = ('image_id', 'filename', 'uploaded_at', 'percentage_necrosis', 'lesion_count', 'confidence_score')
+_IMAGE_FIELDS = ('id', 'image_name', 'uploaded_at', 'necrosis_percentage', 'total_lesions', 'confidence_score')
+
+
+class _HashingWriter:
+    """
+    Binary file wrapper hashing everything written through it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        # The temporary file is closed by build_report
+        self.closed = True
+
+
+def _rows(session, with_lesions=False):
+    """
+    The session's images as tuples of COLUMNS values (plus the lesion
+    polygons with ``with_lesions``), read from the database in chunks.
+    """
+    fields = _IMAGE_FIELDS + (('lesion_polygons', 'metadata') if with_lesions else ())
+    images = CassavaImage.objects.filter(session=session).order_by('id').values_list(*fields)
+    for row in images.iterator(chunk_size=CHUNK_SIZE):
+        if with_lesions:
+            polygons = SimpleNamespace(lesion_polygons=row[-2], metadata=row[-1])
+            row = row[:-2] + (lesions_for(polygons, EXPANDED),)
+        yield row
+
+
+def _write_csv(session, out):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    rows = _rows(session)
+    while chunk := list(islice(rows, CHUNK_SIZE)):
+        writer.writerows((*row[:2], row[2].isoformat(), *row[3:]) for row in chunk)
+        out.write(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+    out.write(buffer.getvalue().encode())
+
+
+def _write_jsonl(session, out):
+    for row in _rows(session, with_lesions=True):
+        record = dict(zip(COLUMNS, row), uploaded_at=row[2].isoformat(), necrosis_lesions=row[-1])
+        out.write((json.dumps(record) + '\n').encode())
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured('Parquet reports need pyarrow installed')
+    return pyarrow
+
+
+def _write_parquet(session, out):
+    pa = _pyarrow()
+    schema = pa.schema([
+        ('image_id', pa.int64()),
+        ('filename', pa.string()),
+        ('uploaded_at', pa.timestamp('us', tz='UTC')),
+        ('percentage_necrosis', pa.float64()),
+        ('lesion_count', pa.int64()),
+        ('confidence_score', pa.float64()),
+    ])
+    rows = _rows(session)
+    with pa.parquet.ParquetWriter(pa.PythonFile(out, mode='w'), schema) as writer:
+        # One row group per chunk
+        while chunk := list(islice(rows, CHUNK_SIZE)):
+            writer.write_batch(pa.RecordBatch.from_pylist([dict(zip(COLUMNS, row)) for row in chunk],
+                                                          schema=schema))
+
+
+WRITERS = {CSV: _write_csv, JSONL: _write_jsonl, PARQUET: _write_parquet}
+
+
+def session_fingerprint(session):
+    images = CassavaImage.objects.filter(session=session).aggregate(
+        count=Count('id'), last=Max('id'), necrosis=Sum('necrosis_percentage'), lesions=Sum('total_lesions'),
+    )
+    state = [REPORT_VERSION, images['count'], images['last'], images['necrosis'], images['lesions']]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+
+def build_report(session, file_format, fingerprint=None):
+    """
+    Writes the ``file_format`` report of ``session`` to storage and records
+    it as the session's AnalysisReport of that format, replacing any earlier
+    one. Returns the report and an open binary handle on the file built.
+    """
+    if file_format == PARQUET:
+        _pyarrow()
+    fingerprint = fingerprint or session_fingerprint(session)
+    extension, _ = FORMATS[file_format]
+    name = default_storage.generate_filename(f'reports/session_{session.session_id}{extension}')
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.build-', suffix=extension, delete=False)
+    try:
+        with f:
+            out = _HashingWriter(f)
+            WRITERS[file_format](session, out)
+        with transaction.atomic():
+            # The report's row stays locked until this block commits
+            previous = AnalysisReport.objects.select_for_update().filter(
+                session=session, file_format=file_format).values_list('report_file', flat=True).first()
+            report, _ = AnalysisReport.objects.update_or_create(session=session, file_format=file_format, defaults={
+                'report_file': name,
+                'checksum': out.digest.hexdigest(),
+                'session_fingerprint': fingerprint,
+                'generated_at': timezone.now(),
+            })
+            os.replace(f.name, path)
+            handle = default_storage.open(name, 'rb')
+    finally:
+        # Only left behind when the build failed
+        if os.path.exists(f.name):
+            os.remove(f.name)
+    if previous and previous != name:
+        default_storage.delete(previous)
+    logger.info('Built %s report of session %s, %d bytes', file_format, session.session_id, out.size)
+    return report, handle
+
+
+def session_report(session, file_format):
+    """
+    The session's ``file_format`` report and an open binary handle on its
+    file: the stored one while the session is unchanged, else a freshly
+    built one.
+    """
+    fingerprint = session_fingerprint(session)
+    report = AnalysisReport.objects.filter(session=session, file_format=file_format).first()
+    if report is not None and report.session_fingerprint == fingerprint and report.report_file:
+        try:
+            return report, report.report_file.open('rb')
+        except FileNotFoundError:
+            pass
+    return build_report(session, file_format, fingerprint)
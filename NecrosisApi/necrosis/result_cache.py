@@ -0,0 +1,240 @@
+"""
+Content-hash cache of analysis results.
+
+Entries are keyed by the SHA-256 of the image bytes combined with the hash of
+the model weights and of the RESULT_SETTINGS, so re-uploads of the same photo
+skip inference while a new model, or a change to tiling or area measuring,
+invalidates everything. Each entry is a JSON file (necrosis percentage,
+lesion count, lesion polygons) plus the rendered overlay PNG when one was
+drawn (see NECROSIS_EAGER_OVERLAYS). The directory is
+kept under a size limit by evicting least recently used entries, using file
+modification times as the recency marker. A running byte total avoids
+walking the directory on every put: it is only scanned once the total
+passes EVICT_HIGH_WATER times the limit, and then trimmed down to
+EVICT_LOW_WATER times it. The scan also picks up what other processes wrote.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+
+from .backends import backend_label
+from .utilities import img_results_dir, process_images_batch
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+EVICT_HIGH_WATER = 1.1
+EVICT_LOW_WATER = 0.9
+# Settings that change the polygons or percentages of a result
+RESULT_SETTINGS = ('NECROSIS_TILED_INFERENCE', 'NECROSIS_TILE_SIZE', 'NECROSIS_TILE_OVERLAP',
+                   'NECROSIS_TILE_MIN_PIXELS', 'NECROSIS_AREA_METHOD')
+
+_weights_digest = None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_replacing(path, write):
+    """
+    Calls ``write`` on a new file next to ``path``, named uniquely so that
+    concurrent writers of the same entry do not share it, then moves it over
+    ``path``. The temporary file is removed if anything fails.
+    """
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.put-', suffix='.tmp', delete=False)
+    try:
+        with f:
+            write(f)
+        os.replace(f.name, path)
+    finally:
+        # Only left behind when the write failed
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def weights_digest():
+    """
+    Hash of the model weights and the backend running them (exports give
+    slightly different results), computed once per process.
+    """
+    global _weights_digest
+    if _weights_digest is None:
+        try:
+            digest = file_digest(settings.NECROSIS_MODEL_PATH)
+        except OSError:
+            # Weights only reachable from the inference server: fall back to the path
+            digest = hashlib.sha256(str(settings.NECROSIS_MODEL_PATH).encode()).hexdigest()
+        _weights_digest = hashlib.sha256(f'{digest}:{backend_label()}'.encode()).hexdigest()
+    return _weights_digest
+
+
+def settings_digest():
+    """
+    Hash of the RESULT_SETTINGS values, read on every call.
+    """
+    values = ':'.join(f'{name}={getattr(settings, name)!r}' for name in RESULT_SETTINGS)
+    return hashlib.sha256(values.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Bytes in the directory as far as this process knows, None until scanned
+        self._bytes = None
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def key(self, image_digest):
+        return hashlib.sha256(f'{image_digest}:{weights_digest()}:{settings_digest()}'.encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.json', base + '.png'
+
+    def get(self, key, need_overlay=False):
+        """
+        Returns the cached entry (with the overlay path under 'overlay') or
+        None. With ``need_overlay``, an entry without an overlay PNG is a miss.
+        """
+        json_path, overlay_path = self._paths(key)
+        try:
+            with open(json_path) as f:
+                entry = json.load(f)
+            has_overlay = os.path.exists(overlay_path)
+            if need_overlay and not has_overlay:
+                raise FileNotFoundError(overlay_path)
+            os.utime(json_path)
+            if has_overlay:
+                os.utime(overlay_path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        entry['overlay'] = overlay_path
+        return entry
+
+    def put(self, key, percentage_necrosis, lesion_count, necrosis_lesions, overlay_path=None):
+        os.makedirs(self.directory, exist_ok=True)
+        json_path, cached_overlay = self._paths(key)
+        entry = {
+            'percentage_necrosis': percentage_necrosis,
+            'lesion_count': lesion_count,
+            'necrosis_lesions': necrosis_lesions,
+        }
+        paths = (json_path, cached_overlay) if overlay_path else (json_path,)
+        replaced = sum(_size(path) for path in paths)
+        # Write to temporary files first so readers never see partial entries
+        if overlay_path:
+            with open(overlay_path, 'rb') as source:
+                _write_replacing(cached_overlay, lambda f: shutil.copyfileobj(source, f))
+        _write_replacing(json_path, lambda f: f.write(json.dumps(entry).encode()))
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += sum(_size(path) for path in paths) - replaced
+            scan = self._bytes is None or self._bytes > self.max_bytes * EVICT_HIGH_WATER
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """
+        Scans the directory and, when it holds more than max_bytes, removes
+        least recently used entries until it is down to EVICT_LOW_WATER
+        times that. Skipped while another thread is already evicting.
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._evict()
+        finally:
+            self._evict_lock.release()
+
+    def _evict(self):
+        entries = {}
+        for item in os.scandir(self.directory):
+            key, ext = os.path.splitext(item.name)
+            if ext not in ('.json', '.png'):
+                continue
+            stat = item.stat()
+            size, used = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+        total = sum(size for size, _ in entries.values())
+        if total > self.max_bytes:
+            for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+                if total <= self.max_bytes * EVICT_LOW_WATER:
+                    break
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+        with self._lock:
+            self._bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+result_cache = ResultCache(settings.NECROSIS_RESULT_CACHE_DIR, settings.NECROSIS_RESULT_CACHE_MAX_BYTES)
+
+
+def cached_process_images(img_paths, mdl, batch_size=8, cache=None, names=None, digests=None, render=True,
+                          load=None):
+    """
+    process_images_batch with the result cache in front of it: images seen
+    before (same bytes, same weights) are served from the cache and only the
+    misses go through the model. For decoded arrays, pass their file
+    ``names`` and the ``digests`` of their encoded bytes. ``render`` and
+    ``load`` are passed on to process_images_batch; entries without an
+    overlay count as misses when one is needed.
+    Returns process_image_v2 style tuples.
+    """
+    cache = cache or result_cache
+    if not settings.NECROSIS_RESULT_CACHE_ENABLED:
+        return process_images_batch(img_paths, mdl, batch_size=batch_size, names=names, render=render, load=load)
+    names = names or [os.path.basename(p) for p in img_paths]
+    digests = digests or [file_digest(path) for path in img_paths]
+    keys = [cache.key(digest) for digest in digests]
+    processed = [None] * len(img_paths)
+    misses = []
+    for i, (name, key) in enumerate(zip(names, keys)):
+        entry = cache.get(key, need_overlay=render)
+        if entry is None:
+            misses.append(i)
+            continue
+        result_name = name.replace('.jpg', '.png')
+        if render:
+            shutil.copyfile(entry['overlay'], os.path.join(img_results_dir, result_name))
+        processed[i] = (entry['percentage_necrosis'], result_name, entry['lesion_count'], entry['necrosis_lesions'])
+    if misses:
+        fresh = process_images_batch([img_paths[i] for i in misses], mdl, batch_size=batch_size,
+                                     names=[names[i] for i in misses], render=render, load=load)
+        for i, res in zip(misses, fresh):
+            processed[i] = res
+            cache.put(keys[i], res[0], res[2], res[3], os.path.join(img_results_dir, res[1]) if render else None)
+    logger.debug('Result cache: %s', cache.stats())
+    return processed
@@ -57,3 +57,11 @@ class AnalysisSessionSerializer(serializers.ModelSerializer):
         model = AnalysisSession
         fields = ['session_id', 'created_at', 'num_images', 'notes', 'session_name']
         read_only_fields = ['session_id', 'created_at', 'num_images', 'notes']
+
+    def update(self, instance, validated_data):
+        # Only write the edited columns so the aggregates maintained by
+        # necrosis.aggregates are never overwritten with stale values
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
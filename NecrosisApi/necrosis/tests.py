@@ -1,3 +1,1351 @@
-from django.test import TestCase
+import base64
+import csv
+import hashlib
+import importlib.util
+import json
+import io
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.testing import ApplicationCommunicator
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from .aggregates import add_images, session_summary
+from .authentication import TokenCache, token_cache
+from .areas import necrosis_areas, polygon_area, raster_area, union_area
+from . import activity, cleanup, previews, reports
+from .activity import ActivityLogWriter
+from .backends import DecodingModel, compare_backends, weights_path
+from .benchmarks import compare_to_baseline, fillpoly_areas, isolated_environment, synthetic_polygons
+from .executor import InferenceExecutor
+from .inference_server import InferenceClient, InferenceServer, _take_jobs, inference_authkey
+from .ingest import ingest_upload
+from .jobs import claim_tasks, run_tasks
+from .overlays import overlay_image
+from . import metrics
+from .models import User, AnalysisReport, AnalysisSession, AnalysisTask, CassavaImage, CleanupTask, \
+    UserActivityLog
+from .polygons import decode_polygons, encode_polygons
+from .result_cache import ResultCache, cached_process_images, file_digest
+from .tiling import TiledModel, tile_boxes
+from .utilities import Detections, process_images_batch
+from .zipstream import stream_zip
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp()
+
+# Audit events queue up here and are only written when a test flushes them:
+# the flusher thread's connection cannot see the tests' uncommitted rows
+_activity_patcher = mock.patch('necrosis.activity.activity_writer',
+                               ActivityLogWriter(batch_size=10 ** 6, flush_interval=3600))
+
+
+def setUpModule():
+    _activity_patcher.start()
+
+
+def tearDownModule():
+    _activity_patcher.stop()
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+class UserTestCase(TestCase):
+    """
+    Creates the 'tester' user and its token, with self.client authenticated
+    by that token.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='tester', email='tester@example.com', password='pass1234')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+
+class AnalysisTestCase(UserTestCase):
+    """
+    UserTestCase with a CountingModel (self.model) in place of the views'
+    model and result files written under TEST_MEDIA_ROOT. Rendered overlays
+    and previews are removed after each test.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.model = CountingModel()
+        results_dir = os.path.join(TEST_MEDIA_ROOT, 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        for patcher in (mock.patch('necrosis.views.model', self.model),
+                        mock.patch('necrosis.utilities.img_results_dir', results_dir)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for directory in ('overlays', 'previews'):
+            self.addCleanup(shutil.rmtree, os.path.join(TEST_MEDIA_ROOT, directory), ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class AnalysisJobTests(UserTestCase):
+    def submit(self, count=2):
+        files = [SimpleUploadedFile(f'root{i}.jpg', b'not-an-image', content_type='image/jpeg') for i in range(count)]
+        return self.client.post('/api/analyze/jobs/', {'images': files}, format='multipart')
+
+    def test_submit_queues_one_task_per_image(self):
+        response = self.submit(3)
+        self.assertEqual(response.status_code, 202)
+        session = AnalysisSession.objects.get(session_id=response.data['job_id'])
+        self.assertEqual(session.status, 'queued')
+        self.assertEqual(session.tasks.filter(status='queued').count(), 3)
+
+    def test_claimed_tasks_are_not_claimed_twice(self):
+        self.submit(3)
+        first = claim_tasks(2)
+        second = claim_tasks(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({t.id for t in first} & {t.id for t in second})
+        self.assertEqual(AnalysisTask.objects.filter(status='running').count(), 3)
+
+    def test_status_reports_progress_per_image(self):
+        job_id = self.submit(2).data['job_id']
+        claim_tasks(1)
+        response = self.client.get(f'/api/analyze/jobs/{job_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'running')
+        self.assertEqual(response.data['progress']['running'], 1)
+        self.assertEqual(response.data['progress']['queued'], 1)
+        self.assertEqual([img['filename'] for img in response.data['images']], ['root0.jpg', 'root1.jpg'])
+
+    @override_settings(NECROSIS_JOB_LEASE_SECONDS=60, NECROSIS_JOB_MAX_ATTEMPTS=2)
+    def test_expired_leases_are_requeued_then_failed(self):
+        job_id = self.submit(1).data['job_id']
+        crashed = claim_tasks(1)
+        self.assertEqual(claim_tasks(1), [])
+        AnalysisTask.objects.update(started_at=timezone.now() - timedelta(seconds=61))
+        retried = claim_tasks(1)
+        self.assertEqual([(task.id, task.attempts) for task in retried], [(crashed[0].id, 2)])
+        # The crashed worker lost the task and cannot record a result any more
+        run_tasks(crashed, CountingModel(), batch_size=1)
+        self.assertEqual(AnalysisTask.objects.get().claim_token, retried[0].claim_token)
+        self.assertEqual(AnalysisTask.objects.get().status, 'running')
+        AnalysisTask.objects.update(started_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(claim_tasks(1), [])
+        task = AnalysisTask.objects.get()
+        self.assertEqual(task.status, 'failed')
+        self.assertEqual(AnalysisSession.objects.get(session_id=job_id).status, 'failed')
+
+
+    @override_settings(NECROSIS_RESULT_CACHE_ENABLED=False)
+    def test_rotated_uploads_keep_the_pixel_frame_of_their_overlay(self):
+        from PIL import Image as PILImage
+
+        photo = io.BytesIO()
+        exif = PILImage.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+        PILImage.new('RGB', (60, 40)).save(photo, 'JPEG', exif=exif)
+        upload = SimpleUploadedFile('phone.jpg', photo.getvalue(), content_type='image/jpeg')
+        self.client.post('/api/analyze/jobs/', {'images': [upload]}, format='multipart')
+
+        def model(sources):
+            # Reads paths itself like ultralytics, which applies the EXIF orientation
+            images = [source if isinstance(source, np.ndarray) else cv2.imread(source) for source in sources]
+            lesion = np.array([[5, 5], [35, 5], [35, 35], [5, 35]], dtype=np.float32)
+            return [Detections([0, 1], [np.array([[0, 0], [img.shape[1], 0], [img.shape[1], img.shape[0]],
+                                                  [0, img.shape[0]]], dtype=np.float32), lesion], img)
+                    for img in images]
+
+        run_tasks(claim_tasks(1), DecodingModel(model), batch_size=1)
+        image = CassavaImage.objects.get()
+        overlay = overlay_image(image)
+        self.assertEqual(overlay.shape[:2], (40, 60))
+        lesion = np.asarray(decode_polygons(image.lesion_polygons)['1']) * [overlay.shape[1], overlay.shape[0]]
+        np.testing.assert_allclose(lesion.min(axis=0), [5, 5], atol=0.5)
+        np.testing.assert_allclose(lesion.max(axis=0), [35, 35], atol=0.5)
+
+    def test_tasks_of_a_deleted_session_are_dropped_with_their_uploads(self):
+        job_id = self.submit(2).data['job_id']
+        claimed = claim_tasks(2)
+        uploads = [task.upload_path for task in claimed]
+        self.assertTrue(all(default_storage.exists(name) for name in uploads))
+        self.assertEqual(self.client.delete(f'/api/sessions/{job_id}/').status_code, 204)
+        self.assertFalse(any(default_storage.exists(name) for name in uploads))
+        model = CountingModel()
+        run_tasks(claimed, model, batch_size=2)
+        self.assertEqual(model.calls, 0)
+        self.assertFalse(CassavaImage.objects.exists())
+
+class WorkStealingTests(SimpleTestCase):
+    def test_idle_replica_steals_from_busy_queue(self):
+        queues = [queue.Queue(), queue.Queue()]
+        for job_id in range(3):
+            queues[0].put((job_id, f'img{job_id}.jpg'))
+        self.assertEqual([job_id for job_id, _ in _take_jobs(1, queues, batch_size=2)], [0, 1])
+        self.assertEqual([job_id for job_id, _ in _take_jobs(0, queues, batch_size=2)], [2])
+
+    def test_shutdown_sentinel_is_not_stolen(self):
+        queues = [queue.Queue(), queue.Queue()]
+        queues[0].put(None)
+        queues[1].put((7, 'img.jpg'))
+        self.assertEqual(_take_jobs(0, queues, batch_size=4), None)
+        self.assertEqual(_take_jobs(1, queues, batch_size=4), [(7, 'img.jpg')])
+
+
+def _crashing_replica(index, queues, results, model_path, batch_size):
+    jobs = _take_jobs(index, queues, batch_size)
+    if jobs is not None:
+        results.put(('taken', index, [job_id for job_id, _ in jobs]))
+        # Flush the queue's feeder thread, then die like an OOM-killed process
+        results.close()
+        results.join_thread()
+        os._exit(1)
+
+
+def _slow_replica(index, queues, results, model_path, batch_size):
+    while (jobs := _take_jobs(index, queues, batch_size)) is not None:
+        time.sleep(0.5)
+        for job_id, _ in jobs:
+            results.put(('result', job_id, {'classes': [], 'polygons': []}, None))
+
+
+class InferenceServerTests(SimpleTestCase):
+    def start(self, replica, timeout):
+        server = InferenceServer('unused.sock', 'unused.pt', replicas=1, timeout=timeout)
+        patcher = mock.patch('necrosis.inference_server._replica_main', replica)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        server.start_replicas()
+        self.addCleanup(server.stop)
+        return server
+
+    @mock.patch('necrosis.inference_server.MONITOR_INTERVAL', 0.05)
+    def test_jobs_of_a_dead_replica_fail_and_it_is_restarted(self):
+        server = self.start(_crashing_replica, timeout=30)
+        started = time.monotonic()
+        with self.assertRaisesRegex(RuntimeError, 'replica 0 exited'):
+            server.predict(['root.jpg'])
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(server.restarts, 1)
+        self.assertEqual(server._pending, {})
+
+    def test_requests_time_out_and_late_replies_are_dropped(self):
+        server = self.start(_slow_replica, timeout=0.1)
+        with self.assertRaisesRegex(RuntimeError, 'timed out'):
+            server.predict(['root.jpg'])
+        server.timeout = 5
+        # The collector survived the late reply of the first request
+        self.assertEqual(server.predict(['root.jpg']), [{'classes': [], 'polygons': []}])
+
+    def test_network_addresses_need_their_own_authkey(self):
+        with override_settings(NECROSIS_INFERENCE_AUTHKEY=None):
+            self.assertEqual(inference_authkey('127.0.0.1:8765'), settings.SECRET_KEY.encode())
+            self.assertEqual(inference_authkey('/run/necrosis.sock'), settings.SECRET_KEY.encode())
+            with self.assertRaises(ImproperlyConfigured):
+                inference_authkey('0.0.0.0:8765')
+        with override_settings(NECROSIS_INFERENCE_AUTHKEY=b'k3y'):
+            self.assertEqual(inference_authkey('10.0.0.5:8765'), b'k3y')
+
+    def test_client_builds_detections_without_decoding_the_image(self):
+        polygon = np.array([[0, 0], [50, 0], [50, 100]], dtype=np.float32)
+        reply = {'classes': [0], 'polygons': [polygon], 'orig_shape': (100, 200)}
+        with mock.patch('necrosis.inference_server.Client') as client, \
+                mock.patch('necrosis.utilities.read_image') as read_image:
+            client.return_value.__enter__.return_value.recv.return_value = ('ok', [reply])
+            detections = InferenceClient('127.0.0.1:8765', authkey=b'k3y')(['root.jpg'])[0]
+            self.assertEqual(detections.orig_shape, (100, 200))
+            np.testing.assert_allclose(detections.masks.xyn[0][1], [0.25, 0])
+            read_image.assert_not_called()
+            detections.orig_img
+        read_image.assert_called_once_with('root.jpg')
+
+
+class LazyModelTests(SimpleTestCase):
+    def test_importing_views_does_not_load_the_model(self):
+        import sys
+        from . import inference, views  # noqa: F401
+        self.assertFalse(inference.is_loaded())
+        self.assertNotIn('ultralytics', sys.modules)
+
+    def test_warm_up_reports_when_it_finishes(self):
+        from . import inference
+        with mock.patch.object(inference, 'LazyModel'), mock.patch.dict(inference.stats, warmup_seconds=None):
+            with self.assertLogs('necrosis.inference', 'INFO') as logs:
+                inference.warm_up(background=False)
+            self.assertIsNotNone(inference.stats['warmup_seconds'])
+        self.assertIn('Model warm-up finished', logs.output[0])
+
+    def test_startup_is_timed_from_process_start(self):
+        from . import apps
+        # Interpreter start-up and the settings import came before the app's
+        self.assertGreater(apps._process_age(), time.perf_counter() - apps._IMPORTED_AT)
+
+
+class NecrosisAreaTests(SimpleTestCase):
+    shapes = [(480, 640), (1080, 1920), (3000, 4000)]
+
+    def percentages(self, shape, seed, method):
+        root, lesions = synthetic_polygons(shape, lesions=15, seed=seed)
+        root_ref, nec_ref = fillpoly_areas(root, lesions, shape)
+        root_area, nec_area = necrosis_areas(root, lesions, shape, method=method)
+        return nec_ref / root_ref * 100, nec_area / root_area * 100
+
+    def test_raster_matches_fillpoly_exactly(self):
+        for shape in self.shapes:
+            for seed in range(3):
+                reference, percentage = self.percentages(shape, seed, 'raster')
+                self.assertEqual(reference, percentage)
+
+    def test_shoelace_within_tolerance_of_fillpoly(self):
+        for shape in self.shapes:
+            for seed in range(3):
+                reference, percentage = self.percentages(shape, seed, 'shoelace')
+                self.assertAlmostEqual(reference, percentage, delta=0.5)
+
+    def test_polygons_outside_the_image_are_clipped(self):
+        shape = (100, 100)
+        square = np.array([[-50, -50], [49, -50], [49, 49], [-50, 49]], dtype=np.float32)
+        self.assertEqual(raster_area([square], shape), fillpoly_areas(square, [], shape)[0])
+        self.assertEqual(raster_area([square + 500], shape), 0)
+
+    def test_overlapping_lesions_are_not_counted_twice(self):
+        square = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=np.float32)
+        self.assertEqual(union_area([square, square], (100, 100), method='shoelace'), raster_area([square], (100, 100)))
+        self.assertEqual(polygon_area(square), 100)
+
+    def test_scattered_lesions_are_rasterized_cluster_by_cluster(self):
+        square = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=np.float32)
+        lesions = [square + offset for offset in ([5, 5], [10, 10], [3900, 2900], [1900, 1400])]
+        zeros = np.zeros
+        with mock.patch('necrosis.areas.np.zeros', side_effect=zeros) as masks:
+            area = raster_area(lesions, (3000, 4000))
+        self.assertEqual(area, fillpoly_areas(square, lesions, (3000, 4000))[1])
+        self.assertLessEqual(max(np.prod(call.args[0]) for call in masks.call_args_list), 16 * 16)
+
+
+class CountingModel:
+    """
+    Stand-in model returning one root and one lesion for every image.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, sources):
+        self.calls += 1
+        root = np.array([[10, 10], [90, 10], [90, 90], [10, 90]], dtype=np.float32)
+        lesion = np.array([[20, 20], [40, 20], [40, 40], [20, 40]], dtype=np.float32)
+        return [
+            Detections([0, 1], [root, lesion], source if isinstance(source, np.ndarray) else cv2.imread(source))
+            for source in sources
+        ]
+
+
+class BatchInferenceTests(SimpleTestCase):
+    def test_images_are_chunked_and_results_keep_input_order(self):
+        batch_sizes = []
+        root = np.array([[10, 10], [90, 10], [90, 90], [10, 90]], dtype=np.float32)
+
+        def model(images):
+            batch_sizes.append(len(images))
+            # Lesion side of 5 pixels per unit of pixel value, so each image gets its own percentage
+            return [Detections([0, 1], [root, np.array([[20, 20], [20 + side, 20], [20 + side, 20 + side],
+                                                        [20, 20 + side]], dtype=np.float32)], image)
+                    for image in images for side in [5 * int(image[0, 0, 0])]]
+
+        images = [np.full((100, 100, 3), i + 1, dtype=np.uint8) for i in range(5)]
+        names = [f'root{i}.jpg' for i in range(5)]
+        processed = process_images_batch(images, model, batch_size=2, names=names, render=False)
+        self.assertEqual(batch_sizes, [2, 2, 1])
+        self.assertEqual([name for _, name, _, _ in processed], [f'root{i}.png' for i in range(5)])
+        # Lesions grow with the input position, so in order results have rising percentages
+        percentages = [nec_per for nec_per, _, _, _ in processed]
+        self.assertTrue(all(a < b for a, b in zip(percentages, percentages[1:])), percentages)
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.results_dir = os.path.join(self.tmp, 'results')
+        os.makedirs(self.results_dir)
+        patcher = mock.patch('necrosis.utilities.img_results_dir', self.results_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('necrosis.result_cache.img_results_dir', self.results_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_image(self, name, value=0):
+        path = os.path.join(self.tmp, name)
+        cv2.imwrite(path, np.full((100, 100, 3), value, np.uint8))
+        return path
+
+    def test_repeated_image_is_served_from_cache(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), max_bytes=10 * 1024 ** 2)
+        model = CountingModel()
+        first = cached_process_images([self.write_image('a.jpg')], model, cache=cache)[0]
+        second = cached_process_images([self.write_image('b.jpg')], model, cache=cache)[0]
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(second[1], 'b.png')
+        self.assertTrue(os.path.exists(os.path.join(self.results_dir, 'b.png')))
+
+    def test_entries_without_an_overlay_count_as_misses_when_rendering(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), max_bytes=10 * 1024 ** 2)
+        model = CountingModel()
+        path = self.write_image('a.jpg')
+        cached_process_images([path], model, cache=cache, render=False)
+        cached_process_images([path], model, cache=cache, render=True)
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 2})
+        cached_process_images([path], model, cache=cache, render=False)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_changing_result_settings_misses_the_cache(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), max_bytes=10 * 1024 ** 2)
+        model = CountingModel()
+        path = self.write_image('a.jpg')
+        cached_process_images([path], model, cache=cache)
+        with override_settings(NECROSIS_AREA_METHOD='shoelace'):
+            cached_process_images([path], model, cache=cache)
+        with override_settings(NECROSIS_TILED_INFERENCE=True):
+            cached_process_images([path], model, cache=cache)
+        cached_process_images([path], model, cache=cache)
+        self.assertEqual(model.calls, 3)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache'), max_bytes=10 * 1024 ** 2)
+        model = CountingModel()
+        paths = [self.write_image(f'{i}.jpg', value=i) for i in range(3)]
+        cached_process_images(paths, model, cache=cache)
+        keys = [cache.key(file_digest(path)) for path in paths]
+        for age, key in enumerate(keys):
+            for path in cache._paths(key):
+                os.utime(path, (1000 + age, 1000 + age))
+        entry_size = sum(os.path.getsize(p) for p in cache._paths(keys[0]))
+        cache.max_bytes = entry_size * 2
+        cache.evict()
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertIsNotNone(cache.get(keys[2]))
+
+    def test_puts_only_scan_the_directory_past_the_high_water_mark(self):
+        directory = os.path.join(self.tmp, 'cache')
+        cache = ResultCache(directory, max_bytes=10 * 1024 ** 2)
+        cache.put('0' * 64, 12.5, 1, {})
+        entry_size = cache._bytes
+        cache.max_bytes = entry_size * 100
+        with mock.patch('necrosis.result_cache.os.scandir', wraps=os.scandir) as scandir:
+            for i in range(1, 300):
+                cache.put(f'{i:064x}', 12.5, 1, {})
+        # Every scan trims 20% of the limit, so about one scan per 20 puts past the first 110
+        self.assertLessEqual(scandir.call_count, 12)
+        total = sum(entry.stat().st_size for entry in os.scandir(directory))
+        self.assertEqual(total, cache._bytes)
+        self.assertLessEqual(total, cache.max_bytes * 1.1)
+
+
+    def test_concurrent_puts_of_one_entry_use_their_own_temporary_files(self):
+        directory = os.path.join(self.tmp, 'cache')
+        cache = ResultCache(directory, max_bytes=10 * 1024 ** 2)
+        overlay = self.write_image('overlay.png')
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda i: cache.put('0' * 64, 12.5, i, {}, overlay_path=overlay), range(32)))
+        self.assertEqual(sorted(os.listdir(directory)), ['0' * 64 + '.json', '0' * 64 + '.png'])
+        self.assertIsNotNone(cache.get('0' * 64, need_overlay=True))
+
+        with mock.patch('necrosis.result_cache.os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                cache.put('1' * 64, 12.5, 1, {})
+        self.assertEqual(sorted(os.listdir(directory)), ['0' * 64 + '.json', '0' * 64 + '.png'])
+
+class StreamZipTests(SimpleTestCase):
+    def test_stream_produces_valid_archive(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        png_path = os.path.join(tmp, 'overlay.png')
+        cv2.imwrite(png_path, np.random.default_rng(0).integers(0, 255, (300, 300, 3), dtype=np.uint8))
+        txt_path = os.path.join(tmp, 'notes.txt')
+        with open(txt_path, 'w') as f:
+            f.write('necrosis ' * 10000)
+        entries = [('root.png', png_path), ('notes.txt', txt_path), ('missing.png', os.path.join(tmp, 'nope.png'))]
+        chunks = list(stream_zip(entries, chunk_size=4096))
+        self.assertGreater(len(chunks), 2)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertEqual(archive.namelist(), ['root.png', 'notes.txt'])
+            self.assertEqual(archive.getinfo('root.png').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+            with open(png_path, 'rb') as f:
+                self.assertEqual(archive.read('root.png'), f.read())
+            self.assertIsNone(archive.testzip())
+
+
+def encoded_image(name='root.jpg', size=(100, 100), value=60):
+    ok, encoded = cv2.imencode('.jpg', np.full((*size, 3), value, np.uint8))
+    return SimpleUploadedFile(name, encoded.tobytes(), content_type='image/jpeg')
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, NECROSIS_RESULT_CACHE_ENABLED=False)
+class AnalyzeImagesTests(AnalysisTestCase):
+    def analyze(self, *files, **data):
+        return self.client.post('/api/analyze/', {'images': list(files), **data}, format='multipart')
+
+    def test_analyze_stores_originals_and_results(self):
+        upload = encoded_image()
+        response = self.analyze(upload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.model.calls, 1)
+        image = CassavaImage.objects.get()
+        self.assertEqual(image.image_name, 'root.jpg')
+        self.assertAlmostEqual(image.necrosis_percentage, response.data['results'][0]['percentage_necrosis'])
+        upload.seek(0)
+        with image.original_image.open('rb') as f:
+            self.assertEqual(f.read(), upload.read())
+        session = AnalysisSession.objects.get()
+        self.assertEqual(session.num_images, 1)
+        self.assertAlmostEqual(session.necrosis_max, image.necrosis_percentage)
+
+    def test_batch_is_written_with_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.analyze(*[encoded_image(name=f'root{i}.jpg') for i in range(3)])
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "necrosis_cassavaimage"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(CassavaImage.objects.count(), 3)
+        self.assertGreater(response.data['timing']['db_ms_per_image'], 0)
+
+    def test_failed_batch_writes_no_rows(self):
+        self.client.raise_request_exception = False
+        with mock.patch('necrosis.views.add_images', side_effect=DatabaseError('disk full')):
+            response = self.analyze(encoded_image(), encoded_image(name='other.jpg'))
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(CassavaImage.objects.exists())
+
+    def test_metrics_cover_pipeline_stages_and_routes(self):
+        metrics.stage_seconds.reset()
+        metrics.request_seconds.reset()
+        with override_settings(NECROSIS_METRICS_ENABLED=True, NECROSIS_EAGER_OVERLAYS=True):
+            self.analyze(encoded_image())
+            body = self.client.get('/metrics/').content.decode()
+        for stage in ('decode', 'inference', 'areas', 'overlay', 'image_write', 'db_write'):
+            self.assertIn(f'necrosis_stage_seconds_count{{stage="{stage}",', body)
+        self.assertIn('necrosis_request_seconds_count{view="necrosis:analyze_images",method="POST",status="200"} 1',
+                      body)
+
+    def test_metrics_disabled_by_default(self):
+        self.assertIs(metrics.timer('decode'), metrics.timer('areas'))
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+
+class IngestTests(SimpleTestCase):
+    def test_upload_is_decoded_and_hashed_from_the_same_bytes(self):
+        upload = encoded_image(size=(40, 60))
+        with override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT):
+            image = ingest_upload(upload)
+            upload.seek(0)
+            data = upload.read()
+            self.assertEqual(image.decode().shape, (40, 60, 3))
+            self.assertEqual(image.digest, hashlib.sha256(data).hexdigest())
+            with open(os.path.join(TEST_MEDIA_ROOT, image.upload_path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_exif_orientation_is_left_unapplied(self):
+        from PIL import Image as PILImage
+
+        photo = io.BytesIO()
+        exif = PILImage.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+        PILImage.new('RGB', (60, 40)).save(photo, 'JPEG', exif=exif)
+        upload = SimpleUploadedFile('phone.jpg', photo.getvalue(), content_type='image/jpeg')
+        with override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT):
+            image = ingest_upload(upload)
+            self.assertEqual(image.decode().shape, (40, 60, 3))
+            self.assertTrue(image.upload_path)
+
+    def test_uploads_are_decoded_per_inference_batch(self):
+        events = []
+        model = CountingModel()
+
+        def decode(image):
+            events.append('decode')
+            return image.decode()
+
+        def run(images):
+            events.append('inference')
+            return model(images)
+
+        with override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT):
+            images = [ingest_upload(encoded_image(f'root{i}.jpg')) for i in range(3)]
+            process_images_batch(images, run, batch_size=2, names=[img.name for img in images], render=False,
+                                 load=decode)
+            # The originals are stored while MEDIA_ROOT still points at the test directory
+            self.assertTrue(all(img.upload_path for img in images))
+        self.assertEqual(events, ['decode', 'decode', 'inference', 'decode', 'inference'])
+
+
+class PolygonEncodingTests(UserTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.polygons = {str(i): rng.random((200, 2)).tolist() for i in range(1, 25)}
+
+    def test_round_trip_within_quantization_step(self):
+        decoded = decode_polygons(encode_polygons(self.polygons))
+        self.assertEqual(decoded.keys(), self.polygons.keys())
+        for key, polygon in self.polygons.items():
+            np.testing.assert_allclose(decoded[key], polygon, atol=1 / 65535)
+
+    def test_compact_form_is_much_smaller_than_json(self):
+        self.assertLess(len(encode_polygons(self.polygons)) * 10, len(json.dumps(self.polygons)))
+
+    def test_session_results_in_both_forms(self):
+        session = AnalysisSession.objects.create(user=self.user, session_id='s1', num_images=2)
+        blob = encode_polygons(self.polygons)
+        CassavaImage.objects.create(session=session, original_image='a.jpg', image_name='a.jpg', total_lesions=24,
+                                    necrosis_percentage=12.5, lesion_polygons=blob)
+        # Rows written before the binary field keep their polygons in metadata
+        CassavaImage.objects.create(session=session, original_image='b.jpg', image_name='b.jpg', total_lesions=24,
+                                    necrosis_percentage=12.5, metadata={'necrosis_lesions': self.polygons})
+        expanded = self.client.get('/api/session_results/s1/').data['results']
+        compact = self.client.get('/api/session_results/s1/?polygons=compact').data['results']
+        self.assertEqual(expanded[0]['necrosis_lesions'], decode_polygons(blob))
+        self.assertEqual(expanded[1]['necrosis_lesions'], self.polygons)
+        self.assertEqual([base64.b64decode(r['necrosis_lesions']) for r in compact], [blob, blob])
+        self.assertEqual(self.client.get('/api/session_results/s1/?polygons=svg').status_code, 400)
+
+
+class BenchmarkBaselineTests(SimpleTestCase):
+    def test_only_stages_beyond_threshold_are_regressions(self):
+        baseline = [{'resolution': '640x480', 'stage': 'decode', 'seconds': 1.0},
+                    {'resolution': '640x480', 'stage': 'areas', 'seconds': 1.0}]
+        rows = [{'resolution': '640x480', 'stage': 'decode', 'seconds': 1.1},
+                {'resolution': '640x480', 'stage': 'areas', 'seconds': 1.5},
+                {'resolution': '640x480', 'stage': 'endpoint', 'seconds': 9.0}]
+        regressions = compare_to_baseline(rows, baseline, threshold=0.2)
+        self.assertEqual([row['stage'] for row in regressions], ['areas'])
+        self.assertAlmostEqual(regressions[0]['slowdown'], 0.5)
+
+
+class SessionResultsPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='tester', email='tester@example.com', password='pass1234')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.session = AnalysisSession.objects.create(user=cls.user, session_id='s1', num_images=25)
+        blob = encode_polygons({'1': [[0.1, 0.1], [0.2, 0.1], [0.2, 0.2]]})
+        CassavaImage.objects.bulk_create([
+            CassavaImage(session=cls.session, original_image=f'{i}.jpg', image_name=f'{i}.jpg', total_lesions=1,
+                         necrosis_percentage=i, lesion_polygons=blob)
+            for i in range(25)
+        ])
+        for i in range(5):
+            AnalysisSession.objects.create(user=cls.user, session_id=f'extra{i}', num_images=0)
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_fixed_query_count_per_page(self):
+        url = '/api/session_results/s1/?page_size=10'
+        names = []
+        while url:
+            # Token lookup (then cached), session lookup, one page of images
+            with self.assertNumQueries(2 if names else 3):
+                data = self.client.get(url).data
+            names += [r['filename'] for r in data['results']]
+            url = data['next']
+        self.assertEqual(names, [f'{i}.jpg' for i in range(25)])
+
+    def test_fields_selector_skips_polygon_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get('/api/session_results/s1/?fields=filename,percentage_necrosis').data
+        self.assertEqual(data['results'][3], {'filename': '3.jpg', 'percentage_necrosis': 3})
+        self.assertNotIn('lesion_polygons', queries.captured_queries[-1]['sql'])
+        self.assertEqual(self.client.get('/api/session_results/s1/?fields=bogus').status_code, 400)
+
+    def test_unpaginated_results_stay_complete(self):
+        data = self.client.get('/api/session_results/s1/').data
+        self.assertEqual(len(data['results']), 25)
+        self.assertNotIn('next', data)
+
+    def test_user_sessions_pages(self):
+        first = self.client.get('/api/user_sessions/?page_size=4&fields=session_id').data
+        self.assertEqual(first['sessions'][0], {'session_id': 'extra4'})
+        second = self.client.get(first['next']).data
+        ids = [s['session_id'] for s in first['sessions'] + second['sessions']]
+        self.assertEqual(ids, ['extra4', 'extra3', 'extra2', 'extra1', 'extra0', 's1'])
+        self.assertIsNone(second['next'])
+
+
+class SessionAggregateTests(UserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = AnalysisSession.objects.create(user=self.user, session_id='s1', num_images=0)
+        self.values = [(10.0, 2), (30.0, 5), (20.0, 1), (55.5, 7)]
+        for i, (percentage, lesions) in enumerate(self.values):
+            CassavaImage.objects.create(session=self.session, original_image=f'{i}.jpg', image_name=f'{i}.jpg',
+                                        total_lesions=lesions, necrosis_percentage=percentage)
+        add_images(self.session.id, self.values[:2])
+        add_images(self.session.id, self.values[2:])
+
+    def expected(self, values):
+        percentages = np.array([p for p, _ in values])
+        return {'num_images': len(values), 'mean_necrosis': percentages.mean(), 'std_necrosis': percentages.std(),
+                'min_necrosis': percentages.min(), 'max_necrosis': percentages.max(),
+                'total_lesions': sum(n for _, n in values)}
+
+    def assertSummary(self, values):
+        summary = session_summary(AnalysisSession.objects.get(id=self.session.id))
+        for key, value in self.expected(values).items():
+            self.assertAlmostEqual(summary[key], value, places=6, msg=key)
+
+    def test_incremental_updates_match_the_rows(self):
+        self.assertSummary(self.values)
+        AnalysisSession.objects.filter(id=self.session.id).update(num_images=0, necrosis_sum=0, necrosis_max=None)
+        call_command('recompute_session_aggregates', stdout=io.StringIO())
+        self.assertSummary(self.values)
+
+    def test_command_repairs_sessions_changed_by_hand(self):
+        CassavaImage.objects.filter(necrosis_percentage=55.5).update(necrosis_percentage=5.5)
+        out = io.StringIO()
+        call_command('recompute_session_aggregates', 's1', stdout=out)
+        self.assertIn('1 sessions', out.getvalue())
+        self.assertSummary([(10.0, 2), (30.0, 5), (20.0, 1), (5.5, 7)])
+
+    def test_deleting_images_takes_them_out_of_the_aggregates(self):
+        # The extremes, so min and max are recomputed from the remaining rows
+        CassavaImage.objects.filter(necrosis_percentage__in=[10.0, 55.5]).delete()
+        self.assertSummary([(30.0, 5), (20.0, 1)])
+        CassavaImage.objects.get(necrosis_percentage=20.0).delete()
+        self.assertSummary([(30.0, 5)])
+        self.session.cassava_images.all().delete()
+        summary = session_summary(AnalysisSession.objects.get(id=self.session.id))
+        self.assertEqual((summary['num_images'], summary['total_lesions']), (0, 0))
+        self.assertIsNone(summary['max_necrosis'])
+
+    def test_deleting_a_session_skips_the_aggregate_updates(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.session.delete()
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE "necrosis_analysissession"')])
+
+    def test_session_list_serves_summaries_without_reading_images(self):
+        # Forced authentication, so only the session list query is counted
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/user_sessions/?fields=session_id,summary')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('cassavaimage', queries[0]['sql'])
+        self.assertAlmostEqual(response.data['sessions'][0]['summary']['mean_necrosis'], 28.875)
+        response = client.get('/api/session_results/s1/?fields=filename')
+        self.assertEqual(response.data['summary']['total_lesions'], 15)
+
+
+class DatabaseIndexTests(TestCase):
+    def test_session_list_uses_the_composite_index(self):
+        user = User.objects.create_user(username='tester', email='tester@example.com', password='pass1234')
+        plan = AnalysisSession.objects.filter(user=user).order_by('-created_at').explain()
+        if connection.vendor == 'sqlite':
+            self.assertIn('session_user_created_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class SessionCleanupTests(UserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = AnalysisSession.objects.create(user=self.user, session_id='s1', num_images=3)
+        self.paths = []
+        for i in range(3):
+            original = default_storage.save(f'uploads/images/{i}.jpg', ContentFile(b'x' * 100))
+            processed = default_storage.save(f'results/{i}.png', ContentFile(b'y' * 50))
+            self.paths += [original, processed]
+            CassavaImage.objects.create(session=self.session, original_image=original, processed_image=processed,
+                                        image_name=f'{i}.jpg', total_lesions=1, necrosis_percentage=1.0)
+
+    def assertFilesGone(self):
+        for path in self.paths:
+            self.assertFalse(default_storage.exists(path), path)
+
+    def test_clearing_images_updates_rows_at_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/delete_session_images/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['files'], response.data['bytes_reclaimed']), (6, 450))
+        self.assertEqual(sum(q['sql'].startswith('UPDATE "necrosis_cassavaimage"') for q in queries), 1)
+        self.assertFilesGone()
+        self.assertEqual(set(CassavaImage.objects.values_list('original_image', 'processed_image')), {('', '')})
+
+    def delete_in_background(self):
+        # The executor's thread could not see the test's uncommitted rows, so its work is run here
+        with mock.patch.object(cleanup, '_background_executor') as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/sessions/s1/?background=1')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(AnalysisSession.objects.exists())
+        return response.data['cleanup_id'], executor
+
+    def test_background_session_delete_reports_reclaimed_bytes(self):
+        cleanup_id, executor = self.delete_in_background()
+        self.assertEqual(self.client.get(f'/api/cleanups/{cleanup_id}/').data['status'], 'running')
+        cleanup.run_cleanup(executor.submit.call_args.args[1])
+        # Served from the database, so any worker process can answer
+        status = self.client.get(f'/api/cleanups/{cleanup_id}/').data
+        self.assertEqual((status['status'], status['files'], status['bytes_reclaimed']), ('completed', 6, 450))
+        self.assertFilesGone()
+        other = User.objects.create_user(username='other', email='other@example.com', password='pass1234')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(f'/api/cleanups/{cleanup_id}/').status_code, 404)
+
+    @override_settings(NECROSIS_CLEANUP_LEASE_SECONDS=60)
+    def test_cleanup_lost_with_its_process_is_run_again(self):
+        cleanup_id, _ = self.delete_in_background()
+        CleanupTask.objects.update(started_at=timezone.now() - timedelta(seconds=61))
+        with mock.patch.object(cleanup, '_background_executor') as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.get(f'/api/cleanups/{cleanup_id}/').data['status'], 'running')
+            self.client.get(f'/api/cleanups/{cleanup_id}/')
+        self.assertEqual(executor.submit.call_count, 1)
+        cleanup.run_cleanup(executor.submit.call_args.args[1])
+        self.assertEqual(self.client.get(f'/api/cleanups/{cleanup_id}/').data['status'], 'completed')
+        self.assertFilesGone()
+
+
+class ThresholdModel:
+    """
+    Segments synthetic images by grey level: bright pixels form the root,
+    mid-grey blobs the lesions. Records the size of every batch.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, images):
+        self.batches.append(len(images))
+        detections = []
+        for img in images:
+            grey = img[..., 0]
+            root, _ = cv2.findContours(((grey >= 50) * 255).astype(np.uint8), cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_NONE)
+            lesions, _ = cv2.findContours((((grey >= 50) & (grey < 100)) * 255).astype(np.uint8),
+                                          cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+            root = sorted(root, key=cv2.contourArea)[-1:]
+            polygons = [c.reshape(-1, 2).astype(np.float32) for c in root + list(lesions)]
+            detections.append(Detections([0] * len(root) + [1] * len(lesions), polygons, img))
+        return detections
+
+
+class TiledInferenceTests(SimpleTestCase):
+    def setUp(self):
+        self.img = np.full((2000, 3000, 3), 20, np.uint8)
+        cv2.circle(self.img, (1500, 1000), 900, (200, 200, 200), -1)
+        # The first lesion straddles the seam between the first two tile columns
+        for center in ((1000, 700), (1500, 1300), (2100, 900)):
+            cv2.circle(self.img, center, 60, (70, 70, 70), -1)
+
+    def test_tiles_cover_the_image_with_overlap(self):
+        boxes = tile_boxes((2000, 3000), 1024, 128)
+        covered = np.zeros((2000, 3000), bool)
+        for x0, y0, x1, y1 in boxes:
+            covered[y0:y1, x0:x1] = True
+            self.assertLessEqual((x1 - x0, y1 - y0), (1024, 1024))
+        self.assertTrue(covered.all())
+
+    def test_lesions_split_by_seams_are_merged(self):
+        model = ThresholdModel()
+        tiled = TiledModel(model, tile_size=1024, overlap=128, max_tiles=3, min_pixels=0)
+        results = tiled([self.img.copy()])[0]
+        whole = ThresholdModel()([self.img.copy()])[0]
+        self.assertEqual([int(c) for c in results.boxes.cls.tolist()], [0, 1, 1, 1])
+        self.assertLessEqual(max(model.batches[1:]), 3)
+        tiled_areas = necrosis_areas(results.masks.xy[0], results.masks.xy[1:], results.orig_shape)
+        whole_areas = necrosis_areas(whole.masks.xy[0], whole.masks.xy[1:], whole.orig_shape)
+        self.assertAlmostEqual(tiled_areas[1] / tiled_areas[0], whole_areas[1] / whole_areas[0], places=3)
+
+    def test_small_images_skip_tiling(self):
+        model = ThresholdModel()
+        TiledModel(model, tile_size=1024, overlap=128)([self.img])
+        self.assertEqual(model.batches, [1])
+
+
+class InferenceBackendTests(SimpleTestCase):
+    @override_settings(NECROSIS_MODEL_PATH='/models/best.pt')
+    def test_exports_are_found_next_to_the_weights(self):
+        self.assertEqual(weights_path('torch', int8=True), '/models/best.pt')
+        self.assertEqual(weights_path('onnx', int8=False), '/models/best.onnx')
+        self.assertEqual(weights_path('onnx', int8=True), '/models/best-int8.onnx')
+        self.assertEqual(weights_path('openvino', int8=False), '/models/best_openvino_model')
+
+    def test_backends_are_compared_on_necrosis_percentage(self):
+        img = np.full((400, 400, 3), 20, np.uint8)
+        cv2.circle(img, (200, 200), 150, (200, 200, 200), -1)
+        cv2.circle(img, (200, 200), 40, (70, 70, 70), -1)
+        path = os.path.join(TEST_MEDIA_ROOT, 'fixture.png')
+        cv2.imwrite(path, img)
+
+        def shrunk(images):
+            # Candidate whose lesion outline is shrunk by a few pixels
+            results = ThresholdModel()(images)[0]
+            lesion = results.masks.xy[1]
+            center = lesion.mean(axis=0)
+            polygons = [results.masks.xy[0], center + (lesion - center) * 0.9]
+            return [Detections([0, 1], polygons, results.orig_img)]
+
+        rows = compare_backends([path], ThresholdModel(), {'onnx': ThresholdModel(), 'onnx-int8': shrunk})
+        self.assertEqual([row['backend'] for row in rows], ['onnx', 'onnx-int8'])
+        self.assertEqual(rows[0]['difference'], 0)
+        self.assertGreater(rows[1]['difference'], 0.5)
+
+
+class InferenceExecutorTests(SimpleTestCase):
+    def test_replicas_are_never_shared_between_threads(self):
+        created = []
+        overlaps = []
+
+        class SlowModel:
+            def __init__(self):
+                self.busy = False
+                created.append(self)
+
+            def __call__(self, sources):
+                overlaps.append(self.busy)
+                self.busy = True
+                time.sleep(0.02)
+                self.busy = False
+                return sources
+
+        executor = InferenceExecutor(SlowModel, replicas=2)
+        self.assertEqual(len(created), 1)
+        threads = [threading.Thread(target=executor, args=([i],)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(created), 2)
+        self.assertEqual(executor.loaded, 2)
+        self.assertFalse(any(overlaps))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, NECROSIS_RESULT_CACHE_ENABLED=False)
+class AsyncViewTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        # AsyncClient puts client-wide defaults into the ASGI scope, not the headers
+        self.auth = {'Authorization': f'Token {self.token.key}'}
+        self.client = AsyncClient()
+
+    async def test_analyze_then_read_and_download_results(self):
+        response = await self.client.post('/api/async/analyze/', {'images': [encoded_image(), encoded_image('b.jpg')]},
+                                         headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([r['filename'] for r in data['results']], ['root.jpg', 'b.jpg'])
+        self.assertEqual(await CassavaImage.objects.acount(), 2)
+
+        results = (await self.client.get(f"/api/async/session_results/{data['session_id']}/?fields=filename",
+                                         headers=self.auth)).json()
+        self.assertEqual(results['results'], [{'filename': 'root.jpg'}, {'filename': 'b.jpg'}])
+        self.assertEqual(results['summary']['num_images'], 2)
+
+        response = await self.client.get(f"/api/async/sessions/{data['session_id']}/download_images/",
+                                         headers=self.auth)
+        archive = b''.join([chunk async for chunk in response.streaming_content])
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            self.assertEqual(sorted(zf.namelist()), ['b.jpg', 'root.jpg'])
+
+    async def test_errors_match_the_drf_views(self):
+        response = await self.client.get('/api/async/latest_session_results/')
+        self.assertEqual((response.status_code, response['WWW-Authenticate']), (401, 'Token'))
+        response = await self.client.get('/api/async/session_results/missing/', headers=self.auth)
+        self.assertEqual((response.status_code, response.json()), (404, {'detail': 'Session not found.'}))
+
+    async def test_asgi_application_serves_static_files(self):
+        with mock.patch.dict(os.environ):
+            from NecrosisApi.asgi import application
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'method': 'GET', 'path': '/static/admin/css/base.css', 'query_string': b'', 'headers': [],
+        })
+        await communicator.send_input({'type': 'http.request'})
+        start = await communicator.receive_output()
+        self.assertEqual(start['status'], 200)
+        await communicator.wait()
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, NECROSIS_RESULT_CACHE_ENABLED=False, NECROSIS_OVERLAY_WIDTHS=[128, 512])
+class OverlayTests(AnalysisTestCase):
+    def analyze(self):
+        response = self.client.post('/api/analyze/', {'images': [encoded_image(name='lazy.jpg', size=(200, 300))]},
+                                    format='multipart')
+        return response.data['results'][0]['result_image']
+
+    def test_analysis_skips_the_overlay_until_it_is_requested(self):
+        url = self.analyze()
+        self.assertFalse(os.path.exists(os.path.join(TEST_MEDIA_ROOT, 'results', 'lazy.png')))
+        self.assertEqual(CassavaImage.objects.get().processed_image, '')
+
+        # The signed URL needs no token, like the media URLs it replaces
+        response = APIClient().get(url, {'width': 128})
+        self.assertEqual(response.status_code, 200)
+        overlay = cv2.imdecode(np.frombuffer(b''.join(response.streaming_content), np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(overlay.shape[:2], (85, 128))
+        rendered = cleanup.session_overlays(AnalysisSession.objects.get().pk)
+        self.assertEqual(len(rendered), 1)
+
+        # Served from storage the second time
+        with mock.patch('necrosis.overlays.render_overlay') as render:
+            self.assertEqual(APIClient().get(url, {'width': 128}).status_code, 200)
+        render.assert_not_called()
+
+        self.assertEqual(APIClient().get(url.replace('/api/overlays/', '/api/overlays/x')).status_code, 404)
+        for width in ('big', '100', '129'):
+            self.assertEqual(APIClient().get(url, {'width': width}).status_code, 400)
+
+    def test_widths_beyond_the_original_share_the_full_size_file(self):
+        url = self.analyze()
+        for params in ({'width': 512}, {}):
+            response = APIClient().get(url, params)
+            overlay = cv2.imdecode(np.frombuffer(b''.join(response.streaming_content), np.uint8), cv2.IMREAD_COLOR)
+            self.assertEqual(overlay.shape[:2], (200, 300))
+        rendered = cleanup.session_overlays(AnalysisSession.objects.get().pk)
+        self.assertEqual([name.rsplit('-', 1)[1] for name in rendered], ['full.png'])
+
+    def test_signed_urls_expire(self):
+        url = self.analyze()
+        self.assertEqual(APIClient().get(url).status_code, 200)
+        later = time.time() + settings.NECROSIS_IMAGE_URL_MAX_AGE + 1
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            self.assertEqual(APIClient().get(url).status_code, 404)
+
+    def test_rendered_overlays_are_deleted_with_the_images(self):
+        url = self.analyze()
+        self.client.get(url)
+        session = AnalysisSession.objects.get()
+        rendered = cleanup.session_overlays(session.pk)
+        self.assertEqual(len(rendered), 1)
+        self.client.post('/api/delete_session_images/')
+        self.assertFalse(default_storage.exists(rendered[0]))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.get('/api/latest_session_results/?fields=result_image')
+        self.assertEqual(response.data['results'], [{'result_image': None}])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, NECROSIS_RESULT_CACHE_ENABLED=False, NECROSIS_PREVIEW_WIDTHS=[64, 160])
+class PreviewTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.post('/api/analyze/', {'images': [encoded_image(size=(200, 300))]}, format='multipart')
+        self.image = CassavaImage.objects.get()
+
+    def test_size_url_redirects_to_content_hashed_file(self):
+        urls = self.client.get('/api/latest_session_results/?fields=previews').data['results'][0]['previews']
+        self.assertEqual(set(urls), {'original', 'overlay'})
+        response = APIClient().get(urls['original']['64'])
+        self.assertEqual(response.status_code, 302)
+        hashed = APIClient().get(response['Location'])
+        self.assertEqual((hashed.status_code, hashed['Content-Type']), (200, 'image/webp'))
+        self.assertIn('immutable', hashed['Cache-Control'])
+        data = b''.join(hashed.streaming_content)
+        self.assertEqual(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR).shape[:2], (43, 64))
+        self.assertIn(hashlib.sha256(data).hexdigest()[:16], response['Location'])
+
+        # Made once, then found by its size
+        with mock.patch('necrosis.previews._source_image') as source:
+            self.assertEqual(APIClient().get(urls['original']['64'])['Location'], response['Location'])
+        source.assert_not_called()
+        self.assertEqual(APIClient().get(urls['original']['64'].replace('/64/', '/65/')).status_code, 400)
+
+    def test_urls_are_stable_across_requests(self):
+        request = mock.Mock(build_absolute_uri=lambda path: path)
+        later = time.time() + settings.NECROSIS_IMAGE_URL_MAX_AGE + 1
+        first = previews.preview_urls(request, self.image)
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            self.assertEqual(previews.preview_urls(request, self.image), first)
+            location = APIClient().get(first['overlay']['64'])['Location']
+            self.assertEqual(APIClient().get(first['overlay']['64'])['Location'], location)
+            self.assertEqual(APIClient().get(location).status_code, 200)
+        # The signature covers the file name, so one of another preview is refused
+        signature = location.rsplit('/', 2)[1]
+        forged = location.replace(signature, previews.file_signature(self.image.pk, 'original-64-0.webp'))
+        self.assertEqual(APIClient().get(forged).status_code, 404)
+
+    def test_background_generation_and_session_delete(self):
+        previews.generate_previews([self.image.pk])
+        made = previews.session_previews(self.image.session_id)
+        self.assertEqual(len(made), 4)
+        # Overlay previews come straight from the polygons, no full size overlay is kept
+        self.assertEqual(cleanup.session_overlays(self.image.session_id), [])
+        self.assertEqual(self.client.delete(f'/api/sessions/{self.image.session.session_id}/').status_code, 204)
+        for name in made:
+            self.assertFalse(default_storage.exists(name), name)
+
+
+class TokenCacheTests(UserTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        super().setUp()
+
+    def test_repeated_requests_skip_the_token_query(self):
+        url = '/api/user_sessions/?fields=session_id'
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(first) - len(second), 1)
+        self.assertFalse(any('authtoken_token' in q['sql'] for q in second.captured_queries))
+
+    def test_deleted_tokens_and_deactivated_users_are_dropped(self):
+        url = '/api/user_sessions/'
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.token.delete()
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_entries_expire_and_are_bounded(self):
+        cache = TokenCache(max_entries=2, ttl=60)
+        for key in 'abc':
+            cache.set(key, self.user, None)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        with mock.patch('necrosis.authentication.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('c'))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class SessionReportTests(UserTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = AnalysisSession.objects.create(user=self.user, session_id='s1', num_images=0)
+        self.add_images(5)
+
+    def add_images(self, count):
+        blob = encode_polygons({'1': [[0.1, 0.1], [0.2, 0.1], [0.2, 0.2]]})
+        CassavaImage.objects.bulk_create([
+            CassavaImage(session=self.session, original_image=f'{i}.jpg', image_name=f'{i}.jpg', total_lesions=i,
+                         necrosis_percentage=i * 1.5, lesion_polygons=blob)
+            for i in range(count)
+        ])
+
+    def download(self, file_format, **headers):
+        response = self.client.get(f'/api/sessions/s1/report/{file_format}/', headers=headers)
+        return response, b''.join(response.streaming_content) if response.status_code == 200 else b''
+
+    def test_csv_report_is_checksummed_and_reused(self):
+        with mock.patch('necrosis.reports.CHUNK_SIZE', 2):
+            response, body = self.download('csv')
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(body.decode())))
+        self.assertEqual(rows[0], list(reports.COLUMNS))
+        self.assertEqual([(r[1], r[3], r[4]) for r in rows[1:]], [(f'{i}.jpg', str(i * 1.5), str(i)) for i in range(5)])
+        report = AnalysisReport.objects.get()
+        self.assertEqual(report.checksum, hashlib.sha256(body).hexdigest())
+        self.assertEqual(response['ETag'], f'"{report.checksum}"')
+
+        with mock.patch('necrosis.reports.build_report') as build:
+            self.assertEqual(self.download('csv')[1], body)
+            self.assertEqual(self.download('csv', if_none_match=response['ETag'])[0].status_code, 304)
+        build.assert_not_called()
+
+        self.add_images(1)
+        response, rebuilt = self.download('csv')
+        self.assertEqual(len(rebuilt.decode().splitlines()), 7)
+        self.assertEqual(AnalysisReport.objects.get().report_file.name, report.report_file.name)
+
+    def test_a_rebuild_leaves_the_file_of_an_earlier_build_readable(self):
+        first, first_file = reports.build_report(self.session, 'csv')
+        self.add_images(1)
+        second, second_file = reports.build_report(self.session, 'csv')
+        with first_file, second_file:
+            self.assertEqual(hashlib.sha256(first_file.read()).hexdigest(), first.checksum)
+            self.assertEqual(hashlib.sha256(second_file.read()).hexdigest(), second.checksum)
+        self.assertNotEqual(first.checksum, second.checksum)
+        self.assertEqual(AnalysisReport.objects.get().checksum, second.checksum)
+        _, files = default_storage.listdir('reports')
+        self.assertIn('session_s1.csv', files)
+        self.assertFalse([name for name in files if name.startswith('.build-')])
+
+    def test_jsonl_report_carries_lesions(self):
+        response, body = self.download('jsonl')
+        records = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([r['filename'] for r in records], [f'{i}.jpg' for i in range(5)])
+        np.testing.assert_allclose(records[2]['necrosis_lesions']['1'][0], [0.1, 0.1], atol=1e-4)
+        self.assertEqual(self.download('xlsx')[0].status_code, 400)
+
+    def test_each_format_is_stored_and_reused_separately(self):
+        csv_body = self.download('csv')[1]
+        jsonl_body = self.download('jsonl')[1]
+        self.assertEqual(AnalysisReport.objects.count(), 2)
+        with mock.patch('necrosis.reports.build_report') as build:
+            self.assertEqual(self.download('csv')[1], csv_body)
+            self.assertEqual(self.download('jsonl')[1], jsonl_body)
+        build.assert_not_called()
+
+    # CI sets CI=true so the Parquet path fails there instead of being skipped
+    @skipUnless(importlib.util.find_spec('pyarrow') or os.environ.get('CI'), 'pyarrow is not installed')
+    def test_parquet_report_round_trips(self):
+        import pyarrow.parquet as pq
+
+        response, body = self.download('parquet')
+        table = pq.read_table(io.BytesIO(body))
+        self.assertEqual(table.column('lesion_count').to_pylist(), list(range(5)))
+
+
+class ActivityLogTests(AnalysisTestCase):
+    def setUp(self):
+        super().setUp()
+        activity.activity_writer.flush()
+        UserActivityLog.objects.all().delete()
+
+    def test_views_queue_events_until_flushed(self):
+        client = APIClient(HTTP_USER_AGENT='field-app/1.0', REMOTE_ADDR='10.0.0.7')
+        response = client.post('/api/login/', {'email': 'tester@example.com', 'password': 'pass1234'})
+        client.credentials(HTTP_AUTHORIZATION=f"Token {response.data['token']}")
+        AnalysisSession.objects.create(user=self.user, session_id='s1', num_images=0)
+        client.delete('/api/sessions/s1/')
+        self.assertFalse(UserActivityLog.objects.exists())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(activity.activity_writer.flush(), 2)
+        login, delete = UserActivityLog.objects.order_by('timestamp')
+        self.assertEqual((login.activity_type, login.ip_address, login.device_info),
+                         ('login', '10.0.0.7', 'field-app/1.0'))
+        self.assertEqual((delete.activity_type, delete.context_data), ('delete_session', {'session_id': 's1'}))
+
+    def test_forwarded_for_is_only_trusted_behind_proxies(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.9, 10.0.0.1')
+        self.assertEqual(activity.client_ip(request), '10.0.0.2')
+        # The outermost trusted proxy appended the client; 6.6.6.6 was forged by it
+        with self.settings(NECROSIS_TRUSTED_PROXY_COUNT=2):
+            self.assertEqual(activity.client_ip(request), '203.0.113.9')
+        with self.settings(NECROSIS_TRUSTED_PROXY_COUNT=4):
+            self.assertEqual(activity.client_ip(request), '10.0.0.2')
+
+    @override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, NECROSIS_RESULT_CACHE_ENABLED=False)
+    def test_uploads_and_queued_jobs_are_logged(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        # The second, anonymous upload has no user to log against; the view
+        # builds its result URL from the Host header
+        for c in (client, APIClient()):
+            response = c.post('/image_upload/', {'image': encoded_image()}, HTTP_HOST='testserver')
+            self.assertEqual(response.status_code, 201)
+        job_id = client.post('/api/analyze/jobs/', {'images': [encoded_image()]}, format='multipart').data['job_id']
+        activity.activity_writer.flush()
+        upload, job = UserActivityLog.objects.order_by('timestamp')
+        self.assertEqual(upload.activity_type, 'upload')
+        self.assertEqual((job.activity_type, job.context_data),
+                         ('analyze', {'session_id': job_id, 'images': 1, 'queued': True}))
+
+    def test_drop_policy_bounds_the_queue(self):
+        for policy, kept in (('oldest', ['2', '3']), ('newest', ['0', '1'])):
+            writer = ActivityLogWriter(batch_size=100, flush_interval=3600, max_queue=2, drop_policy=policy)
+            with mock.patch.object(writer, '_run'):
+                for i in range(4):
+                    writer.record(UserActivityLog(user=self.user, activity_type=str(i)))
+            self.assertEqual(writer.stats()['dropped'], 2)
+            self.assertEqual([entry.activity_type for entry in writer._queue], kept)
+
+    def test_failed_batches_are_retried_then_requeued(self):
+        writer = ActivityLogWriter(batch_size=100, flush_interval=3600, max_queue=3)
+        with mock.patch.object(writer, '_run'):
+            for i in range(2):
+                writer.record(UserActivityLog(user=self.user, activity_type=str(i)))
+        bulk_create = UserActivityLog.objects.bulk_create
+        failures = [DatabaseError('gone away')]
+
+        def fail_once(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(UserActivityLog.objects, 'bulk_create', side_effect=fail_once) as write:
+            self.assertEqual(writer.flush(), 2)
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(UserActivityLog.objects.count(), 2)
+
+        with mock.patch.object(writer, '_run'):
+            for i in range(2, 4):
+                writer.record(UserActivityLog(user=self.user, activity_type=str(i)))
+        with mock.patch.object(UserActivityLog.objects, 'bulk_create', side_effect=DatabaseError('gone away')):
+            self.assertEqual(writer.flush(), 0)
+        with mock.patch.object(writer, '_run'):
+            writer.record(UserActivityLog(user=self.user, activity_type='4'))
+            writer.record(UserActivityLog(user=self.user, activity_type='5'))
+        # Back at the head of the queue, the oldest dropped once it is full
+        self.assertEqual([entry.activity_type for entry in writer._queue], ['3', '4', '5'])
+        self.assertEqual(writer.stats()['dropped'], 1)
+        self.assertEqual(writer.flush(), 3)
+
+    def test_rejected_entries_do_not_block_the_queue(self):
+        writer = ActivityLogWriter(batch_size=100, flush_interval=3600)
+        with mock.patch.object(writer, '_run'):
+            for activity_type in ('upload', 'poisoned', 'login'):
+                writer.record(UserActivityLog(user=self.user, activity_type=activity_type))
+        bulk_create = UserActivityLog.objects.bulk_create
+
+        def refuse_poisoned(objs, *args, **kwargs):
+            if any(entry.activity_type == 'poisoned' for entry in objs):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return bulk_create(objs, *args, **kwargs)
+
+        with mock.patch.object(UserActivityLog.objects, 'bulk_create', side_effect=refuse_poisoned):
+            self.assertEqual(writer.flush(), 2)
+        self.assertEqual(sorted(UserActivityLog.objects.values_list('activity_type', flat=True)), ['login', 'upload'])
+        self.assertEqual(writer.stats(), {'queued': 0, 'written': 2, 'dropped': 0, 'rejected': 1})
+        self.assertEqual(writer.flush(), 0)
+
+    def test_shutdown_flushes_queued_events(self):
+        writer = ActivityLogWriter(batch_size=100, flush_interval=3600)
+        # No flusher thread: its connection would not see this test's user
+        with mock.patch.object(writer, '_run'):
+            writer.record(UserActivityLog(user=self.user, activity_type='upload'))
+            writer.shutdown()
+        self.assertEqual(UserActivityLog.objects.get().activity_type, 'upload')
+
+    def test_benchmark_environment_leaves_no_events_behind(self):
+        writer = ActivityLogWriter(batch_size=100, flush_interval=3600)
+        queued_at_teardown = []
+
+        def destroy_test_db(*args, **kwargs):
+            queued_at_teardown.append(writer.stats()['queued'])
+
+        with mock.patch.object(writer, '_run'), mock.patch('necrosis.activity.activity_writer', writer), \
+                mock.patch.object(connection.creation, 'create_test_db'), \
+                mock.patch.object(connection.creation, 'destroy_test_db', side_effect=destroy_test_db), \
+                mock.patch('necrosis.benchmarks.setup_test_environment'), \
+                mock.patch('necrosis.benchmarks.teardown_test_environment'):
+            with isolated_environment():
+                writer.record(UserActivityLog(user=self.user, activity_type='analyze'))
+            # Written before the test database is destroyed
+            self.assertEqual(UserActivityLog.objects.count(), 1)
+            with mock.patch.object(UserActivityLog.objects, 'bulk_create', side_effect=DatabaseError('gone away')):
+                with isolated_environment():
+                    writer.record(UserActivityLog(user=self.user, activity_type='analyze'))
+        # Events that could not be written are dropped, not left for a later flush
+        self.assertEqual(queued_at_teardown, [0, 0])
+        self.assertEqual(writer.stats()['queued'], 0)
+        self.assertEqual(UserActivityLog.objects.count(), 1)
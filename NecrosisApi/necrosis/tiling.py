@@ -0,0 +1,117 @@
+"""
+Tiled inference for high resolution images.
+
+The model letterboxes its input down to its own size, so on 20+ MP
+cross-sections small lesions shrink to a few pixels and are lost. TiledModel
+wraps the model with the same call interface: each large image gets one
+whole-image pass, which finds the root (it spans the image and survives the
+downscaling), and is then cut into overlapping tiles covering the root's
+bounding box. The tiles go through the model at most ``max_tiles`` at a time,
+which bounds memory, and their lesion polygons are shifted back to image
+coordinates.
+
+Lesions cut by a tile seam are detected twice or in pieces, so the lesion
+polygons of all tiles and of the whole-image pass are merged by mask union:
+they are painted into one full resolution mask and its outer contours become
+the final lesion polygons. The result is a Detections object, which
+process_results consumes like a regular model result.
+"""
+import cv2
+import numpy as np
+
+from .ingest import load_image
+from .utilities import Detections
+
+ROOT_CLASS = 0
+LESION_CLASS = 1
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Start offsets of tiles of ``tile_size`` overlapping by ``overlap`` along
+    one axis of ``length`` pixels. The last tile ends on the edge.
+    """
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    origins = list(range(0, length - tile_size, step))
+    origins.append(length - tile_size)
+    return origins
+
+
+def tile_boxes(shape, tile_size, overlap, region=None):
+    """
+    (x0, y0, x1, y1) boxes of the tiles covering an image of ``shape``
+    (height, width), keeping only those intersecting ``region`` (x0, y0,
+    x1, y1) when given.
+    """
+    height, width = shape
+    boxes = []
+    for y in tile_origins(height, tile_size, overlap):
+        for x in tile_origins(width, tile_size, overlap):
+            box = (x, y, min(x + tile_size, width), min(y + tile_size, height))
+            if region is None or (box[0] < region[2] and region[0] < box[2]
+                                  and box[1] < region[3] and region[1] < box[3]):
+                boxes.append(box)
+    return boxes
+
+
+def _polygons(results, cls):
+    if results.masks is None:
+        return []
+    classes = [int(c) for c in results.boxes.cls.tolist()]
+    return [np.asarray(results.masks.xy[i], dtype=np.float32) for i, c in enumerate(classes)
+            if c == cls and len(results.masks.xy[i]) >= 3]
+
+
+def merge_polygons(polygons, shape):
+    """
+    Union of ``polygons`` (pixel coordinates) as a list of outer contours.
+    """
+    mask = np.zeros(shape, np.uint8)
+    for polygon in polygons:
+        cv2.fillPoly(mask, [np.round(polygon).astype(np.int32)], color=255)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [c.reshape(-1, 2).astype(np.float32) for c in contours if len(c) >= 3]
+
+
+class TiledModel:
+    """
+    Model wrapper running tiled inference on images with more than
+    ``min_pixels`` pixels; smaller images go through the model unchanged.
+    """
+
+    def __init__(self, mdl, tile_size=1280, overlap=256, max_tiles=8, min_pixels=12_000_000):
+        if not 0 <= overlap < tile_size:
+            raise ValueError('The tile overlap must be smaller than the tile size')
+        self.mdl = mdl
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self.min_pixels = min_pixels
+
+    def __call__(self, sources, **kwargs):
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        images = [load_image(source) for source in sources]
+        whole = self.mdl(images, **kwargs)
+        return [self._tiled(image, results, source, **kwargs)
+                if image.shape[0] * image.shape[1] > self.min_pixels else results
+                for image, results, source in zip(images, whole, sources)]
+
+    def _tiled(self, image, results, source, **kwargs):
+        roots = _polygons(results, ROOT_CLASS)
+        if not roots:
+            return results
+        x, y, w, h = cv2.boundingRect(np.round(roots[0]).astype(np.int32))
+        boxes = tile_boxes(image.shape[:2], self.tile_size, self.overlap, region=(x, y, x + w, y + h))
+        lesions = _polygons(results, LESION_CLASS)
+        for start in range(0, len(boxes), self.max_tiles):
+            chunk = boxes[start:start + self.max_tiles]
+            tiles = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in chunk]
+            for (x0, y0, _, _), tile_results in zip(chunk, self.mdl(tiles, **kwargs)):
+                lesions += [polygon + np.array([x0, y0], dtype=np.float32)
+                            for polygon in _polygons(tile_results, LESION_CLASS)]
+        lesions = merge_polygons(lesions, image.shape[:2])
+        path = source if isinstance(source, str) else getattr(results, 'path', '')
+        return Detections([ROOT_CLASS] + [LESION_CLASS] * len(lesions), [roots[0]] + lesions, image, path=path)
@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.urls import path, include
-from . import views
+from . import async_views, views
+from .metrics import metrics_view
 from .views import RegisterAPIView, UserDetailAPIView, DeleteSessionImagesAPIView, LatestSessionResultsAPIView, UserSessionsAPIView, DeleteAnalysisSessionAPIView, SessionResultsAPIView, UpdateSessionNameAPIView, DownloadSessionImagesAPIView, EmailAuthTokenAPIView, ResetPasswordAPIView
 
 app_name = 'necrosis'
@@ -8,6 +10,8 @@ urlpatterns = [
     path('image_upload/', views.ImageUploadAPIView.as_view(), name='image_upload'),
     path('upload/', views.upload_image_view, name='upload_image'),
     path('api/analyze/', views.AnalyzeImagesAPIView.as_view(), name='analyze_images'),
+    path('api/analyze/jobs/', views.SubmitAnalysisJobAPIView.as_view(), name='submit_analysis_job'),
+    path('api/analyze/jobs/<str:job_id>/', views.AnalysisJobStatusAPIView.as_view(), name='analysis_job_status'),
     path('api/register/', RegisterAPIView.as_view(), name='register'),
     path('api/login/', EmailAuthTokenAPIView.as_view(), name='login'),
     path('api/user/<str:email>/', UserDetailAPIView.as_view(), name='user_detail'),
@@ -17,6 +21,25 @@ urlpatterns = [
     path('api/sessions/<str:session_id>/', DeleteAnalysisSessionAPIView.as_view(), name='delete_analysis_session'),
     path('api/session_results/<str:session_id>/', SessionResultsAPIView.as_view(), name='session_results'),
     path('api/sessions/<str:session_id>/name/', UpdateSessionNameAPIView.as_view(), name='update_session_name'),
-    path('api/sessions/<str:session_id>/download_images/', DownloadSessionImagesAPIView.as_view(), name='download_session_images'),
+    path('api/sessions/<str:session_id>/report/<str:file_format>/', views.SessionReportAPIView.as_view(),
+         name='session_report'),
+    # Under ASGI the sync view's stream would be read into memory before the first byte is sent
+    path('api/sessions/<str:session_id>/download_images/',
+         async_views.download_session_images if settings.NECROSIS_ASGI else DownloadSessionImagesAPIView.as_view(),
+         name='download_session_images'),
+    path('api/cleanups/<str:cleanup_id>/', views.CleanupStatusAPIView.as_view(), name='cleanup_status'),
+    path('api/overlays/<str:token>/', views.ImageOverlayAPIView.as_view(), name='image_overlay'),
+    path('api/previews/<str:token>/<str:kind>/<int:width>/', views.ImagePreviewAPIView.as_view(),
+         name='image_preview'),
+    path('api/previews/<int:image_id>/<str:signature>/<str:name>', views.ImagePreviewFileAPIView.as_view(),
+         name='image_preview_file'),
     path('api/reset_password/', ResetPasswordAPIView.as_view(), name='reset_password'),
+    # Async versions of the endpoints above, for ASGI deployments (see necrosis.async_views)
+    path('api/async/analyze/', async_views.analyze_images, name='async_analyze_images'),
+    path('api/async/latest_session_results/', async_views.latest_session_results,
+         name='async_latest_session_results'),
+    path('api/async/session_results/<str:session_id>/', async_views.session_results, name='async_session_results'),
+    path('api/async/sessions/<str:session_id>/download_images/', async_views.download_session_images,
+         name='async_download_session_images'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
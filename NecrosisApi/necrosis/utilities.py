@@ -1,23 +1,43 @@
 import numpy
-import torch
 import os
 from PIL import Image, ImageDraw
 import io
 import json
 import cv2
 import numpy as np
+import logging
+import time
+import uuid
+from types import SimpleNamespace
+from django.conf import settings
+from . import metrics
+from .areas import necrosis_areas
+from .ingest import read_image
 
 FIL_DIR = os.path.dirname((os.path.abspath(__file__)))
 # model_path = torch.hub.load('ultralytics/yolov5', 'custom', FIL_DIR+'/weights/best-sol.pt')
 img_upload_dir = os.path.join(FIL_DIR, "files/uploads/")
 img_results_dir = os.path.join(FIL_DIR, '../media/results/')
 
+logger = logging.getLogger(__name__)
+
 
 def save_image(img_data, img_name, save_to=img_upload_dir):
     input_image = Image.open(img_data.file).convert("RGB")
     input_image.save(os.path.join(save_to, img_name))
 
 
+def store_upload(upload, upload_dir='uploads/images/'):
+    """
+    Writes an uploaded file chunk by chunk to default storage under a unique
+    name and returns its storage path.
+    """
+    from django.core.files.storage import default_storage
+
+    unique_name = f'{uuid.uuid4()}_{upload.name}'
+    return default_storage.save(os.path.join(upload_dir, unique_name), upload)
+
+
 def process_image(img_path, mdl):
     input_image = Image.open(io.BytesIO(img_path)).convert("RGB")
     print(type(input_image))
@@ -50,24 +70,81 @@ def process_image_v1(img_data, mdl, filename):
 
 
 def process_image_v2(img_path, mdl):
-    input_image = Image.open(img_path).convert("RGB")
-    print(type(input_image))
-    results = mdl(input_image)[0]
+    return process_images_batch([img_path], mdl)[0]
+
+
+def process_images_batch(img_paths, mdl, batch_size=8, names=None, render=True, load=None):
+    """
+    Batched counterpart of process_image_v2.
+    Sends the images through the model ``batch_size`` at a time and fans the
+    per-image results out to process_results. ``img_paths`` may also hold
+    decoded BGR arrays, in which case ``names`` gives their file names, or
+    any items that ``load`` turns into model inputs. ``load`` runs per
+    batch, right before its inference, and the batch is dropped once
+    summarised, so only one batch of decoded images is held at a time.
+    Without ``render`` no overlay PNG is drawn or written (see
+    necrosis.overlays).
+    Returns one process_image_v2 style tuple per image, in input order.
+    """
+    names = names or [os.path.basename(p) for p in img_paths]
+    processed = []
+    for start in range(0, len(img_paths), batch_size):
+        chunk = img_paths[start:start + batch_size]
+        if load is not None:
+            chunk = [load(item) for item in chunk]
+        inference_start = time.perf_counter()
+        batch_results = mdl(chunk)
+        per_image = (time.perf_counter() - inference_start) / max(len(chunk), 1)
+        for name, results in zip(names[start:start + batch_size], batch_results):
+            metrics.observe_stage('inference', per_image, results.orig_shape)
+            processed.append(summarise_results(results, name, render=render))
+        del chunk, batch_results
+    return processed
+
+
+def summarise_results(results, img_name, render=True):
+    classes = [int(c) for c in results.boxes.cls.tolist()]
 
     # Get root box
-    root_boxes = (results.boxes.cls == 0).nonzero(as_tuple=True)[0].tolist()
+    root_boxes = [i for i, c in enumerate(classes) if c == 0]
 
     # Get necrosis boxes
-    nec_boxes = (results.boxes.cls == 1).nonzero(as_tuple=True)[0].tolist()
-    print(root_boxes, nec_boxes)
-    print(results.path)
+    nec_boxes = [i for i, c in enumerate(classes) if c == 1]
+    logger.debug('%s: root boxes %s, necrosis boxes %s', img_name, root_boxes, nec_boxes)
 
-    # Get necrosis masks and root masks
-    root_mask = results.masks.xyn[root_boxes[0]]
+    # Get necrosis masks
     nec_masks = {str(n): results.masks.xyn[n].tolist() for n in nec_boxes}
 
-    pr = process_results(results, nec_boxes, root_boxes, img_results_dir, os.path.basename(img_path))
-    return pr, os.path.basename(img_path).replace('.jpg', '.png'), len(nec_boxes), nec_masks
+    pr = process_results(results, nec_boxes, root_boxes, img_results_dir, img_name, save_result=render)
+    return pr, img_name.replace('.jpg', '.png'), len(nec_boxes), nec_masks
+
+
+class Detections:
+    """
+    Minimal stand-in for an ultralytics Results object, built from plain class
+    ids and mask polygons (pixel coordinates). Carries everything
+    summarise_results and process_results read. Without ``orig_img``, the
+    image at ``path`` is only read (with ingest.read_image) if orig_img is
+    used, e.g. to draw an overlay; ``orig_shape`` then gives its (height,
+    width).
+    """
+
+    def __init__(self, classes, polygons, orig_img=None, path='', orig_shape=None):
+        height, width = orig_shape or orig_img.shape[:2]
+        self.boxes = SimpleNamespace(cls=np.asarray(classes, dtype=np.float32))
+        self.masks = SimpleNamespace(
+            xy=polygons,
+            xyn=[p / np.array([width, height], dtype=np.float32) for p in polygons],
+        )
+        self._orig_img = orig_img
+        self.orig_shape = (height, width)
+        self.path = path
+
+    @property
+    def orig_img(self):
+        if self._orig_img is None:
+            self._orig_img = read_image(self.path)
+        return self._orig_img
 
 
 # def get_necrosis_percentage(necrosis_masks, root_mask,):
@@ -77,7 +154,8 @@ def process_image_v2(img_path, mdl):
 #     pass
 
 
-def process_results(model_results, necrosis_idx, root_idx, save_dir, img_path, save_result=True, save_mask=False):
+def process_results(model_results, necrosis_idx, root_idx, save_dir, img_path, save_result=True, save_mask=False,
+                    area_method=None):
     """
     Function to process the results from the model.
     Performs background removal and saves masks.
@@ -88,65 +166,33 @@ def process_results(model_results, necrosis_idx, root_idx, save_dir, img_path, s
     # img_mask = Image.new('RGBA', model_results.orig_shape, color='black')
     # poly_mask = img_rgb.copy()
     # img_draw = ImageDraw.Draw(img_mask)
-    #
-    root_mask = np.zeros(model_results.orig_shape, np.uint8)
-    nec_mask = np.zeros(model_results.orig_shape, np.uint8)
-    # fill_mask = ''
-    # pil_mask = Image.fromarray(cv2.cvtColor(img_rgb, cv2.COLOR_BGR2RGBA),  'RGBA')
-    # # pil_mask = Image.fromarray(cv2.cvtColor(img_rgb, cv2.COLOR_BGR2RGB))
-    # # pil_mask = Image.fromarray(img_rgb)
-    # pil_draw = ImageDraw.Draw(pil_mask, 'RGBA')
-    # img_draw.polygon(model_results.masks.xy[root_idx[0]], fill=(255,0,0, 255))
-    #
-    # root_pixels = model_results.masks.xy[root_idx[0]].shape[0]
-
-    cv2.fillPoly(root_mask, [model_results.masks.xy[root_idx[0]].astype('int')], color=[255])
-    root_area = cv2.countNonZero(root_mask)
-    # contours, hierarchy = cv2.findContours(root_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    # root_contour_area = sum([cv2.contourArea(c) for c in contours])
-    print(root_area)
-    # print(root_contour_area)
-
-    # root_mask_draw = ImageDraw.Draw(root_mask)
-    # root_mask_draw.polygon(root_pixels, fill=255)s
-    # print(type(root_mask))
-    # root_mask = cv2.fillPoly(img_rgb, root_pixels, color=(0, 255, 0))
-    nec_pixels = 0
-    for n in necrosis_idx:
-        mask_points = [model_results.masks.xy[n].astype('int')]  # Get mask x and y points
-        # print(mask_points[0])
-        nec_pixels += model_results.masks.xy[n].shape[0]
-
-        # pil_draw.polygon(model_results.masks.xy[n], fill=(255, 0, 0, 230))
-
-        # fill_mask = cv2.fillPoly(img_mask, mask_points, color=(0, 255, 0))  # Fill detected mask polygon
-        # cv2.fillPoly(img_rgb, mask_points, color=(0, 255, 0))
-        cv2.fillPoly(nec_mask, mask_points, color=[255])
-        cv2.polylines(img_rgb, mask_points, color=(255, 0, 0), thickness=6, isClosed=True)
-
-        # img_draw.polygon(model_results.masks.xy[n], fill=(0, 255, 0))
-        # pil_draw.polygon(model_results.masks.xy[n], fill=(0, 255, 0, 100))
-
-    nec_area = cv2.countNonZero(nec_mask)
-    print(nec_area)
+
+    shape = model_results.orig_shape
+    # Areas come straight from the polygons, see necrosis.areas
+    with metrics.timer('areas', shape):
+        root_area, nec_area = necrosis_areas(
+            model_results.masks.xy[root_idx[0]],
+            [model_results.masks.xy[n] for n in necrosis_idx],
+            shape,
+            method=area_method or settings.NECROSIS_AREA_METHOD,
+        )
 
     # seg_rgb = cv2.bitwise_and(img_rgb, img_rgb, mask=fill_mask)  # Segment original image
 
     nec_per = (nec_area/root_area)* 100
+    logger.debug('%s: root area %s, necrosis area %s, %.2f%% necrosis', img_path, root_area, nec_area, nec_per)
 
-    print(f'Orig: {nec_per}')
-    print(f'New: {(nec_area/root_area) * 100}')
-
-    cv2.putText(img_rgb, f'{nec_per:.2f}%', (int(model_results.orig_shape[1]/2), 100), color=(255, 0, 0),
-                thickness=5, fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=5)
     # pil_draw.text((int(model_results.orig_shape[1]/2), 100), f'{nec_per:.2f}%', fill=(0, 0, 255), font_size=50)
 
     if save_result:
+        with metrics.timer('overlay', shape):
+            draw_overlay(img_rgb, [model_results.masks.xy[n] for n in necrosis_idx], nec_per)
         # cv2.imwrite(save_dir + img_path, img_rgb)
         # pil_mask.save(os.path.join(save_dir, 'pillow-'+img_path.replace('.jpg', '.png')))
         # pil_mask.save(os.path.join(save_dir, img_path.replace('.jpg', '.png')))
         # cv2.imwrite(os.path.join(save_dir, 'poly-' + img_path.replace('.jpg', '.png')), poly_mask)
-        cv2.imwrite(os.path.join(save_dir, img_path.replace('.jpg', '.png')), img_rgb)
+        with metrics.timer('image_write', shape):
+            cv2.imwrite(os.path.join(save_dir, img_path.replace('.jpg', '.png')), img_rgb)
         # cv2.imwrite(save_dir + "ann-" + img_name, img_rgb)
     # if save_mask:
     #     # cv2.imwrite(save_dir + "/masks-"+img_path, fill_mask)
@@ -162,6 +208,20 @@ def process_results(model_results, necrosis_idx, root_idx, save_dir, img_path, s
 #     results = mdl(pil_files)
 
 
+def draw_overlay(img, lesion_polygons, nec_per, scale=1.0):
+    """
+    Draws the lesion outlines (pixel coordinates) and the necrosis percentage
+    onto ``img`` in place. ``scale`` shrinks lines and text along with a
+    downscaled image.
+    """
+    for polygon in lesion_polygons:
+        mask_points = [np.asarray(polygon).astype('int')]  # Get mask x and y points
+        cv2.polylines(img, mask_points, color=(255, 0, 0), thickness=max(1, round(6 * scale)), isClosed=True)
+    cv2.putText(img, f'{nec_per:.2f}%', (int(img.shape[1]/2), max(1, round(100 * scale))), color=(255, 0, 0),
+                thickness=max(1, round(5 * scale)), fontFace=cv2.FONT_HERSHEY_PLAIN, fontScale=5 * scale)
+    return img
+
+
 def draw_annotations(img_data, detections):
     img = np.asarray(Image.open(img_data.file).convert("RGB"))
     # print(type(img))
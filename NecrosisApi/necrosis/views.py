@@ -1,36 +1,55 @@
 from django.shortcuts import render
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import Image
 from rest_framework import status
+from rest_framework.exceptions import ParseError
 from django.views.decorators.csrf import csrf_exempt
-from .utilities import process_image_v2
-import os
-from ultralytics import YOLO
+from .ingest import IngestedImage, ingest_uploads
+from .result_cache import cached_process_images
+from .zipstream import stream_zip
+from . import metrics
+from .pagination import ImageCursorPagination, SessionCursorPagination, selected_fields, wants_pagination
+from .polygons import EXPANDED, POLYGON_FORMATS, encode_polygons, lesions_for
+import logging
+import time
 from rest_framework.parsers import MultiPartParser, FormParser
 from .serializers import UserSerializer, AnalysisSessionSerializer
 from .models import User, AnalysisSession, CassavaImage
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework.authentication import TokenAuthentication
-from django.core.files.storage import default_storage
-import zipfile
-import io
+from .activity import log_activity
+from .authentication import CachedTokenAuthentication
 from django.http import StreamingHttpResponse
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import authenticate
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.urls import reverse
+from .jobs import enqueue_images, job_status
+from .cleanup import cleanup_status, clear_session_images, delete_session
+from .aggregates import SUMMARY_COLUMNS, add_images, session_summary
+from .inference import LazyModel
+from .overlays import OVERLAY_COLUMNS, overlay_file, overlay_url, unsign_image_id, zip_entries
+from .reports import FORMATS as REPORT_FORMATS, session_report
+from .previews import KINDS as PREVIEW_KINDS, PREVIEW_NAME, content_type, file_signature, preview_dir, preview_file, \
+    preview_urls, schedule_previews, unsign_preview_id, valid_file_signature
+
 
+logger = logging.getLogger(__name__)
 
-FIL_DIR = os.path.dirname((os.path.abspath(__file__)))
-model_path = os.path.join(FIL_DIR, "../media/models/exp_new-Sep-24_yolov8n-seg_24-09-27_13_26/best.pt")
-model = YOLO(model_path)
+# Loaded on first inference, see necrosis.inference
+model = LazyModel()
 
 
 # Create your views here.
 def index(request):
     # print(request.META['HTTP_HOST'])
     # print(request.get_host())
-    print(request.build_absolute_uri())
+    logger.debug('index requested at %s', request.build_absolute_uri())
     return HttpResponse("Hello World")
 
 
@@ -43,11 +62,9 @@ class ImageUploadAPIView(APIView):
         if image:
             instance = Image(image=image)
             instance.save()
-            print(instance.image.path)
 
-            res = process_image_v2(instance.image.path, model)
-            # print(len(res))
-            print(res)
+            res = cached_process_images([instance.image.path], model)[0]
+            log_activity(request, 'upload', image=instance.pk)
             out = {"percentage_necrosis": res[0], "lesion_count": res[2],
                    "image": f'{ request.scheme }://{ request.META["HTTP_HOST"]}/results/{res[1]}',
                    "necrosis_lesions": res[3]}
@@ -78,7 +95,7 @@ def upload_image_view(request):
         image = request.FILES["image"]
         instance = Image(image=image)
         instance.save()
-        res = process_image_v2(instance.image.path, model)
+        res = cached_process_images([instance.image.path], model)[0]
         result = {
             "percentage_necrosis": res[0],
             "lesion_count": res[2],
@@ -87,17 +104,55 @@ def upload_image_view(request):
         message = "Image submitted successfully"
     return render(request, "upload.html", {"result": result, "message": message})
 
+def store_analysis(session, names, upload_paths, processed):
+    """
+    Adds the analysed images to the session: one transaction per batch, all
+    rows or none. Returns the created images and the seconds spent writing.
+    """
+    db_start = time.perf_counter()
+    with metrics.timer('db_write'), transaction.atomic():
+        images = CassavaImage.objects.bulk_create([
+            CassavaImage(
+                session=session,
+                original_image=upload_path,
+                # Without an eager overlay it is rendered on request, see necrosis.overlays
+                processed_image=f'results/{res[1]}' if settings.NECROSIS_EAGER_OVERLAYS else '',
+                image_name=name,
+                total_lesions=res[2],
+                necrosis_percentage=res[0],
+                lesion_polygons=encode_polygons(res[3]),
+            )
+            for name, upload_path, res in zip(names, upload_paths, processed)
+        ])
+        # Fold the new images into the session aggregates
+        add_images(session.id, [(res[0], res[2]) for res in processed])
+        schedule_previews(images)
+    return images, time.perf_counter() - db_start
+
+
+def analysis_results(request, images, processed):
+    return [
+        {
+            "filename": img.image_name,
+            "percentage_necrosis": res[0],
+            "lesion_count": res[2],
+            "result_image": f'{request.scheme}://{request.get_host()}/media/results/{res[1]}'
+            if img.processed_image else overlay_url(request, img),
+            "necrosis_lesions": res[3],
+        }
+        for img, res in zip(images, processed)
+    ]
+
+
 class AnalyzeImagesAPIView(APIView):
     parser_classes = (MultiPartParser, FormParser)
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
         user = request.user
         files = request.FILES.getlist('images')
-        results = []
         import uuid
-        from django.core.files.base import File
         session_id = request.data.get('session_id')
         session = None
         # Try to use existing session if provided and valid
@@ -114,42 +169,67 @@ class AnalyzeImagesAPIView(APIView):
                 session_id=session_id,
                 num_images=0,
             )
-        # Add images to session
-        for file in files:
-            unique_name = f'{uuid.uuid4()}_{file.name}'
-            upload_path = os.path.join('uploads/images/', unique_name)
-            full_upload_path = os.path.join(default_storage.location, upload_path)
-            with default_storage.open(upload_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
-            res = process_image_v2(full_upload_path, model)
-            cassava_img = CassavaImage.objects.create(
-                session=session,
-                original_image=upload_path,
-                processed_image=f'results/{res[1]}',
-                image_name=file.name,
-                total_lesions=res[2],
-                necrosis_percentage=res[0],
-                metadata={'necrosis_lesions': res[3]},
-            )
-            out = {
-                "filename": file.name,
-                "percentage_necrosis": res[0],
-                "lesion_count": res[2],
-                "result_image": f'{request.scheme}://{request.get_host()}/media/results/{res[1]}',
-                "necrosis_lesions": res[3],
-            }
-            results.append(out)
-        # Update session image count
-        session.num_images = session.cassava_images.count()
-        session.save()
+        # Uploads are decoded once, one inference batch at a time; the originals are stored in the background
+        images = ingest_uploads(files)
+        processed = cached_process_images(
+            images, model,
+            batch_size=settings.NECROSIS_INFERENCE_BATCH_SIZE,
+            names=[img.stored_name for img in images],
+            digests=[img.digest for img in images],
+            render=settings.NECROSIS_EAGER_OVERLAYS,
+            load=IngestedImage.decode,
+        )
+        # Wait for the originals to be stored before referencing them
+        upload_paths = [img.upload_path for img in images]
+        names = [file.name for file in files]
+        rows, db_seconds = store_analysis(session, names, upload_paths, processed)
+        log_activity(request, 'analyze', session_id=session.session_id, images=len(files))
         return Response({
-            "results": results,
+            "results": analysis_results(request, rows, processed),
             "session_id": session.session_id,
             "created_at": session.created_at,
+            "timing": {
+                "db_seconds": db_seconds,
+                "db_ms_per_image": db_seconds * 1000 / len(files) if files else 0.0,
+            },
         }, status=status.HTTP_200_OK)
 
 
+class SubmitAnalysisJobAPIView(APIView):
+    """
+    Queues the uploaded images for background analysis and returns the job id
+    (the session_id) right away. Progress is polled on AnalysisJobStatusAPIView.
+    """
+    parser_classes = (MultiPartParser, FormParser)
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        files = request.FILES.getlist('images')
+        if not files:
+            return Response({'detail': 'No images found in request.'}, status=status.HTTP_400_BAD_REQUEST)
+        session = enqueue_images(request.user, files, session_id=request.data.get('session_id'))
+        log_activity(request, 'analyze', session_id=session.session_id, images=len(files), queued=True)
+        return Response({
+            'job_id': session.session_id,
+            'status': session.status,
+            'num_images': len(files),
+            'created_at': session.created_at,
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class AnalysisJobStatusAPIView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        try:
+            session = AnalysisSession.objects.get(session_id=job_id, user=request.user)
+        except AnalysisSession.DoesNotExist:
+            return Response({'detail': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_status(session), status=status.HTTP_200_OK)
+
+
 class RegisterAPIView(APIView):
     """
     API endpoint for registering a new user (regular).
@@ -169,7 +249,7 @@ class UserDetailAPIView(APIView):
     """
     API endpoint to fetch or update user details (email, contact, organisation) by email. Requires authentication.
     """
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request, email):
@@ -199,8 +279,15 @@ class UserDetailAPIView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+def wants_background(request):
+    value = request.query_params.get('background')
+    if value is None:
+        return settings.NECROSIS_CLEANUP_BACKGROUND
+    return value.lower() in ('1', 'true', 'yes')
+
+
 class DeleteSessionImagesAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
@@ -209,27 +296,80 @@ class DeleteSessionImagesAPIView(APIView):
         session = AnalysisSession.objects.filter(user=user).order_by('-created_at').first()
         if not session:
             return Response({'message': 'No session found.'}, status=status.HTTP_404_NOT_FOUND)
-        # Delete images for all CassavaImage in this session
-        for img in session.cassava_images.all():
-            if img.original_image:
-                try:
-                    default_storage.delete(img.original_image.path)
-                except Exception:
-                    pass
-                img.original_image.delete(save=False)
-            if img.processed_image:
-                try:
-                    default_storage.delete(img.processed_image.path)
-                except Exception:
-                    pass
-                img.processed_image.delete(save=False)
-            img.original_image = None
-            img.processed_image = None
-            img.save()
-        return Response({'message': 'Images deleted, text results retained.'}, status=status.HTTP_200_OK)
+        # Blank the file fields in one update and delete the files in parallel
+        background = wants_background(request)
+        outcome = clear_session_images(session, user, background=background)
+        log_activity(request, 'delete_images', session_id=session.session_id)
+        return Response({'message': 'Images deleted, text results retained.', **outcome},
+                        status=status.HTTP_202_ACCEPTED if background else status.HTTP_200_OK)
+
+# Result fields clients can pick with ?fields=, and the model fields each needs
+IMAGE_RESULT_FIELDS = {
+    'filename': ('image_name',),
+    'percentage_necrosis': ('necrosis_percentage',),
+    'lesion_count': ('total_lesions',),
+    'result_image': ('original_image', 'processed_image'),
+    'necrosis_lesions': ('lesion_polygons', 'metadata'),
+    'previews': ('original_image', 'processed_image'),
+}
+# Session list fields, and the AnalysisSession columns each needs
+SESSION_LIST_FIELDS = {
+    'session_id': ('session_id',),
+    'created_at': ('created_at',),
+    'num_images': ('num_images',),
+    'session_name': ('session_name',),
+    'summary': SUMMARY_COLUMNS,
+}
+
+
+def image_result_value(request, img, field, polygon_format):
+    if field == 'filename':
+        return img.image_name
+    if field == 'percentage_necrosis':
+        return img.necrosis_percentage
+    if field == 'lesion_count':
+        return img.total_lesions
+    if field == 'necrosis_lesions':
+        return lesions_for(img, polygon_format)
+    if field == 'previews':
+        return preview_urls(request, img)
+    # Overlays are rendered when first requested; none once the images are deleted
+    if img.original_image or img.processed_image:
+        return overlay_url(request, img)
+    return None
+
+
+def session_results_data(request, view, session, **extra):
+    """
+    Results of a session's images, limited to the requested ?fields= and
+    loading only the columns those need. Paginated by cursor when the client
+    asks for it (see necrosis.pagination).
+    """
+    polygon_format = request.query_params.get('polygons', EXPANDED)
+    if polygon_format not in POLYGON_FORMATS:
+        raise ParseError(f'polygons must be one of {", ".join(POLYGON_FORMATS)}.')
+    fields = selected_fields(request, IMAGE_RESULT_FIELDS)
+    # session_id stays loaded: the related manager attaches the session to each row
+    columns = {'id', 'session'}.union(*(IMAGE_RESULT_FIELDS[f] for f in fields))
+    images = session.cassava_images.only(*columns).order_by('id')
+    paginator = None
+    if wants_pagination(request):
+        paginator = ImageCursorPagination()
+        images = paginator.paginate_queryset(images, request, view=view)
+    results = [{f: image_result_value(request, img, f, polygon_format) for f in fields} for img in images]
+    data = {'results': results, 'session_id': session.session_id, **extra, 'polygons': polygon_format,
+            'summary': session_summary(session)}
+    if paginator:
+        data.update(next=paginator.get_next_link(), previous=paginator.get_previous_link())
+    return data
+
+
+def session_results_response(request, view, session, **extra):
+    return Response(session_results_data(request, view, session, **extra), status=status.HTTP_200_OK)
+
 
 class LatestSessionResultsAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -237,37 +377,30 @@ class LatestSessionResultsAPIView(APIView):
         session = AnalysisSession.objects.filter(user=user).order_by('-created_at').first()
         if not session:
             return Response({'results': []}, status=status.HTTP_200_OK)
-        results = []
-        for img in session.cassava_images.all():
-            results.append({
-                'filename': img.image_name,
-                'percentage_necrosis': img.necrosis_percentage,
-                'lesion_count': img.total_lesions,
-                'result_image': None,  # No image returned
-                'necrosis_lesions': img.metadata.get('necrosis_lesions') if img.metadata else None,
-            })
-        return Response({'results': results, 'session_id': session.session_id}, status=status.HTTP_200_OK)
+        return session_results_response(request, self, session)
 
 class UserSessionsAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         user = request.user
-        sessions = AnalysisSession.objects.filter(user=user).order_by('-created_at')
-        data = [
-            {
-                'session_id': s.session_id,
-                'created_at': s.created_at,
-                'num_images': s.num_images,
-                'session_name': s.session_name,  # Added to persist custom session names
-            }
-            for s in sessions
-        ]
+        fields = selected_fields(request, SESSION_LIST_FIELDS)
+        # created_at is always loaded, the cursor is built from it
+        columns = dict.fromkeys(['created_at', *(c for f in fields for c in SESSION_LIST_FIELDS[f])])
+        sessions = AnalysisSession.objects.filter(user=user).order_by('-created_at').values(*columns)
+        paginator = None
+        if wants_pagination(request):
+            paginator = SessionCursorPagination()
+            sessions = paginator.paginate_queryset(sessions, request, view=self)
+        data = [{f: session_summary(s) if f == 'summary' else s[f] for f in fields} for s in sessions]
+        if paginator:
+            return Response({'sessions': data, 'next': paginator.get_next_link(),
+                             'previous': paginator.get_previous_link()}, status=status.HTTP_200_OK)
         return Response({'sessions': data}, status=status.HTTP_200_OK)
 
 class DeleteAnalysisSessionAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def delete(self, request, session_id):
@@ -278,24 +411,30 @@ class DeleteAnalysisSessionAPIView(APIView):
             return Response({'detail': 'Session not found.'}, status=status.HTTP_404_NOT_FOUND)
         if session.user != user:
             return Response({'detail': 'Not authorized to delete this session.'}, status=status.HTTP_403_FORBIDDEN)
-        # Delete all related CassavaImage and AnalysisReport (should cascade, but ensure files are deleted)
-        for img in session.cassava_images.all():
-            if img.original_image:
-                try:
-                    default_storage.delete(img.original_image.path)
-                except Exception:
-                    pass
-            if img.processed_image:
-                try:
-                    default_storage.delete(img.processed_image.path)
-                except Exception:
-                    pass
-        # Delete the session (cascades to CassavaImage and AnalysisReport)
-        session.delete()
+        # Delete the session (cascades to CassavaImage and AnalysisReport), then its files
+        background = wants_background(request)
+        outcome = delete_session(session, user, background=background)
+        log_activity(request, 'delete_session', session_id=session_id)
+        if background:
+            return Response(outcome, status=status.HTTP_202_ACCEPTED)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+
+class CleanupStatusAPIView(APIView):
+    """
+    Outcome of a background cleanup: files deleted and bytes reclaimed.
+    """
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, cleanup_id):
+        outcome = cleanup_status(cleanup_id, request.user)
+        if outcome is None:
+            return Response({'detail': 'Cleanup not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(outcome, status=status.HTTP_200_OK)
+
 class SessionResultsAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request, session_id):
@@ -304,19 +443,44 @@ class SessionResultsAPIView(APIView):
             session = AnalysisSession.objects.get(session_id=session_id, user=user)
         except AnalysisSession.DoesNotExist:
             return Response({'detail': 'Session not found.'}, status=status.HTTP_404_NOT_FOUND)
-        results = []
-        for img in session.cassava_images.all():
-            results.append({
-                'filename': img.image_name,
-                'percentage_necrosis': img.necrosis_percentage,
-                'lesion_count': img.total_lesions,
-                'result_image': None,  # No image returned
-                'necrosis_lesions': img.metadata.get('necrosis_lesions') if img.metadata else None,
-            })
-        return Response({'results': results, 'session_id': session.session_id, 'created_at': session.created_at}, status=status.HTTP_200_OK)
+        return session_results_response(request, self, session, created_at=session.created_at)
+
+class SessionReportAPIView(APIView):
+    """
+    Downloads a session's report as CSV, JSON Lines or Parquet. The report
+    is built on first request and served from storage until the session
+    changes; its checksum is the ETag.
+    """
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, session_id, file_format):
+        if file_format not in REPORT_FORMATS:
+            raise ParseError(f'Reports are available as {", ".join(REPORT_FORMATS)}.')
+        try:
+            session = AnalysisSession.objects.get(session_id=session_id, user=request.user)
+        except AnalysisSession.DoesNotExist:
+            return Response({'detail': 'Session not found.'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            report, report_file = session_report(session, file_format)
+        except ImproperlyConfigured as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        etag = f'"{report.checksum}"'
+        if request.headers.get('If-None-Match') == etag:
+            report_file.close()
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            extension, content_type = REPORT_FORMATS[file_format]
+            # The file opened when the report was looked up or built: a
+            # concurrent rebuild replaces it under another inode
+            response = FileResponse(report_file, as_attachment=True,
+                                    filename=f'session_{session_id}{extension}', content_type=content_type)
+            log_activity(request, 'download', session_id=session_id, report=file_format)
+        response['ETag'] = etag
+        return response
 
 class UpdateSessionNameAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def patch(self, request, session_id):
@@ -332,7 +496,7 @@ class UpdateSessionNameAPIView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class DownloadSessionImagesAPIView(APIView):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request, session_id):
@@ -341,25 +505,94 @@ class DownloadSessionImagesAPIView(APIView):
             session = AnalysisSession.objects.get(session_id=session_id, user=user)
         except AnalysisSession.DoesNotExist:
             return Response({'detail': 'Session not found.'}, status=status.HTTP_404_NOT_FOUND)
-        images = session.cassava_images.all()
-        if not images:
+        images = session.cassava_images.exclude(Q(processed_image='') | Q(processed_image=None), original_image='')
+        if not session.cassava_images.exists():
             return Response({'detail': 'No images found for this session.'}, status=status.HTTP_404_NOT_FOUND)
-        # Create a zip in memory
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for img in images:
-                if img.processed_image and img.processed_image.name:
-                    img_path = img.processed_image.path
-                    # Use the original uploaded image name for the zip entry
-                    original_name = img.image_name or img.processed_image.name.split('/')[-1]
-                    try:
-                        with open(img_path, 'rb') as f:
-                            zip_file.writestr(original_name, f.read())
-                    except Exception:
-                        continue
-        zip_buffer.seek(0)
-        response = StreamingHttpResponse(zip_buffer, content_type='application/zip')
+        # Stream the zip: entries are written (and missing overlays rendered) as the files are read
+        entries = zip_entries(images.only(*OVERLAY_COLUMNS).iterator())
+        response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename="session_{session_id}_images.zip"'
+        log_activity(request, 'download', session_id=session_id)
+        return response
+
+def signed_image(token, unsign=unsign_image_id):
+    """
+    The CassavaImage of an overlay URL token (or, with unsign_preview_id,
+    of a preview URL token), or None.
+    """
+    image_id = unsign(token)
+    return CassavaImage.objects.only(*OVERLAY_COLUMNS).filter(pk=image_id).first() if image_id else None
+
+
+class ImageOverlayAPIView(APIView):
+    """
+    Serves the overlay of one image, rendered on first request, at the
+    width given by ?width=, one of NECROSIS_OVERLAY_WIDTHS (full size by
+    default). The URL's signed token
+    authorizes the request, so it works in <img> tags.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, token):
+        img = signed_image(token)
+        if img is None:
+            return Response({'detail': 'Image not found.'}, status=status.HTTP_404_NOT_FOUND)
+        width = request.query_params.get('width')
+        if width is not None and (not width.isdigit() or int(width) not in settings.NECROSIS_OVERLAY_WIDTHS):
+            raise ParseError(f'width must be one of {", ".join(map(str, settings.NECROSIS_OVERLAY_WIDTHS))}.')
+        if width is None and img.processed_image and default_storage.exists(img.processed_image.name):
+            name = img.processed_image.name
+        else:
+            name = overlay_file(img, int(width) if width else None)
+        if name is None:
+            return Response({'detail': 'Image not available.'}, status=status.HTTP_404_NOT_FOUND)
+        response = FileResponse(default_storage.open(name, 'rb'), content_type='image/png')
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+
+
+class ImagePreviewAPIView(APIView):
+    """
+    Redirects to the content-hashed URL of an image's preview at one of the
+    NECROSIS_PREVIEW_WIDTHS, making the preview first if needed. The
+    URL's signed token authorizes the request, as for ImageOverlayAPIView,
+    but does not expire (see necrosis.previews).
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, token, kind, width):
+        if kind not in PREVIEW_KINDS or width not in settings.NECROSIS_PREVIEW_WIDTHS:
+            raise ParseError(f'Previews are made of the {" and ".join(PREVIEW_KINDS)} at widths '
+                             f'{", ".join(map(str, settings.NECROSIS_PREVIEW_WIDTHS))}.')
+        img = signed_image(token, unsign=unsign_preview_id)
+        name = preview_file(img, kind, width) if img else None
+        if name is None:
+            return Response({'detail': 'Image not available.'}, status=status.HTTP_404_NOT_FOUND)
+        file_name = name.rsplit('/', 1)[-1]
+        response = HttpResponseRedirect(reverse('necrosis:image_preview_file',
+                                                args=[img.pk, file_signature(img.pk, file_name), file_name]))
+        response['Cache-Control'] = 'private, max-age=3600'
+        return response
+
+
+class ImagePreviewFileAPIView(APIView):
+    """
+    Serves a preview by its content-hashed name, authorized by a signature
+    of the image id and that name; the content of such a URL never changes.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, image_id, signature, name):
+        valid = PREVIEW_NAME.match(name) and valid_file_signature(image_id, name, signature)
+        img = CassavaImage.objects.only('session').filter(pk=image_id).first() if valid else None
+        path = f'{preview_dir(img)}/{name}' if img else None
+        if path is None or not default_storage.exists(path):
+            return Response({'detail': 'Preview not found.'}, status=status.HTTP_404_NOT_FOUND)
+        response = FileResponse(default_storage.open(path, 'rb'), content_type=content_type(name))
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
         return response
 
 class EmailAuthTokenAPIView(APIView):
@@ -377,6 +610,7 @@ class EmailAuthTokenAPIView(APIView):
         user = authenticate(username=user.username, password=password)
         if user is not None:
             token, created = Token.objects.get_or_create(user=user)
+            log_activity(request, 'login', user=user)
             return Response({'token': token.key})
         return Response({'non_field_errors': ['Invalid email or password.']}, status=status.HTTP_400_BAD_REQUEST)
 
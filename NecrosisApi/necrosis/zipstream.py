@@ -0,0 +1,61 @@
+"""
+Streaming ZIP archives.
+
+zipfile can write to a non-seekable stream (it then uses data descriptors
+instead of seeking back to patch headers), so the archive is produced by
+writing into a small sink that is drained after every chunk. Only one chunk
+of one file is held in memory at a time, whatever the size of the archive.
+"""
+import io
+import os
+import zipfile
+
+# Formats that are already compressed gain nothing from deflate
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.zip'}
+CHUNK_SIZE = 64 * 1024
+
+
+class _StreamSink(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, chunk_size=CHUNK_SIZE):
+    """
+    Yields the bytes of a ZIP archive built from ``entries``, an iterable of
+    (archive_name, file_path) pairs. Files that cannot be opened are skipped.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for arcname, path in entries:
+            try:
+                source = open(path, 'rb')
+            except OSError:
+                continue
+            with source:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as destination:
+                    for chunk in iter(lambda: source.read(chunk_size), b''):
+                        destination.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            yield sink.drain()
+    yield sink.drain()